@@ -1,11 +1,14 @@
 """
 Variable store: Python Address (Save & Load & Delete).
 
-- Variables panel: dataset pipeline variables, residual direction variables, loaded model status
+- Variables panel: dataset pipeline variables, residual direction variables, adversarial
+  search checkpoints, loaded model status
 - Lifecycle: save, load, delete
 - NOTE: Heavy objects (HF datasets, tensors) are not stored here; we keep
   lightweight metadata and rough memory estimates for UI display.
   Residual directions dict is persisted to data/residual_variables.json.
+  Adversarial checkpoints keep their summary in data/adversarial_variables.json and the
+  search state (token ids, loss history, RNG state) in the variable pickle.
 """
 
 from __future__ import annotations
@@ -24,6 +27,7 @@ from python.model_load import get_model_status
 _DATA_DIR = Path(__file__).resolve().parent.parent.parent / "data"
 RESIDUAL_VARS_FILE = _DATA_DIR / "residual_variables.json"
 DATA_VARS_FILE = _DATA_DIR / "data_variables.json"
+ADVERSARIAL_VARS_FILE = _DATA_DIR / "adversarial_variables.json"
 PICKLE_DIR = _DATA_DIR / "variable_pickles"
 
 
@@ -63,14 +67,16 @@ class VariableStore:
     def __init__(self) -> None:
         self._data_vars: Dict[str, DataVarMeta] = {}
         self._residual_vars: Dict[str, Dict[str, Any]] = {}
+        self._adversarial_vars: Dict[str, Dict[str, Any]] = {}
         self._load_residual_vars()
         self._load_data_vars()
+        self._load_adversarial_vars()
 
     def _generate_uid(self, prefix: str = "var") -> str:
         stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         for _ in range(20):
             uid = f"{prefix}_{stamp}_{random.randint(100000, 999999)}"
-            if uid not in self._data_vars and uid not in self._residual_vars:
+            if uid not in self._data_vars and uid not in self._residual_vars and uid not in self._adversarial_vars:
                 return uid
         return f"{prefix}_{stamp}_{random.randint(100000, 999999)}"
 
@@ -175,6 +181,28 @@ class VariableStore:
         except IOError:
             pass
 
+    def _load_adversarial_vars(self) -> None:
+        """Load adversarial checkpoint summaries from disk."""
+        if not ADVERSARIAL_VARS_FILE.exists():
+            return
+        try:
+            with open(ADVERSARIAL_VARS_FILE, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+            self._adversarial_vars = {
+                uid: rv for uid, rv in (raw or {}).items() if isinstance(rv, dict) and rv.get("uid") == uid
+            }
+        except (json.JSONDecodeError, IOError):
+            self._adversarial_vars = {}
+
+    def _save_adversarial_vars(self) -> None:
+        """Persist adversarial checkpoint summaries to disk."""
+        ADVERSARIAL_VARS_FILE.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            with open(ADVERSARIAL_VARS_FILE, "w", encoding="utf-8") as f:
+                json.dump(self._adversarial_vars, f, indent=2, ensure_ascii=False)
+        except IOError:
+            pass
+
     @staticmethod
     def _build_saved_var_name(
         path: str,
@@ -283,10 +311,53 @@ class VariableStore:
         self._save_residual_vars()
         return uid
 
+    def save_adversarial(
+        self,
+        *,
+        summary: Dict[str, Any],
+        task_name: str,
+        model: str,
+        mode: str,
+        num_rows: int,
+        prefix_length: int,
+        uid: Optional[str] = None,
+        additional_naming: Optional[str] = None,
+    ) -> str:
+        """
+        Create (uid=None) or update an adversarial search checkpoint entry. summary holds the
+        small JSON fields (status, iterations_run, best_loss, ...). Returns variable id.
+        """
+        now = datetime.now().isoformat()
+        existing = self._adversarial_vars.get(uid or "")
+        if existing is None:
+            base = f"adversarial/{task_name}/{model}/{mode}/{num_rows}x{prefix_length}"
+            extra = (additional_naming or "").strip()
+            uid = self._generate_uid("adv")
+            existing = {"uid": uid, "nickname": base + (f"/{extra}" if extra else ""), "created_at": now}
+        self._adversarial_vars[uid] = {
+            **existing,
+            **summary,
+            "task_name": task_name,
+            "model": model,
+            "mode": mode,
+            "num_rows": num_rows,
+            "prefix_length": prefix_length,
+            "updated_at": now,
+        }
+        self._save_adversarial_vars()
+        return uid
+
+    def get_adversarial(self, name: str) -> Optional[Dict[str, Any]]:
+        """Get adversarial checkpoint summary by variable id or nickname."""
+        uid = self.resolve_id(name, preferred_type="adversarial")
+        if not uid:
+            return None
+        return self._adversarial_vars.get(uid)
+
     def resolve_id(self, name_or_id: str, preferred_type: Optional[str] = None) -> Optional[str]:
         if not name_or_id:
             return None
-        if name_or_id in self._data_vars or name_or_id in self._residual_vars:
+        if name_or_id in self._data_vars or name_or_id in self._residual_vars or name_or_id in self._adversarial_vars:
             return name_or_id
         matches = []
         if preferred_type in (None, "data"):
@@ -297,6 +368,10 @@ class VariableStore:
             for uid, rv in self._residual_vars.items():
                 if (rv.get("nickname") or "") == name_or_id:
                     matches.append((uid, rv.get("created_at", "")))
+        if preferred_type in (None, "adversarial"):
+            for uid, av in self._adversarial_vars.items():
+                if (av.get("nickname") or "") == name_or_id:
+                    matches.append((uid, av.get("created_at", "")))
         if not matches:
             return None
         matches.sort(key=lambda x: x[1] or "", reverse=True)
@@ -313,6 +388,11 @@ class VariableStore:
                 continue
             if (rv.get("nickname") or "") == nickname:
                 return True
+        for uid, av in self._adversarial_vars.items():
+            if uid == exclude_uid:
+                continue
+            if (av.get("nickname") or "") == nickname:
+                return True
         return False
 
     def get_residual(self, name: str) -> Optional[Dict[str, Any]]:
@@ -343,14 +423,21 @@ class VariableStore:
             if nickname and nickname != uid:
                 self.delete_raw_pickle(nickname)
             return True
+        if uid in self._adversarial_vars:
+            del self._adversarial_vars[uid]
+            self._save_adversarial_vars()
+            self.delete_pickle(uid)
+            return True
         return False
 
     def clear_all(self) -> None:
         """Drop all registered working-memory entries."""
         self._data_vars.clear()
         self._residual_vars.clear()
+        self._adversarial_vars.clear()
         self._save_data_vars()
         self._save_residual_vars()
+        self._save_adversarial_vars()
 
     def get_meta(self, name: str) -> Optional[DataVarMeta]:
         """Get variable metadata by id or nickname."""
@@ -375,8 +462,11 @@ class VariableStore:
             return False
         try:
             PICKLE_DIR.mkdir(parents=True, exist_ok=True)
-            with open(self.pickle_path(name), "wb") as f:
+            path = self.pickle_path(name)
+            tmp = path.with_suffix(".pkl.tmp")
+            with open(tmp, "wb") as f:
                 pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+            tmp.replace(path)
             return True
         except Exception:
             return False
@@ -455,6 +545,25 @@ class VariableStore:
                 "memory_ram_mb": mem_mb,
                 "hd_path": str(self.pickle_path(uid)),
             }
+        if uid in self._adversarial_vars:
+            av = self._adversarial_vars[uid] or {}
+            return {
+                "id": uid,
+                "name": av.get("nickname") or uid,
+                "type": "adversarial",
+                "created_at": av.get("created_at", ""),
+                "updated_at": av.get("updated_at", ""),
+                "task_name": av.get("task_name", ""),
+                "model": av.get("model", ""),
+                "mode": av.get("mode", ""),
+                "num_rows": av.get("num_rows", 0),
+                "prefix_length": av.get("prefix_length", 0),
+                "status": av.get("status", ""),
+                "iterations_run": av.get("iterations_run", 0),
+                "best_loss": av.get("best_loss"),
+                "memory_ram_mb": 0,
+                "hd_path": str(self.pickle_path(uid)),
+            }
         return None
 
     def rename(self, old_name: str, new_name: str) -> bool:
@@ -476,6 +585,10 @@ class VariableStore:
             rv["nickname"] = new_name
             self._save_residual_vars()
             return True
+        if uid in self._adversarial_vars:
+            self._adversarial_vars[uid]["nickname"] = new_name
+            self._save_adversarial_vars()
+            return True
         return False
 
     def summarize_for_panel(self, loaded_model_key: Optional[str]) -> Dict[str, Any]:
@@ -539,6 +652,16 @@ class VariableStore:
                 "memory_ram_mb": mem_mb,
                 "type": "residual",
             })
+        for uid, av in self._adversarial_vars.items():
+            variables.append({
+                "id": uid,
+                "name": av.get("nickname") or uid,
+                "pipeline_id": None,
+                "task_name": av.get("task_name", ""),
+                "created_at": av.get("created_at", ""),
+                "memory_ram_mb": 0,
+                "type": "adversarial",
+            })
 
         return {"loaded_model": loaded_model, "variables": variables}
 
@@ -626,3 +749,33 @@ def save_residual_variable(
 def get_residual_variable(name: str) -> Optional[Dict[str, Any]]:
     """Get residual directions by variable name."""
     return variable_store.get_residual(name)
+
+
+def save_adversarial_checkpoint(
+    *,
+    payload: Dict[str, Any],
+    summary: Dict[str, Any],
+    task_name: str,
+    model: str,
+    mode: str,
+    num_rows: int,
+    prefix_length: int,
+    uid: Optional[str] = None,
+) -> str:
+    """Create/update an adversarial checkpoint variable and pickle its search state. Returns uid."""
+    uid = variable_store.save_adversarial(
+        summary=summary,
+        task_name=task_name,
+        model=model,
+        mode=mode,
+        num_rows=num_rows,
+        prefix_length=prefix_length,
+        uid=uid,
+    )
+    variable_store.save_pickle(uid, payload)
+    return uid
+
+
+def get_adversarial_variable(name: str) -> Optional[Dict[str, Any]]:
+    """Get adversarial checkpoint summary by variable name."""
+    return variable_store.get_adversarial(name)
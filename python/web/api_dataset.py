@@ -58,6 +58,8 @@ def _cache_object_name(payload: dict) -> str:
         return "Dataset"
     if payload.get("type") == "residual":
         return "ResidualDirections"
+    if payload.get("type") == "adversarial":
+        return "AdversarialCheckpoint"
     return payload.get("type", "")
 
 
@@ -400,6 +402,19 @@ def api_load_data_var(var_id: str):
                 "device": device,
             },
         )
+    elif detail.get("type") == "adversarial":
+        cache_store.put(
+            _VARIABLE_LOAD_NAMESPACE,
+            resolved,
+            {
+                "type": "adversarial",
+                "data": payload,
+                "loaded_at": datetime.now().isoformat(),
+                "object_name": "AdversarialCheckpoint",
+                "display_name": detail.get("name") or resolved,
+                "device": device,
+            },
+        )
     else:
         ds = payload.get("dataset") if isinstance(payload, dict) else payload
         cache_store.put(
@@ -64,3 +64,75 @@ def api_save_residual_var():
     }
     pickle_saved = save_variable_pickle(var_id, payload)
     return jsonify({"status": "ok", "variable_id": var_id, "variable_name": var_name, "pickle_saved": pickle_saved})
+
+
+@residual_bp.get("/api/residual-stats/<stats_id>")
+def api_get_residual_stats(stats_id: str):
+    """Per-label statistics kept from a residual run: labels, example counts, hook keys."""
+    from python.xai_2.residual_concept_detection import get_label_stats
+
+    entry = get_label_stats(stats_id)
+    if not entry:
+        return jsonify({"error": "Stats not found (expired or server restarted)"}), 404
+    stats = entry.get("stats") or {}
+    first = next(iter(stats.values()), None)
+    return jsonify({
+        "stats_id": stats_id,
+        "labels": [{"label": n, "n_examples": c} for n, c in zip(entry["class_names"], entry["class_examples"])],
+        "keys": list(stats.keys()),
+        "model_dim": int(first[0].shape[-1]) if first is not None else 0,
+        "model": entry.get("model"),
+        "treatment": entry.get("treatment"),
+        "label_key": entry.get("label_key"),
+        "has_covariance": bool(entry.get("second_order")),
+    })
+
+
+@residual_bp.post("/api/residual-stats/<stats_id>/directions")
+def api_residual_stats_directions(stats_id: str):
+    """
+    Directions from stored per-label statistics, without re-running the model.
+    Body: { direction_mode: "pair"|"pairs"|"one_vs_rest"|"class_mean", positive_label?, negative_label?, label_pairs?,
+            estimator?: "mean_diff"|"lda"|"whitened_mean", shrinkage? }.
+    lda / whitened_mean need a run that collected covariance (estimator other than mean_diff).
+    """
+    from flask import request
+
+    from python.xai_2.residual_concept_detection import compute_directions, get_label_stats, parse_label_pairs
+
+    entry = get_label_stats(stats_id)
+    if not entry:
+        return jsonify({"error": "Stats not found (expired or server restarted)"}), 404
+    data = request.get_json(force=True) or {}
+    mode = (data.get("direction_mode") or "pair").strip().lower()
+    estimator = (data.get("estimator") or "mean_diff").strip().lower()
+    try:
+        shrinkage = float(data.get("shrinkage", 0.1))
+    except (TypeError, ValueError):
+        return jsonify({"error": "shrinkage must be a number"}), 400
+    try:
+        sets = compute_directions(
+            entry["stats"],
+            entry["class_names"],
+            mode,
+            str(data.get("positive_label") or "").strip(),
+            str(data.get("negative_label") or "").strip(),
+            parse_label_pairs(data.get("label_pairs")),
+            estimator,
+            entry.get("second_order"),
+            shrinkage,
+        )
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    direction_sets = {name: {k: v.tolist() for k, v in vecs.items()} for name, vecs in sets.items()}
+    directions = next(iter(direction_sets.values()), {})
+    return jsonify({
+        "status": "ok",
+        "stats_id": stats_id,
+        "direction_mode": mode,
+        "estimator": estimator,
+        "directions": directions,
+        "direction_sets": direction_sets,
+        "num_keys": len(directions),
+        "model_dim": len(next(iter(directions.values()), [])) if directions else 0,
+    })
@@ -13,6 +13,7 @@ from python.xai_handlers import (
 )
 from python.dataset_pipeline_store import get_pipeline_by_id
 from python.web.dataset_utils import load_pipeline_dataset
+from python.web.run_jobs import cancel_job, get_job, start_job
 
 run_bp = Blueprint("run", __name__)
 
@@ -109,6 +110,7 @@ def api_run():
             input_setting=input_setting,
             load_dataset_fn=load_pipeline_dataset,
             progress_callback=None,
+            treatment=treatment,
         )
         return jsonify(result), status
 
@@ -121,49 +123,26 @@ def api_run():
     return jsonify(result), status
 
 
-@run_bp.post("/api/run/residual-concept-stream")
-def api_run_residual_concept_stream():
-    """
-    Residual Concept Detection with SSE progress stream.
-    Same body as /api/run. Streams: data: {"type":"progress","batch":n,"total":m}\n\n
-    Final: data: {"type":"done","result":{...}}\n\n
-    """
-    data = request.get_json(force=True) or {}
-    model = data.get("model", "")
-    treatment = data.get("treatment", "")
-    input_setting = data.get("input_setting", {})
-
-    sess = cache_store.get_session()
-    current_model = sess.get("loaded_model")
-    current_treatment = sess.get("treatment")
+_SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
 
-    if model != current_model or treatment != current_treatment:
-        def err_gen():
-            yield f"data: {json.dumps({'type': 'error', 'error': 'session_mismatch'})}\n\n"
 
-        return Response(
-            stream_with_context(err_gen()),
-            mimetype="text/event-stream",
-            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
-        )
+def _sse_error(error: str) -> Response:
+    """Single-event SSE response carrying an error."""
+    def err_gen():
+        yield f"data: {json.dumps({'type': 'error', 'error': error})}\n\n"
 
-    if not (input_setting.get("variable_name") or "").strip() or not current_model:
-        def err_gen():
-            yield f"data: {json.dumps({'type': 'error', 'error': 'variable_name required'})}\n\n"
+    return Response(stream_with_context(err_gen()), mimetype="text/event-stream", headers=_SSE_HEADERS)
 
-        return Response(
-            stream_with_context(err_gen()),
-            mimetype="text/event-stream",
-            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
-        )
 
+def _sse_run(work) -> Response:
+    """
+    Run work(emit) -> (result, status) in a worker thread and stream every dict passed
+    to emit as an SSE event. Final: data: {"type":"done","result":{...}} or {"type":"error",...}.
+    """
     queue: "Queue[dict]" = Queue()
     result_holder: dict = {}
     error_holder: dict = {}
 
-    def progress_cb(batch, total):
-        queue.put({"type": "progress", "batch": batch, "total": total, "message": f"Forward batch {batch}/{total}"})
-
     # Capture the real app object while we are still in request context
     app_obj = current_app._get_current_object()
 
@@ -171,12 +150,7 @@ def api_run_residual_concept_stream():
         # Use a dedicated application context inside the worker thread
         with app_obj.app_context():
             try:
-                res, status = run_residual_concept(
-                    model=model,
-                    input_setting=input_setting,
-                    load_dataset_fn=load_pipeline_dataset,
-                    progress_callback=progress_cb,
-                )
+                res, status = work(queue.put)
                 if status >= 400:
                     error_holder["error"] = res.get("error", "Unknown error")
                 else:
@@ -207,11 +181,182 @@ def api_run_residual_concept_stream():
             except (TypeError, ValueError) as e:
                 yield f"data: {json.dumps({'type': 'error', 'error': f'Result serialize error: {e}'})}\n\n"
 
-    return Response(
-        stream_with_context(gen()),
-        mimetype="text/event-stream",
-        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
-    )
+    return Response(stream_with_context(gen()), mimetype="text/event-stream", headers=_SSE_HEADERS)
+
+
+def _sse_job(job, since: int = 0) -> Response:
+    """Stream a RunJob's events (replayed from index since) as SSE until its final event."""
+    def gen():
+        if since == 0:
+            yield f"data: {json.dumps({'type': 'job', 'job_id': job.id, 'kind': job.kind})}\n\n"
+        for msg in job.iter_events(since):
+            try:
+                yield f"data: {json.dumps(msg)}\n\n"
+            except (TypeError, ValueError) as e:
+                yield f"data: {json.dumps({'type': 'error', 'error': f'Result serialize error: {e}'})}\n\n"
+
+    return Response(stream_with_context(gen()), mimetype="text/event-stream", headers=_SSE_HEADERS)
+
+
+@run_bp.post("/api/run/residual-concept-stream")
+def api_run_residual_concept_stream():
+    """
+    Residual Concept Detection as a cancellable job with SSE progress.
+    Same body as /api/run. Streams: data: {"type":"job","job_id":...} first, then
+    data: {"type":"progress","batch":n,"total":m}\n\n per batch.
+    Final: data: {"type":"done","result":{...}}\n\n
+    Cancel with POST /api/run/jobs/<job_id>/cancel (partial sums are checkpointed; the same run
+    resumes from there); re-attach with GET /api/run/jobs/<job_id>/stream?since=n.
+    """
+    data = request.get_json(force=True) or {}
+    model = data.get("model", "")
+    treatment = data.get("treatment", "")
+    input_setting = data.get("input_setting", {})
+
+    sess = cache_store.get_session()
+    current_model = sess.get("loaded_model")
+    current_treatment = sess.get("treatment")
+
+    if model != current_model or treatment != current_treatment:
+        return _sse_error("session_mismatch")
+
+    if not (input_setting.get("variable_name") or "").strip() or not current_model:
+        return _sse_error("variable_name required")
+
+    def work(job):
+        def progress_cb(batch, total):
+            job.emit({"type": "progress", "batch": batch, "total": total, "message": f"Forward batch {batch}/{total}"})
+
+        return run_residual_concept(
+            model=model,
+            input_setting=input_setting,
+            load_dataset_fn=load_pipeline_dataset,
+            progress_callback=progress_cb,
+            treatment=treatment,
+            should_stop=job.should_stop,
+        )
+
+    job = start_job("residual", work, app=current_app._get_current_object())
+    return _sse_job(job)
+
+
+@run_bp.post("/api/run/attribution-matrix-stream")
+def api_run_attribution_matrix_stream():
+    """
+    Response Attribution with attribution_method="input_grad_matrix", streamed.
+    Same body as /api/run. Streams: data: {"type":"matrix_meta","input_tokens":[...],"output_tokens":[...]}
+    then data: {"type":"matrix_rows","start":j,"rows":[[...], ...],"total":n} per row chunk.
+    Final: data: {"type":"done","result":{...}}\n\n without attribution_matrix (already streamed as rows).
+    """
+    from python.xai_handlers import run_attribution
+
+    data = request.get_json(force=True) or {}
+    model = data.get("model", "")
+    treatment = data.get("treatment", "")
+    input_setting = data.get("input_setting", {})
+
+    sess = cache_store.get_session()
+    current_model = sess.get("loaded_model")
+    current_treatment = sess.get("treatment")
+
+    if model != current_model or treatment != current_treatment:
+        return _sse_error("session_mismatch")
+
+    if "input_string" not in input_setting or not current_model:
+        return _sse_error("input_string required")
+
+    def work(emit):
+        def progress_cb(msg):
+            if msg.get("type") == "matrix_rows":
+                done_rows = msg["start"] + len(msg["rows"])
+                msg = {**msg, "message": f"Attribution rows {done_rows}/{msg['total']}"}
+            emit(msg)
+
+        res, status = run_attribution(
+            model=model,
+            treatment=treatment,
+            current_model=current_model,
+            input_string=(input_setting.get("input_string") or "").strip(),
+            system_instruction=(input_setting.get("system_instruction") or "").strip(),
+            attribution_method="input_grad_matrix",
+            input_setting=input_setting,
+            progress_callback=progress_cb,
+        )
+        if status < 400:
+            res = {k: v for k, v in res.items() if k != "attribution_matrix"}
+        return res, status
+
+    return _sse_run(work)
+
+
+@run_bp.post("/api/run/adversarial-stream")
+def api_run_adversarial_stream():
+    """
+    Adversarial Text Generation as a cancellable job with SSE progress.
+    Same body as /api/run. Streams: data: {"type":"job","job_id":...} first, then one
+    data: {"type":"progress","iteration":i,"total":n,"elapsed_seconds":s,"rows":[...]} per iteration.
+    Final: data: {"type":"done","result":{...}}\n\n (best prefixes so far when cancelled).
+    Cancel with POST /api/run/jobs/<job_id>/cancel; re-attach with GET /api/run/jobs/<job_id>/stream.
+    """
+    from python.xai_handlers import run_adversarial_text_generation
+
+    data = request.get_json(force=True) or {}
+    model = data.get("model", "")
+    treatment = data.get("treatment", "")
+    input_setting = data.get("input_setting", {})
+
+    sess = cache_store.get_session()
+    current_model = sess.get("loaded_model")
+    current_treatment = sess.get("treatment")
+
+    if model != current_model or treatment != current_treatment:
+        return _sse_error("session_mismatch")
+
+    if input_setting.get("adversarial_rows") is None or not current_model:
+        return _sse_error("adversarial_rows required")
+
+    def work(job):
+        return run_adversarial_text_generation(
+            model=model,
+            treatment=treatment,
+            current_model=current_model,
+            input_setting=input_setting,
+            progress_callback=job.emit,
+            should_stop=job.should_stop,
+        )
+
+    job = start_job("adversarial", work, app=current_app._get_current_object())
+    return _sse_job(job)
+
+
+@run_bp.get("/api/run/jobs/<job_id>")
+def api_run_job(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(job.summary())
+
+
+@run_bp.get("/api/run/jobs/<job_id>/stream")
+def api_run_job_stream(job_id):
+    """Re-attach to a running (or recently finished) job; ?since=n skips the first n events."""
+    job = get_job(job_id)
+    if job is None:
+        return _sse_error("job not found")
+    try:
+        since = max(0, int(request.args.get("since", 0)))
+    except ValueError:
+        since = 0
+    return _sse_job(job, since)
+
+
+@run_bp.post("/api/run/jobs/<job_id>/cancel")
+def api_run_job_cancel(job_id):
+    """Ask a running job to stop after its current step."""
+    job = cancel_job(job_id)
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify({"status": "ok", **job.summary()})
 
 
 @run_bp.post("/api/conversation/clear")
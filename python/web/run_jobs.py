@@ -0,0 +1,149 @@
+"""
+In-process registry of long-running streamed runs (adversarial search, ...).
+
+A RunJob keeps every event it emitted, so a client that lost its SSE connection can
+re-attach and replay from any event index, and a cancel Event the worker polls between
+steps. Finished jobs are kept for a while (at most MAX_FINISHED_JOBS, and MAX_FINISHED_BYTES
+of serialized events between them) so their result can still be replayed, then dropped
+oldest first; the most recently finished job is always kept.
+"""
+
+from __future__ import annotations
+
+import json
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+
+MAX_FINISHED_JOBS = 16
+MAX_FINISHED_BYTES = 256 << 20
+
+
+class RunJob:
+    def __init__(self, kind: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.created = time.time()
+        self.finished: Optional[float] = None
+        self.cancel_event = threading.Event()
+        self.events: List[Dict[str, Any]] = []
+        self.nbytes = 0  # serialized size of events, for pruning
+        self._cond = threading.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self.finished is not None
+
+    def should_stop(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def cancel(self) -> None:
+        self.cancel_event.set()
+
+    def emit(self, msg: Dict[str, Any]) -> None:
+        size = _event_bytes(msg)
+        with self._cond:
+            self.events.append(msg)
+            self.nbytes += size
+            self._cond.notify_all()
+
+    def finish(self, msg: Dict[str, Any]) -> None:
+        """Emit the final {"type": "done"|"error", ...} event and mark the job finished."""
+        size = _event_bytes(msg)
+        with self._cond:
+            self.events.append(msg)
+            self.nbytes += size
+            self.finished = time.time()
+            self._cond.notify_all()
+
+    def iter_events(self, since: int = 0, timeout: float = 300.0) -> Iterator[Dict[str, Any]]:
+        """Yield events from index since until the final one (or until timeout without news)."""
+        index = max(0, int(since))
+        while True:
+            with self._cond:
+                if index >= len(self.events) and not self.done:
+                    self._cond.wait(timeout)
+                pending = self.events[index:]
+                finished = self.done
+            if not pending and not finished:
+                return
+            for msg in pending:
+                yield msg
+            index += len(pending)
+            if finished and index >= len(self.events):
+                return
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "created": self.created,
+            "finished": self.finished,
+            "cancelled": self.cancel_event.is_set(),
+            "events": len(self.events),
+        }
+
+
+def _event_bytes(msg: Dict[str, Any]) -> int:
+    try:
+        return len(json.dumps(msg, default=str))
+    except (TypeError, ValueError):
+        return 0
+
+
+_jobs: Dict[str, RunJob] = {}
+_lock = threading.Lock()
+
+
+def _prune() -> None:
+    finished = sorted((j for j in _jobs.values() if j.done), key=lambda j: j.finished or 0.0)
+    total = sum(j.nbytes for j in finished)
+    while len(finished) > 1 and (len(finished) > MAX_FINISHED_JOBS or total > MAX_FINISHED_BYTES):
+        job = finished.pop(0)
+        _jobs.pop(job.id, None)
+        total -= job.nbytes
+
+
+def start_job(kind: str, work: Callable[[RunJob], Tuple[Dict[str, Any], int]], app=None) -> RunJob:
+    """
+    Run work(job) -> (result, status) in a worker thread (inside app.app_context() when app is
+    given). Events emitted by work are recorded on the job; the final event is
+    {"type": "done", "result": ...} or {"type": "error", "error": ...}.
+    """
+    job = RunJob(kind)
+    with _lock:
+        _prune()
+        _jobs[job.id] = job
+
+    def run_thread():
+        try:
+            if app is not None:
+                with app.app_context():
+                    res, status = work(job)
+            else:
+                res, status = work(job)
+            if status >= 400:
+                job.finish({"type": "error", "error": res.get("error", "Unknown error")})
+            else:
+                job.finish({"type": "done", "result": res})
+        except Exception as e:  # noqa: BLE001
+            job.finish({"type": "error", "error": str(e)})
+        with _lock:
+            _prune()
+
+    threading.Thread(target=run_thread, daemon=True).start()
+    return job
+
+
+def get_job(job_id: str) -> Optional[RunJob]:
+    with _lock:
+        return _jobs.get(job_id)
+
+
+def cancel_job(job_id: str) -> Optional[RunJob]:
+    job = get_job(job_id)
+    if job is not None:
+        job.cancel()
+    return job
@@ -1,48 +1,35 @@
 """Adversarial prefix search for target responses.
 
-Described algorithm: discrete prefix tokens are greedily replaced based on
-gradient direction to steer the model toward a desired target text output.
+Described algorithm: discrete prefix (or suffix) tokens are optimized with Greedy
+Coordinate Gradient (python.xai_1.gcg): gradient top-k token pools per position, batched
+evaluation of candidate swaps, keep the candidate with the lowest target loss.
 """
 
 from __future__ import annotations
 
-from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 
+import numpy as np
 import torch
-import torch.nn.functional as F
 
 from python.model_load import get_model_device, load_llm
+from python.xai_1.gcg import (
+    DEFAULT_SEARCH_WIDTH,
+    DEFAULT_TOP_K,
+    PLACEMENTS,
+    build_chat_segments,
+    run_gcg,
+    run_universal_gcg,
+)
+from python.xai_1.vocab_filter import allowed_token_mask, parse_token_filters
 
 
 DEFAULT_PREFIX_LEN = 3
 DEFAULT_ITERATIONS = 6
 MAX_PREFIX_LEN = 32
-MAX_ITERATIONS = 64
-
-
-def _clean_token_ids(value: Any, vocab_size: int, prefix_len: int) -> List[int]:
-    if not value:
-        return []
-    ids: List[int] = []
-    iterable: Iterable[Any]
-    if isinstance(value, str):
-        iterable = [tok for tok in value.replace("/", " ").replace(";", " ").split()]
-    elif isinstance(value, Iterable):
-        iterable = value
-    else:
-        iterable = [value]
-    for raw in iterable:
-        if isinstance(raw, str) and raw.strip() == "":
-            continue
-        try:
-            num = int(raw)
-        except (TypeError, ValueError):
-            continue
-        if 0 <= num < vocab_size:
-            ids.append(num)
-            if len(ids) >= prefix_len:
-                break
-    return ids
+MAX_ITERATIONS = 500
+MAX_SOFT_PROMPT_STEPS = 2000
 
 
 def _build_initial_prefix(
@@ -50,46 +37,123 @@ def _build_initial_prefix(
     vocab_size: int,
     device: torch.device,
     seed_ids: Optional[Sequence[int]] = None,
+    allowed: Optional[torch.Tensor] = None,
 ) -> torch.Tensor:
     seed = seed_ids or []
     clean = [int(x) for x in seed if isinstance(x, int) or (isinstance(x, str) and x.isdigit())]
     clean = [x for x in clean if 0 <= x < vocab_size]
     clean = clean[:prefix_len]
     if len(clean) < prefix_len:
-        rand = torch.randint(0, vocab_size, (prefix_len - len(clean),), device=device)
+        if allowed is not None and bool(allowed.any()):
+            pool = allowed.nonzero(as_tuple=True)[0]
+            rand = pool[torch.randint(0, pool.numel(), (prefix_len - len(clean),), device=pool.device)]
+        else:
+            rand = torch.randint(0, vocab_size, (prefix_len - len(clean),), device=device)
         clean.extend(int(x) for x in rand.tolist())
     tensor = torch.tensor(clean[:prefix_len], dtype=torch.long, device=device)
     return tensor
 
 
-def _token_mask(tokenizer, vocab_size: int, device: torch.device) -> torch.Tensor:
-    mask = torch.ones(vocab_size, dtype=torch.bool, device=device)
-    special_ids = getattr(tokenizer, "all_special_ids", []) or []
-    for sid in special_ids:
-        if isinstance(sid, int) and 0 <= sid < vocab_size:
-            mask[sid] = False
-    pad_id = getattr(tokenizer, "pad_token_id", None)
-    if isinstance(pad_id, int) and 0 <= pad_id < vocab_size:
-        mask[pad_id] = False
-    eos_id = getattr(tokenizer, "eos_token_id", None)
-    if isinstance(eos_id, int) and 0 <= eos_id < vocab_size:
-        mask[eos_id] = False
-    unk_id = getattr(tokenizer, "unk_token_id", None)
-    if isinstance(unk_id, int) and 0 <= unk_id < vocab_size:
-        mask[unk_id] = False
-    return mask
-
-
-def find_adversarial_prefix(
+def _seed_prefix_ids(tokenizer, initial_prefix_ids: Optional[Sequence[int]], initial_prefix_text: Optional[str]) -> List[int]:
+    text_seed_ids: List[int] = []
+    if initial_prefix_text:
+        try:
+            seed_enc = tokenizer(initial_prefix_text, return_tensors="pt", add_special_tokens=False)
+            if seed_enc["input_ids"].numel() > 0:
+                text_seed_ids = seed_enc["input_ids"][0].tolist()
+        except Exception:
+            text_seed_ids = []
+    combined_prefix_ids: List[int] = []
+    if initial_prefix_ids:
+        combined_prefix_ids.extend([int(x) for x in initial_prefix_ids if isinstance(x, int)])
+    combined_prefix_ids.extend([x for x in text_seed_ids if isinstance(x, int)])
+    return combined_prefix_ids
+
+
+def _progress_step_callback(
+    tokenizer,
+    progress_callback: Callable[[Dict[str, Any]], None],
+    iterations: int,
+    row_index: Sequence[int],
+) -> Callable[[Dict[str, Any]], None]:
+    """Turn gcg step states into progress events (best loss / decoded best prefix per row, elapsed time)."""
+    started = time.perf_counter()
+
+    def on_step(state: Dict[str, Any]) -> None:
+        best_ids = state["best_ids"].tolist()
+        active = set(state["active"])
+        rows = [
+            {
+                "row_index": idx,
+                "loss": state["best_loss"][j],
+                "step_loss": state["step_loss"][j],
+                "prefix_text": tokenizer.decode(best_ids[j], skip_special_tokens=True),
+                "target_reached": state["target_reached"][j],
+                "active": j in active,
+            }
+            for j, idx in enumerate(row_index)
+        ]
+        best = min((r["loss"] for r in rows if r["loss"] is not None), default=None)
+        message = f"Iteration {state['iteration']}/{iterations}"
+        if best is not None:
+            message += f" · best loss {best:.3f}"
+        progress_callback(
+            {
+                "type": "progress",
+                "iteration": state["iteration"],
+                "total": iterations,
+                "elapsed_seconds": round(time.perf_counter() - started, 3),
+                "active_rows": len(active),
+                "rows": rows,
+                "message": message,
+            }
+        )
+
+    return on_step
+
+
+def find_adversarial_prefixes(
     model_key: str,
-    input_string: str,
-    target_text: str,
+    rows: Sequence[Dict[str, Any]],
     prefix_length: int = DEFAULT_PREFIX_LEN,
     iterations: int = DEFAULT_ITERATIONS,
-    initial_prefix_ids: Optional[Sequence[int]] = None,
-    initial_prefix_text: Optional[str] = None,
-) -> Dict[str, Any]:
-    """Greedy discrete attack that replaces one token at a time by the gradient."""
+    gradient_checkpointing: bool = False,
+    placement: str = "prefix",
+    search_width: int = DEFAULT_SEARCH_WIDTH,
+    top_k: int = DEFAULT_TOP_K,
+    eval_batch_size: int = 0,
+    seed: Optional[int] = None,
+    token_filter: Sequence[str] = ("special",),
+    early_stop: bool = True,
+    patience: int = 0,
+    progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+    resume_state: Optional[Dict[str, Any]] = None,
+    checkpoint_every: int = 0,
+    checkpoint_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+    soft_prompt_steps: int = 0,
+    soft_prompt_lr: float = 0.1,
+    soft_prompt_compare: bool = False,
+) -> List[Dict[str, Any]]:
+    """
+    GCG search (python.xai_1.gcg) for prefix_length tokens placed before (placement="prefix")
+    or after ("suffix") the input string in the user turn, steering the reply toward target_text.
+    rows: [{input_string, target_text, seed_ids?, seed_text?}]; all valid rows are optimized
+    jointly in one padded batch, and a row stops once greedy decoding reproduces its target
+    (early_stop). Every iteration scores search_width candidate swaps per row from the top_k
+    gradient tokens per position (eval_batch_size candidates per forward, 0 = all at once).
+    gradient_checkpointing=True enables activation checkpointing for the search's gradient passes.
+    token_filter names the cached vocabulary masks (python.xai_1.vocab_filter) the search may use.
+    patience > 0 stops a row whose best loss has not improved for that many iterations.
+    progress_callback receives one {"type": "progress", ...} event per iteration; should_stop()
+    cancels the search, which then returns the best prefixes found so far.
+    checkpoint_callback receives the gcg search state every checkpoint_every iterations and at
+    the end; resume_state (such a state, for the same rows and settings) continues that search.
+    soft_prompt_steps > 0 starts from projected soft-prompt embeddings instead of the random
+    tokens; soft_prompt_compare=True also runs the plain search from the same start and seed and
+    reports baseline_iterations_to_target / iterations_saved per row.
+    Returns one result dict per row, in order; invalid rows carry "error".
+    """
 
     tokenizer, model = load_llm(model_key)
     device = get_model_device(model)
@@ -97,110 +161,382 @@ def find_adversarial_prefix(
 
     prefix_length = max(1, min(prefix_length, MAX_PREFIX_LEN))
     iterations = max(1, min(iterations, MAX_ITERATIONS))
-
-    prompt_input = (input_string or "").strip()
-    target_input = (target_text or "").strip()
-    if not target_input:
-        raise ValueError("target_text is required")
-
-    prompt_enc = tokenizer(prompt_input, return_tensors="pt", add_special_tokens=True)
-    prompt_ids = prompt_enc["input_ids"][0].to(device)
-    target_enc = tokenizer(target_input, return_tensors="pt", add_special_tokens=False)
-    target_ids = target_enc["input_ids"][0].to(device)
-    if target_ids.numel() == 0:
-        raise ValueError("target_text must contain at least one token")
+    placement = placement if placement in PLACEMENTS else "prefix"
 
     embed_layer = model.get_input_embeddings()
     vocab_size = embed_layer.num_embeddings
     if not isinstance(vocab_size, int) or vocab_size <= 0:
         raise ValueError("invalid vocabulary size")
+    token_filter = parse_token_filters(token_filter)
+    token_mask = allowed_token_mask(tokenizer, vocab_size, device, token_filter)
+    if not bool(token_mask.any()):
+        raise ValueError(f"token_filter {', '.join(token_filter)} leaves no allowed tokens")
+
+    results: List[Dict[str, Any]] = []
+    search_rows: List[Dict[str, torch.Tensor]] = []
+    search_index: List[int] = []
+    for idx, row in enumerate(rows):
+        prompt_input = (row.get("input_string") or "").strip()
+        target_input = (row.get("target_text") or "").strip()
+        results.append({"input_string": prompt_input, "target_text": target_input})
+        if not target_input:
+            results[idx]["error"] = "target_text is required"
+            continue
+        target_ids = tokenizer(target_input, return_tensors="pt", add_special_tokens=False)["input_ids"][0]
+        if target_ids.numel() == 0:
+            results[idx]["error"] = "target_text must contain at least one token"
+            continue
+        before_ids, after_ids = build_chat_segments(tokenizer, prompt_input, placement)
+        seeds = _seed_prefix_ids(tokenizer, row.get("seed_ids"), row.get("seed_text"))
+        search_rows.append(
+            {
+                "before_ids": before_ids.to(device),
+                "update_ids": _build_initial_prefix(prefix_length, vocab_size, device, seeds, token_mask),
+                "after_ids": after_ids.to(device),
+                "target_ids": target_ids.to(device),
+            }
+        )
+        search_index.append(idx)
+
+    if not search_rows:
+        return results
+
+    soft_prompt_steps = max(0, min(int(soft_prompt_steps), MAX_SOFT_PROMPT_STEPS)) if resume_state is None else 0
+    baselines: List[Optional[Dict[str, Any]]] = [None] * len(search_rows)
+    if soft_prompt_steps > 0 and soft_prompt_compare:
+        # Both searches need the same sampling seed for the comparison to mean anything.
+        if seed is None:
+            seed = int(torch.randint(0, 2**31 - 1, (1,)).item())
+        baselines = run_gcg(
+            model,
+            tokenizer,
+            search_rows,
+            token_mask,
+            iterations=iterations,
+            search_width=search_width,
+            top_k=top_k,
+            eval_batch_size=eval_batch_size,
+            gradient_checkpointing=gradient_checkpointing,
+            seed=seed,
+            early_stop=early_stop,
+            patience=patience,
+            should_stop=should_stop,
+        )
+
+    searches = run_gcg(
+        model,
+        tokenizer,
+        search_rows,
+        token_mask,
+        iterations=iterations,
+        search_width=search_width,
+        top_k=top_k,
+        eval_batch_size=eval_batch_size,
+        gradient_checkpointing=gradient_checkpointing,
+        seed=seed,
+        early_stop=early_stop,
+        patience=patience,
+        step_callback=(
+            _progress_step_callback(tokenizer, progress_callback, iterations, search_index)
+            if progress_callback is not None
+            else None
+        ),
+        should_stop=should_stop,
+        resume_state=resume_state,
+        checkpoint_every=checkpoint_every,
+        checkpoint_callback=checkpoint_callback,
+        soft_prompt_steps=soft_prompt_steps,
+        soft_prompt_lr=soft_prompt_lr,
+    )
+
+    for idx, search, baseline in zip(search_index, searches, baselines):
+        prompt_input = results[idx]["input_string"]
+        final_ids = search["update_ids"].tolist()
+        prefix_text = tokenizer.decode(final_ids, skip_special_tokens=True)
+        adversarial_input = f"{prefix_text} {prompt_input}" if placement == "prefix" else f"{prompt_input} {prefix_text}"
+        results[idx].update(
+            {
+                "status": "ok",
+                "placement": placement,
+                "prefix_ids": final_ids,
+                "prefix_tokens": tokenizer.convert_ids_to_tokens(final_ids),
+                "prefix_text": prefix_text,
+                "adversarial_input": adversarial_input.strip(),
+                "loss": search["loss"],
+                "target_reached": search["target_reached"],
+                "iterations": iterations,
+                "iterations_run": search["iterations_run"],
+                "stop_reason": search["stop_reason"],
+                "initial_loss": search["initial_loss"],
+                "iterations_to_target": search["iterations_to_target"],
+                "soft_prompt": search["soft_prompt"],
+                "prefix_cache_tokens": search["prefix_cache_tokens"],
+                "loss_history": search["loss_history"],
+                "search_width": search_width,
+                "top_k": top_k,
+                "token_filter": list(token_filter),
+                "grad_pass": search["grad_pass"],
+            }
+        )
+        if baseline is not None:
+            soft_at, base_at = search["iterations_to_target"], baseline["iterations_to_target"]
+            results[idx].update(
+                {
+                    "baseline_initial_loss": baseline["initial_loss"],
+                    "baseline_loss": baseline["loss"],
+                    "baseline_target_reached": baseline["target_reached"],
+                    "baseline_iterations_to_target": base_at,
+                    "iterations_saved": base_at - soft_at if soft_at is not None and base_at is not None else None,
+                }
+            )
+    return results
 
-    text_seed_ids: List[int] = []
-    if initial_prefix_text:
-        try:
-            seed_enc = tokenizer(initial_prefix_text, return_tensors="pt", add_special_tokens=False)
-            if seed_enc["input_ids"].numel() > 0:
-                text_seed_ids = seed_enc["input_ids"][0].tolist()
-        except Exception:
-            text_seed_ids = []
-    combined_prefix_ids: List[int] = []
-    if initial_prefix_ids:
-        combined_prefix_ids.extend([int(x) for x in initial_prefix_ids if isinstance(x, int)])
-    combined_prefix_ids.extend([x for x in text_seed_ids if isinstance(x, int)])
-    prefix_ids = _build_initial_prefix(prefix_length, vocab_size, device, combined_prefix_ids)
-    token_mask = _token_mask(tokenizer, vocab_size, device)
-    embed_weights = embed_layer.weight.detach()
-
-    best_prefix: torch.Tensor = prefix_ids.clone()
-    best_loss = float("inf")
-    loss_history: List[float] = []
-
-    for iter_idx in range(iterations):
-        context_ids = torch.cat([prefix_ids, prompt_ids], dim=0)
-        full_ids = torch.cat([context_ids, target_ids], dim=0).unsqueeze(0)
-        attention_mask = torch.ones_like(full_ids, dtype=torch.long)
-
-        inputs_embeds = embed_layer(full_ids).detach()
-        inputs_embeds.requires_grad_(True)
-
-        outputs = model(inputs_embeds=inputs_embeds, attention_mask=attention_mask)
-        logits = outputs.logits
-        shift_logits = logits[:, :-1, :]
-        shift_labels = full_ids[:, 1:]
-
-        start_idx = prefix_length + prompt_ids.size(0)
-        if start_idx <= 0:
-            start_idx = 1
-        target_len = target_ids.size(0)
-        slice_logits = shift_logits[:, start_idx - 1 : start_idx - 1 + target_len, :]
-        slice_labels = shift_labels[:, start_idx - 1 : start_idx - 1 + target_len]
-
-        loss = F.cross_entropy(slice_logits.reshape(-1, slice_logits.size(-1)), slice_labels.reshape(-1), reduction="sum")
-        loss_value = loss.item()
-        loss_history.append(loss_value)
-        if loss_value < best_loss:
-            best_loss = loss_value
-            best_prefix = prefix_ids.clone()
-
-        model.zero_grad()
-        loss.backward()
-
-        grads = inputs_embeds.grad
-        if grads is None:
-            break
-        prefix_grad = grads[0, :prefix_length]
-        if prefix_grad.numel() == 0:
-            break
-        grad_norm = prefix_grad.norm(dim=-1)
-        if grad_norm.numel() == 0:
-            break
-        best_pos = int(torch.argmax(grad_norm).item())
-        direction = -prefix_grad[best_pos]
-        if direction.norm().item() == 0:
-            break
-
-        scores = torch.matmul(embed_weights.to(device), direction)
-        allowed = token_mask.clone()
-        current_id = int(prefix_ids[best_pos].item())
-        if 0 <= current_id < vocab_size:
-            allowed[current_id] = False
-        scores = torch.where(allowed, scores, torch.full_like(scores, float("-inf")))
-
-        next_token = int(torch.argmax(scores).item())
-        prefix_ids[best_pos] = next_token
-
-    final_ids = best_prefix if best_loss < float("inf") else prefix_ids
-    prefix_strings = tokenizer.convert_ids_to_tokens(final_ids.tolist())
-    prefix_text = tokenizer.decode(final_ids.tolist(), skip_special_tokens=True)
 
+def find_adversarial_prefix(
+    model_key: str,
+    input_string: str,
+    target_text: str,
+    prefix_length: int = DEFAULT_PREFIX_LEN,
+    iterations: int = DEFAULT_ITERATIONS,
+    initial_prefix_ids: Optional[Sequence[int]] = None,
+    initial_prefix_text: Optional[str] = None,
+    gradient_checkpointing: bool = False,
+    placement: str = "prefix",
+    search_width: int = DEFAULT_SEARCH_WIDTH,
+    top_k: int = DEFAULT_TOP_K,
+    eval_batch_size: int = 0,
+    seed: Optional[int] = None,
+    token_filter: Sequence[str] = ("special",),
+) -> Dict[str, Any]:
+    """
+    Single-row find_adversarial_prefixes; raises ValueError for an invalid row.
+    Unlike the earlier greedy search, the prompt is the chat-template user turn (not plain
+    tokenization) and loss is the mean target cross-entropy per token (not the sum).
+    """
+    result = find_adversarial_prefixes(
+        model_key,
+        [
+            {
+                "input_string": input_string,
+                "target_text": target_text,
+                "seed_ids": initial_prefix_ids,
+                "seed_text": initial_prefix_text,
+            }
+        ],
+        prefix_length=prefix_length,
+        iterations=iterations,
+        gradient_checkpointing=gradient_checkpointing,
+        placement=placement,
+        search_width=search_width,
+        top_k=top_k,
+        eval_batch_size=eval_batch_size,
+        seed=seed,
+        token_filter=token_filter,
+    )[0]
+    if "error" in result:
+        raise ValueError(result["error"])
+    return result
+
+
+class _DatasetRowStream:
+    """
+    Endless shuffled stream of tokenized (input, target) rows from a HF Dataset. Rows are read
+    and tokenized only when sampled (with a bounded memo), so large datasets are never fully
+    materialized; the order is reshuffled every epoch.
+    """
+
+    _MEMO_LIMIT = 8192
+
+    def __init__(self, ds, tokenizer, input_key: str, target_key: str, placement: str, device, process_fn=None, seed=None):
+        self.ds = ds
+        self.tokenizer = tokenizer
+        self.input_key = input_key
+        self.target_key = target_key
+        self.placement = placement
+        self.device = device
+        self.process_fn = process_fn
+        self.rng = np.random.default_rng(seed)
+        self.order = self.rng.permutation(ds.num_rows)
+        self.cursor = 0
+        self.memo: Dict[int, Optional[Dict[str, torch.Tensor]]] = {}
+
+    def get_state(self) -> Dict[str, Any]:
+        return {"rng": self.rng.bit_generator.state, "order": self.order.copy(), "cursor": self.cursor}
+
+    def set_state(self, state: Dict[str, Any]) -> None:
+        self.rng.bit_generator.state = state["rng"]
+        self.order = np.asarray(state["order"])
+        self.cursor = int(state["cursor"])
+
+    def _next_indices(self, n: int) -> List[int]:
+        out: List[int] = []
+        while len(out) < n:
+            if self.cursor >= len(self.order):
+                self.order = self.rng.permutation(self.ds.num_rows)
+                self.cursor = 0
+            take = self.order[self.cursor : self.cursor + n - len(out)]
+            self.cursor += len(take)
+            out.extend(int(i) for i in take)
+        return out
+
+    def _read(self, indices: List[int]) -> List[Tuple[Any, Any]]:
+        if self.process_fn is None:
+            batch = self.ds[indices]
+            return list(zip(batch.get(self.input_key, [None] * len(indices)), batch.get(self.target_key, [None] * len(indices))))
+        pairs = []
+        for i in indices:
+            row = self.process_fn(dict(self.ds[i])) or {}
+            pairs.append((row.get(self.input_key), row.get(self.target_key)))
+        return pairs
+
+    def _tokenize(self, input_value: Any, target_value: Any) -> Optional[Dict[str, torch.Tensor]]:
+        input_string = str(input_value).strip() if input_value is not None else ""
+        target_text = str(target_value).strip() if target_value is not None else ""
+        if not input_string or not target_text:
+            return None
+        target_ids = self.tokenizer(target_text, return_tensors="pt", add_special_tokens=False)["input_ids"][0]
+        if target_ids.numel() == 0:
+            return None
+        before_ids, after_ids = build_chat_segments(self.tokenizer, input_string, self.placement)
+        return {
+            "before_ids": before_ids.to(self.device),
+            "after_ids": after_ids.to(self.device),
+            "target_ids": target_ids.to(self.device),
+        }
+
+    def __call__(self, n: int) -> List[Dict[str, torch.Tensor]]:
+        """Next n valid rows (fewer only if a whole epoch yields none)."""
+        rows: List[Dict[str, torch.Tensor]] = []
+        attempts = 0
+        while len(rows) < n and attempts < max(self.ds.num_rows, n):
+            indices = self._next_indices(n - len(rows))
+            attempts += len(indices)
+            missing = [i for i in indices if i not in self.memo]
+            if missing:
+                if len(self.memo) + len(missing) > self._MEMO_LIMIT:
+                    self.memo.clear()
+                for i, (inp, tgt) in zip(missing, self._read(missing)):
+                    self.memo[i] = self._tokenize(inp, tgt)
+            rows.extend(self.memo[i] for i in indices if self.memo.get(i) is not None)
+        return rows
+
+
+def find_universal_prefix(
+    model_key: str,
+    ds,
+    input_key: str,
+    target_key: str,
+    process_fn=None,
+    prefix_length: int = DEFAULT_PREFIX_LEN,
+    iterations: int = DEFAULT_ITERATIONS,
+    initial_prefix_ids: Optional[Sequence[int]] = None,
+    initial_prefix_text: Optional[str] = None,
+    gradient_checkpointing: bool = False,
+    placement: str = "prefix",
+    search_width: int = DEFAULT_SEARCH_WIDTH,
+    top_k: int = DEFAULT_TOP_K,
+    batch_rows: int = 8,
+    eval_rows: int = 8,
+    eval_batch_size: int = 0,
+    seed: Optional[int] = None,
+    token_filter: Sequence[str] = ("special",),
+    patience: int = 0,
+    progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+    resume_state: Optional[Dict[str, Any]] = None,
+    checkpoint_every: int = 0,
+    checkpoint_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Dict[str, Any]:
+    """
+    One prefix (or suffix) for every (input_key, target_key) row of a dataset variable
+    (gcg.run_universal_gcg): gradients are aggregated over batch_rows streamed rows and
+    candidates are evaluated on eval_rows sampled rows per iteration; loss is a running EMA.
+    process_fn (the pipeline's process(example)) is applied lazily to sampled rows only.
+    patience, progress_callback, should_stop and the checkpoint arguments behave as in
+    find_adversarial_prefixes; checkpoints also carry the row stream's shuffle position.
+    """
+    tokenizer, model = load_llm(model_key)
+    device = get_model_device(model)
+    model.eval()
+
+    if hasattr(ds, "keys"):
+        ds = ds[list(ds.keys())[0]]
+    if ds.num_rows == 0:
+        raise ValueError("Dataset is empty")
+    if process_fn is None:
+        missing = [k for k in (input_key, target_key) if k not in (ds.column_names or [])]
+        if missing:
+            raise ValueError(f"Columns not found: {', '.join(missing)}")
+
+    prefix_length = max(1, min(prefix_length, MAX_PREFIX_LEN))
+    iterations = max(1, min(iterations, MAX_ITERATIONS))
+    placement = placement if placement in PLACEMENTS else "prefix"
+
+    vocab_size = model.get_input_embeddings().num_embeddings
+    token_filter = parse_token_filters(token_filter)
+    token_mask = allowed_token_mask(tokenizer, vocab_size, device, token_filter)
+    if not bool(token_mask.any()):
+        raise ValueError(f"token_filter {', '.join(token_filter)} leaves no allowed tokens")
+    seeds = _seed_prefix_ids(tokenizer, initial_prefix_ids, initial_prefix_text)
+    prefix_ids = _build_initial_prefix(prefix_length, vocab_size, device, seeds, token_mask)
+
+    stream = _DatasetRowStream(ds, tokenizer, input_key, target_key, placement, device, process_fn, seed)
+    if resume_state is not None and resume_state.get("stream") is not None:
+        stream.set_state(resume_state["stream"])
+    search = run_universal_gcg(
+        model,
+        tokenizer,
+        stream,
+        prefix_ids,
+        token_mask,
+        iterations=iterations,
+        search_width=search_width,
+        top_k=top_k,
+        batch_rows=batch_rows,
+        eval_rows=eval_rows,
+        eval_batch_size=eval_batch_size,
+        gradient_checkpointing=gradient_checkpointing,
+        seed=seed,
+        patience=patience,
+        step_callback=(
+            _progress_step_callback(tokenizer, progress_callback, iterations, [0])
+            if progress_callback is not None
+            else None
+        ),
+        should_stop=should_stop,
+        resume_state=resume_state,
+        checkpoint_every=checkpoint_every,
+        checkpoint_callback=(
+            (lambda state: checkpoint_callback({**state, "stream": stream.get_state()}))
+            if checkpoint_callback is not None
+            else None
+        ),
+    )
+    if search["iterations_run"] == 0 and search["stop_reason"] != "cancelled":
+        raise ValueError(f"No rows with non-empty {input_key!r} and {target_key!r}")
+
+    final_ids = search["update_ids"].tolist()
     return {
         "status": "ok",
-        "input_string": prompt_input,
-        "target_text": target_input,
-        "prefix_ids": final_ids.tolist(),
-        "prefix_tokens": prefix_strings,
-        "prefix_text": prefix_text,
-        "loss": best_loss if best_loss < float("inf") else None,
+        "universal": True,
+        "input_key": input_key,
+        "target_key": target_key,
+        "rows_total": ds.num_rows,
+        "rows_seen": search["rows_seen"],
+        "placement": placement,
+        "prefix_ids": final_ids,
+        "prefix_tokens": tokenizer.convert_ids_to_tokens(final_ids),
+        "prefix_text": tokenizer.decode(final_ids, skip_special_tokens=True),
+        "loss": search["loss"],
         "iterations": iterations,
-        "loss_history": loss_history,
+        "iterations_run": search["iterations_run"],
+        "stop_reason": search["stop_reason"],
+        "loss_history": search["loss_history"],
+        "minibatch_loss_history": search["minibatch_loss_history"],
+        "batch_rows": batch_rows,
+        "eval_rows": eval_rows,
+        "search_width": search_width,
+        "top_k": top_k,
+        "token_filter": list(token_filter),
+        "grad_pass": search["grad_pass"],
     }
@@ -0,0 +1,789 @@
+"""
+Greedy Coordinate Gradient (GCG) engine for adversarial text generation.
+
+Each step:
+  1. One gradient pass gives d loss / d one-hot(update token) = grad(embeds) @ W^T for every
+     update position; the top_k allowed tokens per position are the replacement pool.
+  2. search_width candidates each swap one position for a token sampled from its pool.
+  3. All candidates are scored in one batched forward (chunks of eval_batch_size) with a
+     vectorized per-row cross-entropy on the target; the best candidate becomes the new update.
+
+The fixed context before the update span is identical for every candidate and step, so its
+KV cache is computed once and expanded across each batch; only [update][after][target] runs.
+
+Optionally (soft_prompt_steps > 0) the search starts from a continuous relaxation: the update
+embeddings are optimized directly with Adam for a fixed budget, then each position is projected
+to its nearest allowed vocabulary embedding, which replaces the random initial tokens.
+
+The prompt is tokenized as segments around the optimized span so no span search is needed:
+  [before][update][after][target]
+where before/after come from the chat template rendered around a sentinel. With
+placement="prefix" the update precedes the input string; with "suffix" it follows it.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+from python.xai_1.grad_checkpoint import activation_checkpointing
+from python.xai_1.prefix_cache import compute_prefix_cache, expand_prefix_cache, tail_logits_kwargs
+
+
+DEFAULT_SEARCH_WIDTH = 128
+DEFAULT_TOP_K = 64
+MAX_SEARCH_WIDTH = 1024
+MAX_TOP_K = 1024
+PLACEMENTS = ("prefix", "suffix")
+PREFIX_CACHE_SLOTS = 4  # distinct common prefixes kept by run_universal_gcg
+
+_SENTINEL = "<<PNP_ADV_UPDATE>>"
+
+# id(embedding weight) -> (data_ptr, fp32 squared row norms) for nearest-token projection.
+_embed_sq_norms: Dict[int, Tuple[int, torch.Tensor]] = {}
+
+
+def build_chat_segments(
+    tokenizer,
+    input_string: str,
+    placement: str = "prefix",
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Token ids before and after the optimized span for a single user turn.
+    Renders the chat template around a sentinel (update + " " + input for prefix placement,
+    input + " " + update for suffix) and tokenizes both sides; falls back to plain text with
+    the tokenizer's special tokens when there is no chat template.
+    Returns (before_ids, after_ids), 1-D LongTensors.
+    """
+    content = f"{_SENTINEL} {input_string}" if placement == "prefix" else f"{input_string} {_SENTINEL}"
+    rendered = None
+    if getattr(tokenizer, "apply_chat_template", None):
+        try:
+            rendered = tokenizer.apply_chat_template(
+                [{"role": "user", "content": content}],
+                tokenize=False,
+                add_generation_prompt=True,
+            )
+        except Exception:
+            rendered = None
+    if isinstance(rendered, str) and rendered.count(_SENTINEL) == 1:
+        before_text, after_text = rendered.split(_SENTINEL)
+        before_special = False
+    else:
+        before_text, after_text = content.split(_SENTINEL)
+        before_special = True
+    before_ids = tokenizer(before_text, add_special_tokens=before_special)["input_ids"] if before_text else []
+    if before_special and not before_text and getattr(tokenizer, "bos_token_id", None) is not None:
+        before_ids = [tokenizer.bos_token_id]
+    after_ids = tokenizer(after_text, add_special_tokens=False)["input_ids"] if after_text else []
+    return torch.tensor(before_ids, dtype=torch.long), torch.tensor(after_ids, dtype=torch.long)
+
+
+def _build_layout(
+    rows: List[Dict[str, torch.Tensor]],
+    pad_id: int,
+    device: torch.device,
+    max_common: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Joint batch layout for several rows, each {before_ids, update_ids, after_ids, target_ids}:
+
+        [common][pad][before rest][update][pad][after][target]
+
+    common is the longest before-prefix shared by every row, at most max_common tokens
+    (run once, cached). The first pad
+    block right-aligns the before rests so every update span starts at the same column; the
+    second right-aligns after+target so all targets end at the last column and one tail slice
+    of logits covers every row. Pads have attention mask 0 and positions come from the mask
+    cumsum, so each row sees exactly its unpadded sequence.
+    """
+    befores = [r["before_ids"].tolist() for r in rows]
+    common_len = min(len(b) for b in befores)
+    if max_common is not None:
+        common_len = min(common_len, max_common)
+    for idx in range(common_len):
+        if any(b[idx] != befores[0][idx] for b in befores[1:]):
+            common_len = idx
+            break
+    update_len = rows[0]["update_ids"].numel()
+    lead = max(len(b) - common_len for b in befores)
+    tails = [r["after_ids"].tolist() + r["target_ids"].tolist() for r in rows]
+    trail = max(len(t) for t in tails)
+    target_max = max(r["target_ids"].numel() for r in rows)
+
+    width = lead + update_len + trail
+    rest_ids = torch.full((len(rows), width), pad_id, dtype=torch.long)
+    rest_mask = torch.zeros((len(rows), width), dtype=torch.long)
+    labels = torch.full((len(rows), target_max), -100, dtype=torch.long)
+    for i, (row, before, tail) in enumerate(zip(rows, befores, tails)):
+        rest = before[common_len:]
+        if rest:
+            rest_ids[i, lead - len(rest) : lead] = torch.tensor(rest)
+            rest_mask[i, lead - len(rest) : lead] = 1
+        rest_mask[i, lead : lead + update_len] = 1
+        rest_ids[i, width - len(tail) :] = torch.tensor(tail)
+        rest_mask[i, width - len(tail) :] = 1
+        target = row["target_ids"]
+        labels[i, target_max - target.numel() :] = target
+    return {
+        "common_ids": torch.tensor(befores[0][:common_len], dtype=torch.long, device=device),
+        "rest_ids": rest_ids.to(device),
+        "rest_mask": rest_mask.to(device),
+        "labels": labels.to(device),
+        "update_col": lead,
+        "update_len": update_len,
+        "target_max": target_max,
+    }
+
+
+def _forward_rows(
+    model: torch.nn.Module,
+    layout: Dict[str, Any],
+    row_index: torch.Tensor,
+    rest: torch.Tensor,
+    prefix_cache: Any,
+    embeds: bool = False,
+):
+    """
+    Forward [common][rest] for layout rows row_index (rest: ids, or embeddings when embeds=True).
+    With prefix_cache (KV of the common ids, batch 1) only rest is run, on an expanded copy of
+    the cache; otherwise the common ids are prepended. Only the target logits are kept.
+    """
+    n = rest.shape[0]
+    mask = layout["rest_mask"][row_index]
+    common = layout["common_ids"]
+    n_logits = layout["target_max"] + 1
+    if prefix_cache is not None:
+        full_mask = torch.cat([torch.ones((n, common.numel()), dtype=mask.dtype, device=mask.device), mask], dim=1)
+        position_ids = (full_mask.cumsum(dim=1) - 1).clamp(min=0)[:, common.numel() :]
+        key = "inputs_embeds" if embeds else "input_ids"
+        return model(
+            **{key: rest},
+            attention_mask=full_mask,
+            position_ids=position_ids,
+            past_key_values=expand_prefix_cache(prefix_cache, n),
+            **tail_logits_kwargs(model, n_logits),
+        )
+    if embeds:
+        lead = model.get_input_embeddings()(common).detach().unsqueeze(0).expand(n, -1, -1)
+    else:
+        lead = common.unsqueeze(0).expand(n, -1)
+    full = torch.cat([lead, rest], dim=1)
+    full_mask = torch.cat([torch.ones((n, common.numel()), dtype=mask.dtype, device=mask.device), mask], dim=1)
+    return model(
+        **{"inputs_embeds" if embeds else "input_ids": full},
+        attention_mask=full_mask,
+        position_ids=(full_mask.cumsum(dim=1) - 1).clamp(min=0),
+        use_cache=False,
+        **tail_logits_kwargs(model, n_logits),
+    )
+
+
+def _row_losses(logits: torch.Tensor, labels: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Per-row mean target cross-entropy from tail logits (n, target_max + 1, V) and right-aligned
+    labels (n, target_max; -100 = not a target position).
+    Returns (losses (n,), greedy_reached (n,) bool: argmax reproduces the whole target).
+    """
+    logits = logits[:, :-1].float()
+    valid = labels != -100
+    ce = F.cross_entropy(logits.transpose(1, 2), labels, ignore_index=-100, reduction="none")
+    losses = ce.sum(dim=1) / valid.sum(dim=1).clamp(min=1)
+    reached = ((logits.argmax(dim=-1) == labels) | ~valid).all(dim=1)
+    return losses, reached
+
+
+def _candidate_losses(
+    model: torch.nn.Module,
+    layout: Dict[str, Any],
+    cand_rows: torch.Tensor,
+    candidates: torch.Tensor,
+    eval_batch_size: int = 0,
+    prefix_cache: Any = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Target losses for candidate update spans (C, L) belonging to layout rows cand_rows (C,),
+    scored across all rows together in chunks of eval_batch_size (0 = one forward).
+    """
+    col, length = layout["update_col"], layout["update_len"]
+    chunk = int(eval_batch_size) if eval_batch_size and int(eval_batch_size) > 0 else candidates.shape[0]
+    losses: List[torch.Tensor] = []
+    reached: List[torch.Tensor] = []
+    with torch.no_grad():
+        for start in range(0, candidates.shape[0], chunk):
+            rows = cand_rows[start : start + chunk]
+            ids = layout["rest_ids"][rows].clone()
+            ids[:, col : col + length] = candidates[start : start + chunk]
+            out = _forward_rows(model, layout, rows, ids, prefix_cache)
+            row_loss, row_reached = _row_losses(out.logits, layout["labels"][rows].to(out.logits.device))
+            losses.append(row_loss)
+            reached.append(row_reached)
+    return torch.cat(losses), torch.cat(reached)
+
+
+def _token_gradients(
+    model: torch.nn.Module,
+    layout: Dict[str, Any],
+    rows: torch.Tensor,
+    update_ids: torch.Tensor,
+    prefix_cache: Any = None,
+) -> torch.Tensor:
+    """
+    Gradient of each row's mean target cross-entropy w.r.t. its one-hot update tokens,
+    (R, L, V): d loss / d embeds(update) @ W^T, so no one-hot matmul through the embedding
+    is needed. Rows do not interact, so one backward of the summed losses serves all rows.
+    The common segment carries no gradient, so it may come from prefix_cache.
+    """
+    embed_layer = model.get_input_embeddings()
+    col, length = layout["update_col"], layout["update_len"]
+    embeds = embed_layer(layout["rest_ids"][rows]).detach()
+    update_embeds = embed_layer(update_ids).detach().requires_grad_(True)
+    rest = torch.cat([embeds[:, :col], update_embeds, embeds[:, col + length :]], dim=1)
+    out = _forward_rows(model, layout, rows, rest, prefix_cache, embeds=True)
+    losses, _ = _row_losses(out.logits, layout["labels"][rows].to(out.logits.device))
+    (grad,) = torch.autograd.grad(losses.sum(), update_embeds)
+    weight = embed_layer.weight.detach()
+    return grad.to(weight.dtype) @ weight.T
+
+
+def _embedding_sq_norms(weight: torch.Tensor, chunk: int = 8192) -> torch.Tensor:
+    """||w||^2 per vocabulary row (fp32), computed in chunks once per embedding matrix."""
+    cached = _embed_sq_norms.get(id(weight))
+    if cached is not None and cached[0] == weight.data_ptr():
+        return cached[1]
+    norms = torch.cat([weight[i : i + chunk].float().pow(2).sum(dim=1) for i in range(0, weight.shape[0], chunk)])
+    _embed_sq_norms[id(weight)] = (weight.data_ptr(), norms)
+    return norms
+
+
+def _project_to_tokens(soft: torch.Tensor, weight: torch.Tensor, allowed: torch.Tensor) -> torch.Tensor:
+    """
+    Nearest allowed token per soft embedding (..., D) -> ids (...): argmin ||w||^2 - 2 s.w,
+    one matmul against the embedding matrix (||s||^2 is constant per position).
+    """
+    flat = soft.reshape(-1, soft.shape[-1]).to(weight.dtype)
+    dist = _embedding_sq_norms(weight).unsqueeze(0) - 2.0 * (flat @ weight.T).float()
+    dist = dist.masked_fill(~allowed.view(1, -1), float("inf"))
+    return dist.argmin(dim=1).view(soft.shape[:-1])
+
+
+def _soft_prompt_init(
+    model: torch.nn.Module,
+    layout: Dict[str, Any],
+    rows: torch.Tensor,
+    update_ids: torch.Tensor,
+    allowed: torch.Tensor,
+    steps: int,
+    lr: float,
+    prefix_cache: Any = None,
+) -> Tuple[torch.Tensor, Dict[str, Any]]:
+    """
+    Optimize the update embeddings of layout rows (R, L) as free continuous vectors with Adam
+    for steps iterations, then project them to the nearest allowed tokens. lr is relative to
+    the RMS of the embedding matrix entries, so one setting fits every model.
+    Returns (projected ids (R, L), {steps, lr, loss_history (mean soft loss per step)}).
+    """
+    embed_layer = model.get_input_embeddings()
+    weight = embed_layer.weight.detach()
+    col, length = layout["update_col"], layout["update_len"]
+    base = embed_layer(layout["rest_ids"][rows]).detach()
+    rms = float((_embedding_sq_norms(weight).mean() / weight.shape[1]).sqrt().item())
+    soft = embed_layer(update_ids).detach().float().clone().requires_grad_(True)
+    optimizer = torch.optim.Adam([soft], lr=lr * rms)
+    history: List[float] = []
+    for _ in range(max(0, int(steps))):
+        rest = torch.cat([base[:, :col], soft.to(base.dtype), base[:, col + length :]], dim=1)
+        out = _forward_rows(model, layout, rows, rest, prefix_cache, embeds=True)
+        losses, _ = _row_losses(out.logits, layout["labels"][rows].to(out.logits.device))
+        (grad,) = torch.autograd.grad(losses.sum(), soft)
+        optimizer.zero_grad(set_to_none=True)
+        soft.grad = grad
+        optimizer.step()
+        history.append(float(losses.mean().item()))
+    with torch.no_grad():
+        projected = _project_to_tokens(soft.detach(), weight, allowed)
+    return projected.to(update_ids.device), {"steps": len(history), "lr": lr, "loss_history": history}
+
+
+def _sample_candidates(
+    update_ids: torch.Tensor,
+    top_ids: torch.Tensor,
+    search_width: int,
+    generator: torch.Generator,
+) -> torch.Tensor:
+    """
+    search_width single-token swaps per row, (R, W, L): positions are spread evenly over the
+    update span (with a random offset per row and step), tokens drawn uniformly from each
+    position's top_k pool.
+    """
+    n_rows, length, k = top_ids.shape
+    offsets = torch.randint(0, length, (n_rows, 1), generator=generator)
+    positions = (torch.arange(search_width).unsqueeze(0) * length // search_width + offsets) % length
+    picks = torch.randint(0, k, (n_rows, search_width), generator=generator)
+    tokens = top_ids.cpu()[torch.arange(n_rows).unsqueeze(1), positions, picks]
+    candidates = update_ids.cpu().unsqueeze(1).repeat(1, search_width, 1)
+    candidates.scatter_(2, positions.unsqueeze(2), tokens.unsqueeze(2))
+    return candidates
+
+
+def _retokenizes(tokenizer, candidates: torch.Tensor) -> torch.Tensor:
+    """Rows whose decoded text encodes back to the same ids (so prefix_text is faithful)."""
+    texts = tokenizer.batch_decode(candidates.tolist())
+    encoded = tokenizer(texts, add_special_tokens=False)["input_ids"]
+    rows = candidates.tolist()
+    return torch.tensor([enc == row for enc, row in zip(encoded, rows)], dtype=torch.bool)
+
+
+def run_gcg(
+    model: torch.nn.Module,
+    tokenizer,
+    rows: List[Dict[str, torch.Tensor]],
+    allowed: torch.Tensor,
+    iterations: int,
+    search_width: int = DEFAULT_SEARCH_WIDTH,
+    top_k: int = DEFAULT_TOP_K,
+    eval_batch_size: int = 0,
+    gradient_checkpointing: bool = False,
+    filter_retokenization: bool = True,
+    seed: Optional[int] = None,
+    reuse_prefix_cache: bool = True,
+    early_stop: bool = True,
+    patience: int = 0,
+    min_delta: float = 1e-3,
+    step_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+    resume_state: Optional[Dict[str, Any]] = None,
+    checkpoint_every: int = 0,
+    checkpoint_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+    soft_prompt_steps: int = 0,
+    soft_prompt_lr: float = 0.1,
+) -> List[Dict[str, Any]]:
+    """
+    Optimize each row's update_ids (1-D, same length for every row) so that
+    [before][update][after] makes the model emit the row's target_ids. Rows are optimized
+    jointly: one batched gradient pass over the active rows and one batched candidate
+    evaluation (search_width candidates per row) per step.
+    allowed is a (V,) bool mask of tokens the search may use.
+    reuse_prefix_cache=True computes the KV of the before-prefix shared by all rows once and
+    expands it across every batch (the gradient pass too, unless gradient checkpointing is on:
+    checkpointed layers re-run their forward and would append to the cache twice).
+    early_stop=True freezes a row as soon as greedy decoding reproduces its target.
+    patience > 0 also freezes a row once its best loss has not improved by min_delta for
+    patience steps. should_stop() is polled before every step (cancellation);
+    step_callback(state) is called after every step with
+    {iteration, best_ids (R, L), best_loss, step_loss, target_reached, active}.
+    checkpoint_callback(state) receives the full search state (CPU tensors, generator state)
+    every checkpoint_every steps and once at the end; passing that state back as resume_state
+    continues the search exactly where it stopped (iterations counts the total, not the rest).
+    soft_prompt_steps > 0 replaces the initial update_ids of a fresh search with the projection
+    of soft_prompt_steps Adam steps on continuous update embeddings (_soft_prompt_init).
+
+    Returns one dict per row:
+        update_ids (best), loss (best mean target CE), initial_loss, loss_history (per step),
+        target_reached, iterations_to_target (step the target was first reproduced, 0 = at
+        start, None = never), iterations_run, stop_reason (target_reached / plateau /
+        cancelled / iterations), prefix_cache_tokens, soft_prompt (report or None),
+        grad_pass (shared timing / peak memory).
+    """
+    device = rows[0]["update_ids"].device
+    allowed = allowed.to(device)
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    layout = _build_layout(rows, pad_id if pad_id is not None else 0, device)
+    n_rows = len(rows)
+    generator = torch.Generator()
+    generator.manual_seed(int(seed) if seed is not None else int(torch.randint(0, 2**62, (1,)).item()))
+
+    search_width = max(1, min(int(search_width), MAX_SEARCH_WIDTH))
+    top_k = max(1, min(int(top_k), MAX_TOP_K, int(allowed.sum().item())))
+
+    prefix_cache = None
+    if reuse_prefix_cache and layout["common_ids"].numel() > 0:
+        prefix_cache = compute_prefix_cache(model, layout["common_ids"].unsqueeze(0))
+    grad_cache = None if gradient_checkpointing else prefix_cache
+
+    grad_pass: Dict[str, Any] = {
+        "gradient_checkpointing": False,
+        "peak_memory_gb": None,
+        "grad_pass_seconds": 0.0,
+        "forward_seconds": 0.0,
+        "recompute_seconds_approx": 0.0,
+    }
+
+    def add_grad_report(report: Dict[str, Any]) -> None:
+        for key in ("grad_pass_seconds", "forward_seconds", "recompute_seconds_approx"):
+            grad_pass[key] = round(grad_pass[key] + report.get(key, 0.0), 4)
+        grad_pass["gradient_checkpointing"] = report["gradient_checkpointing"]
+        if report.get("peak_memory_gb") is not None:
+            grad_pass["peak_memory_gb"] = max(grad_pass["peak_memory_gb"] or 0.0, report["peak_memory_gb"])
+
+    start = 0
+    soft_report: Optional[Dict[str, Any]] = None
+    if resume_state is not None:
+        current = resume_state["current_ids"].to(device).clone()
+        if tuple(current.shape) != (n_rows, layout["update_len"]):
+            raise ValueError("checkpoint does not match these rows")
+        best_ids = resume_state["best_ids"].to(device).clone()
+        best_loss = [float(x) for x in resume_state["best_loss"]]
+        target_reached = [bool(x) for x in resume_state["target_reached"]]
+        loss_history = [list(h) for h in resume_state["loss_history"]]
+        iterations_run = [int(x) for x in resume_state["iterations_run"]]
+        stale = [int(x) for x in resume_state["stale"]]
+        stop_reason = [r if r in ("target_reached", "plateau") else "iterations" for r in resume_state["stop_reason"]]
+        initial_loss = list(resume_state.get("initial_loss") or best_loss)
+        reached_at = list(resume_state.get("iterations_to_target") or [None] * n_rows)
+        generator.set_state(resume_state["rng_state"])
+        start = int(resume_state["step"])
+    else:
+        all_rows = torch.arange(n_rows, device=device)
+        current = torch.stack([r["update_ids"].to(device) for r in rows])
+        if soft_prompt_steps > 0:
+            with activation_checkpointing(model, gradient_checkpointing) as report:
+                current, soft_report = _soft_prompt_init(
+                    model, layout, all_rows, current, allowed, soft_prompt_steps, soft_prompt_lr, grad_cache
+                )
+            add_grad_report(report)
+            soft_report["seconds"] = report["grad_pass_seconds"]
+        loss0, reached0 = _candidate_losses(model, layout, all_rows, current, prefix_cache=prefix_cache)
+        best_ids = current.clone()
+        best_loss = loss0.tolist()
+        initial_loss = list(best_loss)
+        target_reached = reached0.tolist()
+        reached_at = [0 if r else None for r in target_reached]
+        loss_history = [[] for _ in range(n_rows)]
+        iterations_run = [0] * n_rows
+        stale = [0] * n_rows
+        stop_reason = ["target_reached" if early_stop and target_reached[i] else "iterations" for i in range(n_rows)]
+    active = [i for i in range(n_rows) if stop_reason[i] == "iterations"]
+    steps_done = start
+
+    def checkpoint() -> None:
+        checkpoint_callback(
+            {
+                "step": steps_done,
+                "current_ids": current.cpu().clone(),
+                "best_ids": best_ids.cpu().clone(),
+                "best_loss": list(best_loss),
+                "target_reached": list(target_reached),
+                "loss_history": [list(h) for h in loss_history],
+                "iterations_run": list(iterations_run),
+                "stale": list(stale),
+                "stop_reason": list(stop_reason),
+                "initial_loss": list(initial_loss),
+                "iterations_to_target": list(reached_at),
+                "rng_state": generator.get_state(),
+            }
+        )
+
+    for step in range(start, max(0, int(iterations))):
+        if not active:
+            break
+        if should_stop is not None and should_stop():
+            for row in active:
+                stop_reason[row] = "cancelled"
+            break
+        act = torch.tensor(active, device=device)
+        with activation_checkpointing(model, gradient_checkpointing) as report:
+            token_grads = _token_gradients(model, layout, act, current[act], grad_cache)
+        add_grad_report(report)
+
+        scores = (-token_grads).masked_fill(~allowed.view(1, 1, -1), float("-inf"))
+        top_ids = scores.topk(top_k, dim=2).indices
+        sampled = _sample_candidates(current[act], top_ids, search_width, generator)
+
+        per_row: List[torch.Tensor] = []
+        for j in range(len(active)):
+            cands = torch.unique(sampled[j], dim=0)
+            if filter_retokenization:
+                keep = _retokenizes(tokenizer, cands)
+                if keep.any():
+                    cands = cands[keep]
+            per_row.append(cands)
+        cand_rows = torch.cat(
+            [torch.full((c.shape[0],), active[j], dtype=torch.long) for j, c in enumerate(per_row)]
+        ).to(device)
+        candidates = torch.cat(per_row).to(device)
+
+        losses, reached = _candidate_losses(model, layout, cand_rows, candidates, eval_batch_size, prefix_cache)
+        offset = 0
+        still_active: List[int] = []
+        for j, row in enumerate(active):
+            n = per_row[j].shape[0]
+            pick = offset + int(losses[offset : offset + n].argmin().item())
+            offset += n
+            current[row] = candidates[pick]
+            step_loss = float(losses[pick].item())
+            loss_history[row].append(step_loss)
+            iterations_run[row] += 1
+            row_reached = bool(reached[pick].item())
+            if row_reached and reached_at[row] is None:
+                reached_at[row] = iterations_run[row]
+            stale[row] = 0 if step_loss < best_loss[row] - min_delta else stale[row] + 1
+            # Once the best reproduces the target, only a candidate that also does may replace it
+            if (row_reached and not target_reached[row]) or (
+                step_loss < best_loss[row] and (row_reached or not target_reached[row])
+            ):
+                best_loss[row] = step_loss
+                best_ids[row] = candidates[pick]
+                target_reached[row] = row_reached
+            if early_stop and target_reached[row]:
+                stop_reason[row] = "target_reached"
+            elif patience > 0 and stale[row] >= patience:
+                stop_reason[row] = "plateau"
+            else:
+                still_active.append(row)
+        active = still_active
+        steps_done = step + 1
+        if checkpoint_callback is not None and checkpoint_every > 0 and (steps_done - start) % checkpoint_every == 0:
+            checkpoint()
+        if step_callback is not None:
+            step_callback(
+                {
+                    "iteration": step + 1,
+                    "best_ids": best_ids,
+                    "best_loss": list(best_loss),
+                    "step_loss": [h[-1] if h else None for h in loss_history],
+                    "target_reached": list(target_reached),
+                    "active": list(active),
+                }
+            )
+
+    if checkpoint_callback is not None:
+        checkpoint()
+    cache_tokens = layout["common_ids"].numel() if prefix_cache is not None else 0
+    return [
+        {
+            "update_ids": best_ids[i],
+            "loss": best_loss[i],
+            "initial_loss": initial_loss[i],
+            "loss_history": loss_history[i],
+            "target_reached": target_reached[i],
+            "iterations_to_target": reached_at[i],
+            "iterations_run": iterations_run[i],
+            "stop_reason": stop_reason[i],
+            "prefix_cache_tokens": cache_tokens,
+            "soft_prompt": soft_report,
+            "grad_pass": grad_pass,
+        }
+        for i in range(n_rows)
+    ]
+
+
+def run_universal_gcg(
+    model: torch.nn.Module,
+    tokenizer,
+    sample_rows: Callable[[int], List[Dict[str, torch.Tensor]]],
+    update_ids: torch.Tensor,
+    allowed: torch.Tensor,
+    iterations: int,
+    search_width: int = DEFAULT_SEARCH_WIDTH,
+    top_k: int = DEFAULT_TOP_K,
+    batch_rows: int = 8,
+    eval_rows: int = 8,
+    eval_batch_size: int = 0,
+    gradient_checkpointing: bool = False,
+    filter_retokenization: bool = True,
+    seed: Optional[int] = None,
+    ema_decay: float = 0.9,
+    reuse_prefix_cache: bool = True,
+    patience: int = 0,
+    min_delta: float = 1e-3,
+    step_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+    resume_state: Optional[Dict[str, Any]] = None,
+    checkpoint_every: int = 0,
+    checkpoint_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Dict[str, Any]:
+    """
+    One update span shared by every row of a (possibly large) dataset. Rows are never
+    processed all at once: sample_rows(n) streams the next n tokenized rows
+    ({before_ids, after_ids, target_ids}) and each step
+      1. sums the per-row gradients (each normalized to unit norm) over batch_rows rows,
+      2. samples search_width candidates from the summed top_k pools (plus the current span),
+      3. scores every candidate on a fresh minibatch of eval_rows rows (candidates x rows in
+         chunks of eval_batch_size) and keeps the one with the lowest mean loss.
+    The reported loss is an EMA (ema_decay) of the kept candidate's minibatch loss; the best
+    span is the one with the lowest EMA. patience / min_delta / should_stop / step_callback and
+    resume_state / checkpoint_every / checkpoint_callback behave as in run_gcg (plateau is
+    judged on the EMA; the callback state holds a single row). The row stream's own position
+    is not part of the state; the caller checkpoints it alongside.
+
+    Returns:
+        update_ids (best), loss (best EMA), loss_history (EMA per step),
+        minibatch_loss_history, rows_seen, iterations_run, stop_reason, grad_pass.
+    """
+    device = update_ids.device
+    allowed = allowed.to(device)
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    pad_id = pad_id if pad_id is not None else 0
+    generator = torch.Generator()
+    generator.manual_seed(int(seed) if seed is not None else int(torch.randint(0, 2**62, (1,)).item()))
+
+    search_width = max(1, min(int(search_width), MAX_SEARCH_WIDTH))
+    top_k = max(1, min(int(top_k), MAX_TOP_K, int(allowed.sum().item())))
+    batch_rows = max(1, int(batch_rows))
+    eval_rows = max(1, int(eval_rows))
+    # Prefix KV caches keyed by their ids, oldest first. A minibatch reuses the longest cached
+    # prefix of its own common prefix, so minibatches whose rows happen to share a few more
+    # tokens (suffix placement) do not evict and recompute the shared chat-template prefix.
+    caches: Dict[Tuple[int, ...], Any] = {}
+
+    def layout_for(rows: List[Dict[str, torch.Tensor]], span: torch.Tensor):
+        rows = [{**r, "update_ids": span} for r in rows]
+        layout = _build_layout(rows, pad_id, device)
+        key = tuple(layout["common_ids"].tolist())
+        if not reuse_prefix_cache or not key:
+            return layout, None
+        hit = max((k for k in caches if key[: len(k)] == k), key=len, default=None)
+        if hit is None:
+            caches[key] = compute_prefix_cache(model, layout["common_ids"].unsqueeze(0))
+            while len(caches) > PREFIX_CACHE_SLOTS:
+                caches.pop(next(iter(caches)))
+            return layout, caches[key]
+        if len(hit) < len(key):
+            layout = _build_layout(rows, pad_id, device, max_common=len(hit))
+        return layout, caches[hit]
+
+    current = update_ids.clone()
+    best_ids = current.clone()
+    best_loss = float("inf")
+    ema: Optional[float] = None
+    loss_history: List[float] = []
+    minibatch_history: List[float] = []
+    rows_seen = 0
+    iterations_run = 0
+    stale = 0
+    stop_reason = "iterations"
+    start = 0
+    if resume_state is not None:
+        current = resume_state["current_ids"].to(device).clone()
+        if current.shape != update_ids.shape:
+            raise ValueError("checkpoint does not match this prefix length")
+        best_ids = resume_state["best_ids"].to(device).clone()
+        best_loss = float(resume_state["best_loss"])
+        ema = resume_state["ema"]
+        loss_history = list(resume_state["loss_history"])
+        minibatch_history = list(resume_state["minibatch_loss_history"])
+        rows_seen = int(resume_state["rows_seen"])
+        iterations_run = int(resume_state["iterations_run"])
+        stale = int(resume_state["stale"])
+        generator.set_state(resume_state["rng_state"])
+        start = int(resume_state["step"])
+    steps_done = start
+
+    def checkpoint() -> None:
+        checkpoint_callback(
+            {
+                "step": steps_done,
+                "current_ids": current.cpu().clone(),
+                "best_ids": best_ids.cpu().clone(),
+                "best_loss": best_loss,
+                "ema": ema,
+                "loss_history": list(loss_history),
+                "minibatch_loss_history": list(minibatch_history),
+                "rows_seen": rows_seen,
+                "iterations_run": iterations_run,
+                "stale": stale,
+                "stop_reason": stop_reason,
+                "rng_state": generator.get_state(),
+            }
+        )
+    grad_pass: Dict[str, Any] = {
+        "gradient_checkpointing": False,
+        "peak_memory_gb": None,
+        "grad_pass_seconds": 0.0,
+        "forward_seconds": 0.0,
+        "recompute_seconds_approx": 0.0,
+    }
+
+    for step in range(start, max(0, int(iterations))):
+        if should_stop is not None and should_stop():
+            stop_reason = "cancelled"
+            break
+        grad_rows = sample_rows(batch_rows)
+        check_rows = sample_rows(eval_rows)
+        if not grad_rows or not check_rows:
+            break
+        rows_seen += len(grad_rows) + len(check_rows)
+
+        layout, cache = layout_for(grad_rows, current)
+        n = len(grad_rows)
+        with activation_checkpointing(model, gradient_checkpointing) as report:
+            token_grads = _token_gradients(
+                model,
+                layout,
+                torch.arange(n, device=device),
+                current.unsqueeze(0).expand(n, -1),
+                None if gradient_checkpointing else cache,
+            )
+        for key in ("grad_pass_seconds", "forward_seconds", "recompute_seconds_approx"):
+            grad_pass[key] = round(grad_pass[key] + report.get(key, 0.0), 4)
+        grad_pass["gradient_checkpointing"] = report["gradient_checkpointing"]
+        if report.get("peak_memory_gb") is not None:
+            grad_pass["peak_memory_gb"] = max(grad_pass["peak_memory_gb"] or 0.0, report["peak_memory_gb"])
+
+        norms = token_grads.float().flatten(1).norm(dim=1).clamp(min=1e-12).view(-1, 1, 1)
+        summed = (token_grads.float() / norms).sum(dim=0)
+        scores = (-summed).masked_fill(~allowed.unsqueeze(0), float("-inf"))
+        top_ids = scores.topk(top_k, dim=1).indices
+        sampled = _sample_candidates(current.unsqueeze(0), top_ids.unsqueeze(0), search_width, generator)[0]
+        candidates = torch.unique(sampled, dim=0)
+        if filter_retokenization:
+            keep = _retokenizes(tokenizer, candidates)
+            if keep.any():
+                candidates = candidates[keep]
+        candidates = torch.cat([current.cpu().unsqueeze(0), candidates]).to(device)
+
+        layout, cache = layout_for(check_rows, current)
+        m = len(check_rows)
+        losses, _ = _candidate_losses(
+            model,
+            layout,
+            torch.arange(m, device=device).repeat(candidates.shape[0]),
+            candidates.repeat_interleave(m, dim=0),
+            eval_batch_size,
+            cache,
+        )
+        mean_losses = losses.view(candidates.shape[0], m).mean(dim=1)
+        pick = int(mean_losses.argmin().item())
+        current = candidates[pick].clone()
+        step_loss = float(mean_losses[pick].item())
+        ema = step_loss if ema is None else ema_decay * ema + (1.0 - ema_decay) * step_loss
+        minibatch_history.append(step_loss)
+        loss_history.append(ema)
+        iterations_run += 1
+        stale = 0 if ema < best_loss - min_delta else stale + 1
+        if ema < best_loss:
+            best_loss = ema
+            best_ids = current.clone()
+        steps_done = step + 1
+        if checkpoint_callback is not None and checkpoint_every > 0 and (steps_done - start) % checkpoint_every == 0:
+            checkpoint()
+        if step_callback is not None:
+            step_callback(
+                {
+                    "iteration": step + 1,
+                    "best_ids": best_ids.unsqueeze(0),
+                    "best_loss": [best_loss],
+                    "step_loss": [step_loss],
+                    "target_reached": [False],
+                    "active": [0],
+                }
+            )
+        if patience > 0 and stale >= patience:
+            stop_reason = "plateau"
+            break
+
+    if checkpoint_callback is not None:
+        checkpoint()
+    return {
+        "update_ids": best_ids,
+        "loss": best_loss if best_loss < float("inf") else None,
+        "loss_history": loss_history,
+        "minibatch_loss_history": minibatch_history,
+        "rows_seen": rows_seen,
+        "iterations_run": iterations_run,
+        "stop_reason": stop_reason,
+        "grad_pass": grad_pass,
+    }
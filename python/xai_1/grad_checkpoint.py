@@ -0,0 +1,122 @@
+"""
+Opt-in activation checkpointing for gradient passes (attribution, adversarial search).
+
+Large prompts on 7B-32B models run out of memory in backward because every layer's
+activations are kept. activation_checkpointing() turns on HF gradient checkpointing only
+for the duration of a gradient pass and restores the model afterwards, so generation and
+other forward-only tasks keep using the KV cache.
+
+The context yields a report dict filled on exit:
+  gradient_checkpointing, peak_memory_gb (peak summed over all CUDA devices), grad_pass_seconds,
+  forward_seconds (the model's own forward), recompute_seconds_approx.
+recompute_seconds_approx is an approximation, not a measurement of backward: it is the time
+the checkpointed layers took in the forward pass, which backward re-runs (PyTorch's
+non-reentrant checkpoint may stop a recomputation early, so it is an upper bound). 0 when off.
+"""
+
+from __future__ import annotations
+
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Tuple
+
+import torch
+
+
+def _cuda_sync() -> None:
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def _enable(model: torch.nn.Module) -> List[Tuple[torch.nn.Module, bool]]:
+    """
+    Enable HF gradient checkpointing. HF only checkpoints in training mode, so the training
+    flag is set on the checkpointing-aware modules only (dropout etc. stay in eval mode).
+    Returns [(module, previous_training_flag)] for restore.
+    """
+    if not getattr(model, "supports_gradient_checkpointing", False):
+        return []
+    try:
+        model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+    except TypeError:
+        model.gradient_checkpointing_enable()
+    flagged = [m for m in model.modules() if getattr(m, "gradient_checkpointing", False) is True]
+    previous = [(m, m.training) for m in flagged]
+    for m in flagged:
+        m.training = True
+    return previous
+
+
+def _checkpointed_layers(previous: List[Tuple[torch.nn.Module, bool]]) -> List[torch.nn.Module]:
+    """Layers of the ModuleLists under the checkpointing-aware modules (the ones re-run in backward)."""
+    layers: List[torch.nn.Module] = []
+    for m, _ in previous:
+        for child in m.children():
+            if isinstance(child, torch.nn.ModuleList):
+                layers.extend(child)
+    return layers
+
+
+def _disable(model: torch.nn.Module, previous: List[Tuple[torch.nn.Module, bool]]) -> None:
+    for m, was_training in previous:
+        m.training = was_training
+    if previous and hasattr(model, "gradient_checkpointing_disable"):
+        model.gradient_checkpointing_disable()
+
+
+@contextmanager
+def activation_checkpointing(model: torch.nn.Module, enabled: bool = False) -> Iterator[Dict[str, Any]]:
+    """Run a gradient pass with optional activation checkpointing; yields the report dict."""
+    report: Dict[str, Any] = {"gradient_checkpointing": False}
+    forward_time = {"seconds": 0.0, "start": 0.0}
+    layer_time = {"seconds": 0.0, "start": 0.0, "active": False}
+
+    def pre_hook(_mod, _args):
+        _cuda_sync()
+        forward_time["start"] = time.perf_counter()
+        layer_time["active"] = True
+
+    def post_hook(_mod, _args, _out):
+        _cuda_sync()
+        forward_time["seconds"] += time.perf_counter() - forward_time["start"]
+        layer_time["active"] = False
+
+    # Checkpointed layers' share of the model's forward (recomputation hooks are ignored)
+    def layer_pre_hook(_mod, _args):
+        if layer_time["active"]:
+            _cuda_sync()
+            layer_time["start"] = time.perf_counter()
+
+    def layer_post_hook(_mod, _args, _out):
+        if layer_time["active"]:
+            _cuda_sync()
+            layer_time["seconds"] += time.perf_counter() - layer_time["start"]
+
+    handles = [model.register_forward_pre_hook(pre_hook), model.register_forward_hook(post_hook)]
+    if torch.cuda.is_available():
+        for i in range(torch.cuda.device_count()):
+            torch.cuda.reset_peak_memory_stats(i)
+    previous = _enable(model) if enabled else []
+    report["gradient_checkpointing"] = bool(previous)
+    for layer in _checkpointed_layers(previous):
+        handles.append(layer.register_forward_pre_hook(layer_pre_hook))
+        handles.append(layer.register_forward_hook(layer_post_hook))
+    _cuda_sync()
+    started = time.perf_counter()
+    try:
+        yield report
+    finally:
+        _cuda_sync()
+        elapsed = time.perf_counter() - started
+        _disable(model, previous)
+        for h in handles:
+            h.remove()
+        peak_gb = None
+        if torch.cuda.is_available():
+            peak_gb = sum(
+                torch.cuda.max_memory_allocated(i) for i in range(torch.cuda.device_count())
+            ) / (1024**3)
+        report["peak_memory_gb"] = round(peak_gb, 3) if peak_gb is not None else None
+        report["grad_pass_seconds"] = round(elapsed, 4)
+        report["forward_seconds"] = round(forward_time["seconds"], 4)
+        report["recompute_seconds_approx"] = round(layer_time["seconds"], 4)
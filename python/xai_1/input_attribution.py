@@ -2,6 +2,9 @@
 Input attribution for response: which input tokens contributed to the generated output.
 Uses Chat Template (system + user). Attribution is over all input tokens before generation
 (system instruction + input string). input_grad: gradient of output w.r.t. input embeddings, abs, normalize.
+attention_rollout / attention_value_norm: forward-only, from the returned attention weights.
+occlusion: forward-only, log-likelihood drop when input spans are masked or deleted.
+contrastive_grad: gradient of log p(positive) - log p(negative) for two given responses.
 """
 
 from typing import Any, Dict, List, Tuple
@@ -11,8 +14,12 @@ import torch.nn.functional as F
 
 from python.model_load import get_model_device, load_llm
 from python.model_generation import chat_completion, _simple_chat_prompt_to_ids
+from python.xai_1.grad_checkpoint import activation_checkpointing
+from python.xai_1.prefix_cache import expand_prefix_cache, tail_logits_kwargs
 
 
+OCCLUSION_BATCH_SIZE = 8  # spans per occlusion forward when batch_size is 0
+
 def _messages_to_input_ids(tokenizer, messages: List[Dict[str, str]]):
     """Same tokenization as chat_completion: apply_chat_template or fallback."""
     if getattr(tokenizer, "apply_chat_template", None):
@@ -30,6 +37,45 @@ def _messages_to_input_ids(tokenizer, messages: List[Dict[str, str]]):
     return input_ids
 
 
+def _generate_output_ids(
+    model,
+    tokenizer,
+    input_ids: torch.Tensor,
+    temperature: float,
+    max_new_tokens: int,
+    top_p: float,
+    top_k: int,
+) -> torch.Tensor:
+    """Generate a response for input_ids (1, prompt_len). Returns only the new ids, shape (1, gen_len)."""
+    do_sample = temperature > 0
+    gen_kw: Dict[str, Any] = {
+        "max_new_tokens": max_new_tokens,
+        "pad_token_id": tokenizer.eos_token_id,
+        "eos_token_id": tokenizer.eos_token_id,
+        "do_sample": do_sample,
+    }
+    if do_sample:
+        gen_kw["temperature"] = temperature
+        if top_p < 1.0:
+            gen_kw["top_p"] = top_p
+        if top_k > 0:
+            gen_kw["top_k"] = top_k
+
+    with torch.no_grad():
+        out = model.generate(input_ids, **gen_kw)
+    return out[0][input_ids.shape[1]:].unsqueeze(0)
+
+
+def _normalize_scores(importance: torch.Tensor) -> List[float]:
+    """Min-max normalize a 1-D importance tensor to [0, 1] (all zeros when constant)."""
+    importance = importance.detach().cpu().float()
+    min_val = importance.min().item()
+    max_val = importance.max().item()
+    if max_val > min_val:
+        return ((importance - min_val) / (max_val - min_val)).tolist()
+    return [0.0] * importance.shape[0]
+
+
 def _get_input_tokens_and_scores_input_grad_chat(
     model_key: str,
     messages: List[Dict[str, str]],
@@ -38,10 +84,11 @@ def _get_input_tokens_and_scores_input_grad_chat(
     max_new_tokens: int,
     top_p: float,
     top_k: int,
-) -> Tuple[List[str], List[float], torch.Tensor]:
+    gradient_checkpointing: bool = False,
+) -> Tuple[List[str], List[float], torch.Tensor, Dict[str, Any]]:
     """
     Attribution over full prompt (system + user tokens) using chat template.
-    Returns (token_strings, normalized_scores_0_1, output_ids_used).
+    Returns (token_strings, normalized_scores_0_1, output_ids_used, grad_pass_report).
     """
     tokenizer, model = load_llm(model_key)
     device = get_model_device(model)
@@ -53,58 +100,445 @@ def _get_input_tokens_and_scores_input_grad_chat(
     input_ids = input_ids.to(device)
     prompt_length = input_ids.shape[1]
 
-    do_sample = temperature > 0
-    gen_kw: Dict[str, Any] = {
-        "max_new_tokens": max_new_tokens,
-        "pad_token_id": tokenizer.eos_token_id,
-        "eos_token_id": tokenizer.eos_token_id,
-        "do_sample": do_sample,
-    }
-    if do_sample:
-        gen_kw["temperature"] = temperature
-        if top_p < 1.0:
-            gen_kw["top_p"] = top_p
-        if top_k > 0:
-            gen_kw["top_k"] = top_k
-
-    with torch.no_grad():
-        out = model.generate(input_ids, **gen_kw)
-    output_ids = out[0][prompt_length:].unsqueeze(0)
+    output_ids = _generate_output_ids(
+        model, tokenizer, input_ids, temperature, max_new_tokens, top_p, top_k
+    )
     gen_len = output_ids.shape[1]
     if gen_len == 0:
         token_strs = tokenizer.convert_ids_to_tokens(input_ids[0])
-        return token_strs, [0.0] * len(token_strs), output_ids
+        return token_strs, [0.0] * len(token_strs), output_ids, {}
 
     embed_layer = model.get_input_embeddings()
     prompt_embeds = embed_layer(input_ids).detach().clone().requires_grad_(True)
-    output_embeds = embed_layer(output_ids)
+    output_embeds = embed_layer(output_ids).detach()
     full_embeds = torch.cat([prompt_embeds, output_embeds], dim=1)
     seq_len = full_embeds.shape[1]
     attention_mask = torch.ones(1, seq_len, device=device, dtype=torch.long)
 
-    outputs = model(inputs_embeds=full_embeds, attention_mask=attention_mask)
-    logits = outputs.logits
-    logits_for_gen = logits[0, prompt_length - 1 : prompt_length - 1 + gen_len]
-    target = output_ids[0]
-    loss = -F.cross_entropy(logits_for_gen, target, reduction="sum")
-    loss.backward()
+    with activation_checkpointing(model, gradient_checkpointing) as grad_report:
+        outputs = model(inputs_embeds=full_embeds, attention_mask=attention_mask)
+        logits = outputs.logits
+        logits_for_gen = logits[0, prompt_length - 1 : prompt_length - 1 + gen_len]
+        target = output_ids[0]
+        loss = -F.cross_entropy(logits_for_gen, target, reduction="sum")
+        # Gradient w.r.t. the prompt embeddings only: no parameter .grad buffers are allocated.
+        (grad,) = torch.autograd.grad(loss, prompt_embeds, allow_unused=True)
 
-    grad = prompt_embeds.grad
     if grad is None:
         token_strs = tokenizer.convert_ids_to_tokens(input_ids[0])
-        return token_strs, [0.0] * len(token_strs), output_ids
+        return token_strs, [0.0] * len(token_strs), output_ids, grad_report
 
     importance = grad.abs().sum(dim=-1).squeeze(0)
-    importance = importance.detach().cpu().float()
-    min_val = importance.min().item()
-    max_val = importance.max().item()
-    if max_val > min_val:
-        scores = ((importance - min_val) / (max_val - min_val)).tolist()
-    else:
-        scores = [0.0] * importance.shape[0]
+    scores = _normalize_scores(importance)
 
     token_strs = tokenizer.convert_ids_to_tokens(input_ids[0])
-    return token_strs, scores, output_ids
+    return token_strs, scores, output_ids, grad_report
+
+
+def _rows_vjp(
+    token_logprobs: torch.Tensor,
+    prompt_embeds: torch.Tensor,
+    start: int,
+    end: int,
+) -> torch.Tensor:
+    """
+    Vector-Jacobian products for output rows [start, end): d logp(y_j) / d prompt_embeds.
+    One batched backward over one-hot cotangents; falls back to one backward per row
+    when the attention kernel does not support batched gradients.
+    Returns (end - start, prompt_len, hidden).
+    """
+    n = end - start
+    cotangents = torch.zeros(
+        n, token_logprobs.shape[0], device=token_logprobs.device, dtype=token_logprobs.dtype
+    )
+    cotangents[torch.arange(n), torch.arange(start, end)] = 1.0
+    try:
+        (grads,) = torch.autograd.grad(
+            token_logprobs,
+            prompt_embeds,
+            grad_outputs=cotangents,
+            retain_graph=True,
+            is_grads_batched=True,
+        )
+        return grads.squeeze(1)
+    except RuntimeError:
+        rows = []
+        for j in range(start, end):
+            (g,) = torch.autograd.grad(token_logprobs[j], prompt_embeds, retain_graph=True)
+            rows.append(g.squeeze(0))
+        return torch.stack(rows, dim=0)
+
+
+def _get_input_grad_matrix_chat(
+    model_key: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    max_new_tokens: int,
+    top_p: float,
+    top_k: int,
+    chunk_size: int = 16,
+    progress_callback=None,
+    gradient_checkpointing: bool = False,
+) -> Tuple[List[str], List[float], List[str], List[List[float]], Dict[str, Any]]:
+    """
+    Input x output attribution: row j holds |d logp(y_j) / d prompt_embeds| summed over hidden,
+    min-max normalized per row. One forward pass; rows are computed as batched VJPs in
+    chunks of chunk_size and reported through progress_callback as soon as they are ready.
+    The summed row gradients reproduce the input_grad vector, returned as token scores.
+    Returns (input_token_strings, scores, output_token_strings, matrix, grad_pass_report).
+    """
+    tokenizer, model = load_llm(model_key)
+    device = get_model_device(model)
+    model.eval()
+
+    input_ids = _messages_to_input_ids(tokenizer, messages)
+    if input_ids.dim() == 1:
+        input_ids = input_ids.unsqueeze(0)
+    input_ids = input_ids.to(device)
+    prompt_length = input_ids.shape[1]
+    token_strs = tokenizer.convert_ids_to_tokens(input_ids[0])
+
+    output_ids = _generate_output_ids(
+        model, tokenizer, input_ids, temperature, max_new_tokens, top_p, top_k
+    )
+    gen_len = output_ids.shape[1]
+    output_strs = tokenizer.convert_ids_to_tokens(output_ids[0])
+    if progress_callback:
+        progress_callback({"type": "matrix_meta", "input_tokens": token_strs, "output_tokens": output_strs})
+    if gen_len == 0:
+        return token_strs, [0.0] * len(token_strs), output_strs, [], {}
+
+    embed_layer = model.get_input_embeddings()
+    prompt_embeds = embed_layer(input_ids).detach().clone().requires_grad_(True)
+    output_embeds = embed_layer(output_ids).detach()
+    full_embeds = torch.cat([prompt_embeds, output_embeds], dim=1)
+    attention_mask = torch.ones(1, full_embeds.shape[1], device=device, dtype=torch.long)
+
+    chunk = max(1, int(chunk_size or 1))
+    grad_sum = torch.zeros_like(prompt_embeds[0], dtype=torch.float32)
+    matrix: List[List[float]] = []
+    with activation_checkpointing(model, gradient_checkpointing) as grad_report:
+        outputs = model(inputs_embeds=full_embeds, attention_mask=attention_mask)
+        logits_for_gen = outputs.logits[0, prompt_length - 1 : prompt_length - 1 + gen_len]
+        token_logprobs = -F.cross_entropy(logits_for_gen.float(), output_ids[0], reduction="none")
+
+        for start in range(0, gen_len, chunk):
+            end = min(start + chunk, gen_len)
+            grads = _rows_vjp(token_logprobs, prompt_embeds, start, end).float()
+            grad_sum += grads.sum(dim=0)
+            rows_imp = grads.abs().sum(dim=-1)
+            row_min = rows_imp.min(dim=-1, keepdim=True).values
+            row_rng = rows_imp.max(dim=-1, keepdim=True).values - row_min
+            rows = torch.where(row_rng > 0, (rows_imp - row_min) / row_rng.clamp(min=1e-12), torch.zeros_like(rows_imp))
+            rows_list = rows.cpu().tolist()
+            matrix.extend(rows_list)
+            if progress_callback:
+                progress_callback({"type": "matrix_rows", "start": start, "rows": rows_list, "total": gen_len})
+
+    scores = _normalize_scores(grad_sum.abs().sum(dim=-1))
+    return token_strs, scores, output_strs, matrix, grad_report
+
+
+def _value_norm_hooks(model: torch.nn.Module, store: List[torch.Tensor]) -> List[Any]:
+    """Forward hooks on every attention v_proj (in layer order) that keep per-token value vectors."""
+    handles = []
+    for name, mod in model.named_modules():
+        if name.endswith(".v_proj"):
+            handles.append(mod.register_forward_hook(lambda _m, _i, out: store.append(out.detach())))
+    return handles
+
+
+def _get_attention_rollout_chat(
+    model_key: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    max_new_tokens: int,
+    top_p: float,
+    top_k: int,
+    value_norm: bool = False,
+) -> Tuple[List[str], List[float]]:
+    """
+    Gradient-free attribution from a single forward pass (Abnar & Zuidema attention rollout).
+    Per layer: head-averaged attention A, residual-corrected A' = 0.5 * A + 0.5 * I (rows
+    renormalized). The rows of the positions that predict generated tokens are propagated
+    from the last layer down (R <- R @ A'), so only (k x T) @ (T x T) products run on device.
+    value_norm=True weights attention by the value-vector norm of each attended token
+    (attention x ||v||, Kobayashi et al.) before averaging over heads.
+    Returns (token_strings, normalized_scores_0_1).
+    """
+    tokenizer, model = load_llm(model_key)
+    device = get_model_device(model)
+    model.eval()
+
+    input_ids = _messages_to_input_ids(tokenizer, messages)
+    if input_ids.dim() == 1:
+        input_ids = input_ids.unsqueeze(0)
+    input_ids = input_ids.to(device)
+    prompt_length = input_ids.shape[1]
+    token_strs = tokenizer.convert_ids_to_tokens(input_ids[0])
+
+    output_ids = _generate_output_ids(
+        model, tokenizer, input_ids, temperature, max_new_tokens, top_p, top_k
+    )
+    gen_len = output_ids.shape[1]
+    full_ids = torch.cat([input_ids, output_ids.to(device)], dim=1)
+    seq_len = full_ids.shape[1]
+
+    values: List[torch.Tensor] = []
+    handles = _value_norm_hooks(model, values) if value_norm else []
+    try:
+        with torch.inference_mode():
+            outputs = model(
+                input_ids=full_ids,
+                attention_mask=torch.ones_like(full_ids),
+                output_attentions=True,
+            )
+    finally:
+        for h in handles:
+            h.remove()
+
+    attentions = outputs.attentions
+    config = getattr(model.config, "text_config", None) or model.config
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+    if not attentions or any(a is None for a in attentions):
+        raise ValueError("Model did not return attention weights (requires eager attention).")
+    if value_norm and len(values) != len(attentions):
+        raise ValueError("attention_value_norm needs one v_proj module per attention layer.")
+
+    with torch.inference_mode():
+        # Query rows whose next-token prediction is a generated token (last prompt token if none).
+        first_row = prompt_length - 1
+        rows = torch.arange(first_row, first_row + max(gen_len, 1), device=device)
+        rollout = torch.zeros(rows.shape[0], seq_len, device=device, dtype=torch.float32)
+        rollout[torch.arange(rows.shape[0], device=device), rows] = 1.0
+        for layer_idx in range(len(attentions) - 1, -1, -1):
+            attn = attentions[layer_idx][0].float()  # (heads, T, T)
+            if value_norm:
+                num_heads = attn.shape[0]
+                v = values[layer_idx][0].float()  # (T, kv_heads * head_dim)
+                kv_heads = max(v.shape[-1] // head_dim, 1)
+                v_norm = v.view(seq_len, kv_heads, head_dim).norm(dim=-1)  # (T, kv_heads)
+                v_norm = v_norm.repeat_interleave(num_heads // kv_heads, dim=1).T  # (heads, T)
+                attn = attn * v_norm.unsqueeze(1)
+            layer_attn = attn.sum(dim=0)
+            layer_attn = layer_attn / layer_attn.sum(dim=-1, keepdim=True).clamp(min=1e-12)
+            layer_attn = 0.5 * layer_attn + 0.5 * torch.eye(seq_len, device=device)
+            rollout = rollout.to(layer_attn.device) @ layer_attn
+        importance = rollout[:, :prompt_length].sum(dim=0)
+
+    return token_strs, _normalize_scores(importance)
+
+
+def _occlusion_span_logprobs(
+    model: torch.nn.Module,
+    full_ids: torch.Tensor,
+    spans: List[Tuple[int, int]],
+    gen_len: int,
+    mode: str,
+    mask_token_id: int,
+    cache: Any,
+) -> torch.Tensor:
+    """
+    Generated-sequence log-likelihood for each span ablation, in one padded batch.
+    Rows share positions [0, first span start), so that part comes from the cached KV and
+    only the rest is re-run. mode="mask" replaces the span by mask_token_id; mode="delete"
+    drops it from attention and shifts the later position ids, which equals deleting it.
+    A deleted span must leave at least one position before the generated tokens.
+    Returns (len(spans),) log-likelihoods.
+    """
+    device = full_ids.device
+    batch = len(spans)
+    seq_len = full_ids.shape[1]
+    shared = min(start for start, _ in spans)
+    if mode == "delete":
+        # A deleted span at the prompt end moves the first prediction to the token before it.
+        shared = max(shared - 1, 0)
+    rows = full_ids.expand(batch, seq_len).clone()
+    attention_mask = torch.ones_like(rows)
+    for b, (start, end) in enumerate(spans):
+        if mode == "delete":
+            attention_mask[b, start:end] = 0
+        else:
+            rows[b, start:end] = mask_token_id
+    position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+    # Each generated token is predicted from the last non-deleted position before it.
+    positions = torch.arange(seq_len, device=device).expand(batch, seq_len)
+    prev_kept = torch.where(attention_mask.bool(), positions, torch.full_like(positions, -1)).cummax(dim=-1).values
+    pred_pos = prev_kept[:, seq_len - gen_len - 1 : seq_len - 1]  # (batch, gen_len)
+    if int(pred_pos.min().item()) < 0:
+        raise ValueError("Deleted span leaves no position to predict the first generated token from.")
+    keep = seq_len - int(pred_pos.min().item())
+
+    kwargs: Dict[str, Any] = {}
+    if shared > 0:
+        kwargs["past_key_values"] = expand_prefix_cache(cache, batch, shared)
+    with torch.inference_mode():
+        out = model(
+            input_ids=rows[:, shared:],
+            attention_mask=attention_mask,
+            position_ids=position_ids[:, shared:],
+            **kwargs,
+            **tail_logits_kwargs(model, keep),
+        )
+        tail = out.logits[:, -keep:]
+        index = (pred_pos - (seq_len - keep)).to(tail.device)
+        logits = tail.gather(1, index.unsqueeze(-1).expand(-1, -1, tail.shape[-1])).float()
+        targets = full_ids[0, -gen_len:].to(logits.device).expand(batch, gen_len)
+        logp = torch.log_softmax(logits, dim=-1).gather(-1, targets.unsqueeze(-1)).squeeze(-1)
+    return logp.sum(dim=-1).to(device)
+
+
+def _get_occlusion_chat(
+    model_key: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    max_new_tokens: int,
+    top_p: float,
+    top_k: int,
+    span_size: int = 1,
+    mode: str = "mask",
+    batch_size: int = 0,
+) -> Tuple[List[str], List[float], List[float]]:
+    """
+    Gradient-free occlusion: ablate each span of span_size prompt tokens and measure the drop
+    in log-likelihood of the generated sequence. Ablations run in batches of batch_size
+    spans (OCCLUSION_BATCH_SIZE when 0) ordered by start, so every batch after the first
+    re-runs only from its first span on; that prefix KV comes from the single unablated
+    forward that also gives the baseline log-likelihood. In delete mode a span covering the
+    whole prompt has nothing left to condition on and is skipped (drop 0).
+    Returns (token_strings, normalized_scores_0_1, loglik_drop_per_token).
+    """
+    tokenizer, model = load_llm(model_key)
+    device = get_model_device(model)
+    model.eval()
+
+    input_ids = _messages_to_input_ids(tokenizer, messages)
+    if input_ids.dim() == 1:
+        input_ids = input_ids.unsqueeze(0)
+    input_ids = input_ids.to(device)
+    prompt_length = input_ids.shape[1]
+    token_strs = tokenizer.convert_ids_to_tokens(input_ids[0])
+
+    output_ids = _generate_output_ids(
+        model, tokenizer, input_ids, temperature, max_new_tokens, top_p, top_k
+    )
+    gen_len = output_ids.shape[1]
+    if gen_len == 0:
+        return token_strs, [0.0] * len(token_strs), [0.0] * len(token_strs)
+    full_ids = torch.cat([input_ids, output_ids.to(device)], dim=1)
+
+    mask_token_id = next(
+        (t for t in (tokenizer.unk_token_id, tokenizer.pad_token_id, tokenizer.eos_token_id) if t is not None),
+        0,
+    )
+    span_size = max(1, int(span_size or 1))
+    spans = [(s, min(s + span_size, prompt_length)) for s in range(0, prompt_length, span_size)]
+    if mode == "delete":
+        spans = [(s, e) for s, e in spans if s > 0 or e < prompt_length]
+
+    with torch.no_grad():
+        base = model(
+            input_ids=full_ids,
+            attention_mask=torch.ones_like(full_ids),
+            use_cache=True,
+            **tail_logits_kwargs(model, gen_len + 1),
+        )
+        base_logits = base.logits[0, -(gen_len + 1) : -1].float()
+        base_ll = -F.cross_entropy(base_logits, output_ids[0].to(base_logits.device), reduction="sum")
+    cache = base.past_key_values
+
+    chunk = int(batch_size) if batch_size and int(batch_size) > 0 else OCCLUSION_BATCH_SIZE
+    drops = torch.zeros(prompt_length, dtype=torch.float32, device=device)
+    for i in range(0, len(spans), chunk):
+        chunk_spans = spans[i : i + chunk]
+        ll = _occlusion_span_logprobs(model, full_ids, chunk_spans, gen_len, mode, mask_token_id, cache)
+        for (start, end), value in zip(chunk_spans, (base_ll.to(device) - ll).tolist()):
+            drops[start:end] = value
+
+    return token_strs, _normalize_scores(drops), drops.cpu().tolist()
+
+
+def _get_contrastive_grad_chat(
+    model_key: str,
+    messages: List[Dict[str, str]],
+    positive_response: str,
+    negative_response: str,
+    gradient_checkpointing: bool = False,
+) -> Tuple[List[str], List[float], List[float], Dict[str, float], Dict[str, Any]]:
+    """
+    Contrastive input_grad: gradient of log p(positive | prompt) - log p(negative | prompt)
+    w.r.t. the prompt embeddings. Both responses run as one right-padded batch of 2 that
+    shares a single prompt-embedding leaf, so one forward/backward gives the difference.
+    Returns (token_strings, normalized_abs_scores_0_1, signed_scores, logprobs, grad_pass_report).
+    signed_scores is grad . embedding per token (> 0 pushes towards the positive response).
+    """
+    tokenizer, model = load_llm(model_key)
+    device = get_model_device(model)
+    model.eval()
+
+    input_ids = _messages_to_input_ids(tokenizer, messages)
+    if input_ids.dim() == 1:
+        input_ids = input_ids.unsqueeze(0)
+    input_ids = input_ids.to(device)
+    prompt_length = input_ids.shape[1]
+    token_strs = tokenizer.convert_ids_to_tokens(input_ids[0])
+
+    responses = [
+        tokenizer(text, add_special_tokens=False, return_tensors="pt")["input_ids"][0]
+        for text in (positive_response, negative_response)
+    ]
+    if any(r.numel() == 0 for r in responses):
+        raise ValueError("positive_response and negative_response must be non-empty")
+    resp_len = max(r.numel() for r in responses)
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    resp_ids = torch.full((2, resp_len), pad_id if pad_id is not None else 0, dtype=torch.long, device=device)
+    resp_mask = torch.zeros((2, resp_len), dtype=torch.long, device=device)
+    for row, ids in enumerate(responses):
+        resp_ids[row, : ids.numel()] = ids.to(device)
+        resp_mask[row, : ids.numel()] = 1
+
+    embed_layer = model.get_input_embeddings()
+    prompt_embeds = embed_layer(input_ids).detach().clone().requires_grad_(True)
+    resp_embeds = embed_layer(resp_ids).detach()
+    # Right padding keeps prompt positions identical in both rows (no position_ids needed).
+    full_embeds = torch.cat([prompt_embeds.expand(2, -1, -1), resp_embeds], dim=1)
+    attention_mask = torch.cat(
+        [torch.ones((2, prompt_length), dtype=torch.long, device=device), resp_mask], dim=1
+    )
+
+    with activation_checkpointing(model, gradient_checkpointing) as grad_report:
+        outputs = model(
+            inputs_embeds=full_embeds,
+            attention_mask=attention_mask,
+            **tail_logits_kwargs(model, resp_len + 1),
+        )
+        logits = outputs.logits[:, -(resp_len + 1) : -1].float()
+        token_logprobs = torch.log_softmax(logits, dim=-1).gather(
+            -1, resp_ids.to(logits.device).unsqueeze(-1)
+        ).squeeze(-1)
+        seq_logprobs = (token_logprobs * resp_mask.to(logits.device)).sum(dim=1)
+        margin = seq_logprobs[0] - seq_logprobs[1]
+        (grad,) = torch.autograd.grad(margin, prompt_embeds, allow_unused=True)
+
+    logprobs = {
+        "positive": seq_logprobs[0].item(),
+        "negative": seq_logprobs[1].item(),
+        "margin": margin.item(),
+    }
+    if grad is None:
+        zeros = [0.0] * len(token_strs)
+        return token_strs, zeros, zeros, logprobs, grad_report
+
+    scores = _normalize_scores(grad.abs().sum(dim=-1).squeeze(0))
+    signed = (grad * prompt_embeds.detach()).sum(dim=-1).squeeze(0).float().cpu().tolist()
+    return token_strs, scores, signed, logprobs, grad_report
+
+
+def _drop_special_scores(tokenizer, token_strs: List[str], scores: List[float]) -> List[float]:
+    """Special tokens → min score for "dropped" visualization."""
+    special_set = set(getattr(tokenizer, "all_special_tokens", []) or [])
+    min_score = min(scores) if scores else 0.0
+    return [min_score if t in special_set else scores[i] for i, t in enumerate(token_strs)]
 
 
 def compute_input_attribution(
@@ -116,11 +550,33 @@ def compute_input_attribution(
     top_p: float = 1.0,
     top_k: int = 50,
     attribution_method: str = "input_grad",
+    matrix_chunk_size: int = 16,
+    progress_callback=None,
+    gradient_checkpointing: bool = False,
+    occlusion_span: int = 1,
+    occlusion_mode: str = "mask",
+    occlusion_batch_size: int = 0,
+    positive_response: str = "",
+    negative_response: str = "",
 ) -> Dict[str, Any]:
     """
     Run chat completion (Chat Template: system + user) then compute input token attribution
     over all input tokens before generation (system instruction + input string).
 
+    attribution_method="input_grad_matrix" additionally returns attribution_matrix
+    (one row per generated token), computed matrix_chunk_size rows at a time; each chunk
+    is passed to progress_callback as {"type": "matrix_rows", ...} when ready.
+    gradient_checkpointing=True enables activation checkpointing for the backward pass only;
+    gradient-based results then carry grad_pass (peak memory, timing) for the pass.
+    attribution_method="attention_rollout" / "attention_value_norm" are forward-only
+    (no backward pass) and use the attention weights the model returns.
+    attribution_method="occlusion" ablates occlusion_span-token spans (occlusion_mode "mask"
+    or "delete") and scores the drop in the generated sequence's log-likelihood; the
+    ablations run occlusion_batch_size spans per forward (0 = OCCLUSION_BATCH_SIZE) on a
+    shared KV prefix.
+    attribution_method="contrastive_grad" (Positive & Negative Attribution) skips generation and
+    scores the prompt against positive_response vs negative_response in one batched pass.
+
     Returns:
         generated_text, input_tokens, token_scores, system_instruction, input_string, ...
     """
@@ -131,6 +587,36 @@ def compute_input_attribution(
         messages.append({"role": "system", "content": system_instruction})
     messages.append({"role": "user", "content": input_string})
 
+    if (attribution_method or "").lower() == "contrastive_grad":
+        token_strs, scores, signed, logprobs, grad_report = _get_contrastive_grad_chat(
+            model_key=model_key,
+            messages=messages,
+            positive_response=positive_response,
+            negative_response=negative_response,
+            gradient_checkpointing=gradient_checkpointing,
+        )
+        tokenizer, _ = load_llm(model_key)
+        return {
+            "generated_text": "",
+            "input_tokens": token_strs,
+            "token_scores": scores,
+            "token_scores_drop_special": _drop_special_scores(tokenizer, token_strs, scores),
+            "signed_scores": signed,
+            "positive_response": positive_response,
+            "negative_response": negative_response,
+            "logprob_positive": logprobs["positive"],
+            "logprob_negative": logprobs["negative"],
+            "logprob_margin": logprobs["margin"],
+            "attribution_method": "contrastive_grad",
+            "grad_pass": grad_report,
+            "system_instruction": system_instruction,
+            "input_string": input_string,
+            "temperature": temperature,
+            "max_new_tokens": max_new_tokens,
+            "top_p": top_p,
+            "top_k": top_k,
+        }
+
     do_sample = temperature > 0
     generated_text = chat_completion(
         model_key=model_key,
@@ -164,7 +650,7 @@ def compute_input_attribution(
         }
 
     if attribution_method.lower() == "input_grad":
-        token_strs, scores, _ = _get_input_tokens_and_scores_input_grad_chat(
+        token_strs, scores, _, grad_report = _get_input_tokens_and_scores_input_grad_chat(
             model_key=model_key,
             messages=messages,
             generated_text=generated_text,
@@ -172,21 +658,104 @@ def compute_input_attribution(
             max_new_tokens=max_new_tokens,
             top_p=top_p,
             top_k=top_k,
+            gradient_checkpointing=gradient_checkpointing,
         )
-        # Special tokens → min score for "dropped" visualization
         tokenizer, _ = load_llm(model_key)
-        special_set = set(getattr(tokenizer, "all_special_tokens", []) or [])
-        min_score = min(scores) if scores else 0.0
-        token_scores_drop_special = [
-            min_score if t in special_set else scores[i]
-            for i, t in enumerate(token_strs)
-        ]
         return {
             "generated_text": generated_text,
             "input_tokens": token_strs,
             "token_scores": scores,
-            "token_scores_drop_special": token_scores_drop_special,
+            "token_scores_drop_special": _drop_special_scores(tokenizer, token_strs, scores),
             "attribution_method": "input_grad",
+            "grad_pass": grad_report,
+            "system_instruction": system_instruction,
+            "input_string": input_string,
+            "temperature": temperature,
+            "max_new_tokens": max_new_tokens,
+            "top_p": top_p,
+            "top_k": top_k,
+        }
+
+    if attribution_method.lower() == "input_grad_matrix":
+        token_strs, scores, output_strs, matrix, grad_report = _get_input_grad_matrix_chat(
+            model_key=model_key,
+            messages=messages,
+            temperature=temperature,
+            max_new_tokens=max_new_tokens,
+            top_p=top_p,
+            top_k=top_k,
+            chunk_size=matrix_chunk_size,
+            progress_callback=progress_callback,
+            gradient_checkpointing=gradient_checkpointing,
+        )
+        tokenizer, _ = load_llm(model_key)
+        return {
+            "generated_text": generated_text,
+            "input_tokens": token_strs,
+            "token_scores": scores,
+            "token_scores_drop_special": _drop_special_scores(tokenizer, token_strs, scores),
+            "output_tokens": output_strs,
+            "attribution_matrix": matrix,
+            "matrix_chunk_size": matrix_chunk_size,
+            "attribution_method": "input_grad_matrix",
+            "grad_pass": grad_report,
+            "system_instruction": system_instruction,
+            "input_string": input_string,
+            "temperature": temperature,
+            "max_new_tokens": max_new_tokens,
+            "top_p": top_p,
+            "top_k": top_k,
+        }
+
+    if attribution_method.lower() in ("attention_rollout", "attention_value_norm"):
+        method = attribution_method.lower()
+        token_strs, scores = _get_attention_rollout_chat(
+            model_key=model_key,
+            messages=messages,
+            temperature=temperature,
+            max_new_tokens=max_new_tokens,
+            top_p=top_p,
+            top_k=top_k,
+            value_norm=method == "attention_value_norm",
+        )
+        tokenizer, _ = load_llm(model_key)
+        return {
+            "generated_text": generated_text,
+            "input_tokens": token_strs,
+            "token_scores": scores,
+            "token_scores_drop_special": _drop_special_scores(tokenizer, token_strs, scores),
+            "attribution_method": method,
+            "system_instruction": system_instruction,
+            "input_string": input_string,
+            "temperature": temperature,
+            "max_new_tokens": max_new_tokens,
+            "top_p": top_p,
+            "top_k": top_k,
+        }
+
+    if attribution_method.lower() == "occlusion":
+        mode = "delete" if (occlusion_mode or "").strip().lower() == "delete" else "mask"
+        token_strs, scores, drops = _get_occlusion_chat(
+            model_key=model_key,
+            messages=messages,
+            temperature=temperature,
+            max_new_tokens=max_new_tokens,
+            top_p=top_p,
+            top_k=top_k,
+            span_size=occlusion_span,
+            mode=mode,
+            batch_size=occlusion_batch_size,
+        )
+        tokenizer, _ = load_llm(model_key)
+        return {
+            "generated_text": generated_text,
+            "input_tokens": token_strs,
+            "token_scores": scores,
+            "token_scores_drop_special": _drop_special_scores(tokenizer, token_strs, scores),
+            "loglik_drop": drops,
+            "attribution_method": "occlusion",
+            "occlusion_span": occlusion_span,
+            "occlusion_mode": mode,
             "system_instruction": system_instruction,
             "input_string": input_string,
             "temperature": temperature,
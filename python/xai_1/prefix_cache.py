@@ -0,0 +1,76 @@
+"""
+Shared-prefix KV cache helpers for batched forwards (occlusion attribution, adversarial search).
+
+When every row of a batch starts with the same tokens, their keys/values are computed once
+(batch 1) and expanded across the batch; only the tokens after the shared prefix are re-run.
+"""
+
+from __future__ import annotations
+
+import copy
+import inspect
+from typing import Any, Dict, Optional
+
+import torch
+
+
+def cache_length(cache: Any) -> int:
+    """Number of cached positions (DynamicCache or legacy tuple-of-tuples)."""
+    if cache is None:
+        return 0
+    if hasattr(cache, "get_seq_length"):
+        return int(cache.get_seq_length())
+    return int(cache[0][0].shape[-2])
+
+
+def compute_prefix_cache(model: torch.nn.Module, prefix_ids: torch.Tensor) -> Any:
+    """
+    Run prefix_ids (1, P) once and return its past_key_values.
+    Uses no_grad (not inference_mode) so the cache can feed later gradient passes.
+    """
+    if prefix_ids.dim() == 1:
+        prefix_ids = prefix_ids.unsqueeze(0)
+    with torch.no_grad():
+        out = model(
+            input_ids=prefix_ids,
+            attention_mask=torch.ones_like(prefix_ids),
+            use_cache=True,
+            **tail_logits_kwargs(model, 1),
+        )
+    return out.past_key_values
+
+
+def expand_prefix_cache(cache: Any, batch_size: int, length: Optional[int] = None) -> Any:
+    """
+    Fresh copy of a batch-1 cache, cropped to its first `length` positions and repeated
+    batch_size times. Forwards append to caches in place, so every batch needs its own copy.
+    """
+    total = cache_length(cache)
+    length = total if length is None else max(0, min(int(length), total))
+    if hasattr(cache, "batch_repeat_interleave"):
+        new = copy.deepcopy(cache)
+        if length < total:
+            new.crop(length - total)
+        if batch_size > 1:
+            new.batch_repeat_interleave(batch_size)
+        return new
+    return tuple(
+        tuple(t[..., :length, :].expand(batch_size, *t.shape[1:-2], length, t.shape[-1]).contiguous() for t in layer)
+        for layer in cache
+    )
+
+
+def tail_logits_kwargs(model: torch.nn.Module, n: int) -> Dict[str, int]:
+    """
+    Forward kwargs that keep logits for the last n positions only (skips the full
+    batch x seq x vocab projection) on transformers versions that support it.
+    """
+    try:
+        params = inspect.signature(model.forward).parameters
+    except (TypeError, ValueError):
+        return {}
+    if "logits_to_keep" in params:
+        return {"logits_to_keep": int(n)}
+    if "num_logits_to_keep" in params:
+        return {"num_logits_to_keep": int(n)}
+    return {}
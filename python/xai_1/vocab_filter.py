@@ -0,0 +1,146 @@
+"""
+Per-tokenizer vocabulary filter masks for adversarial token search.
+
+Every mask is a bool vector over the tokenizer's ids (True = allowed). All masks for a
+tokenizer are computed together from one batch_decode of the whole vocabulary, then kept in
+memory and persisted under data/vocab_masks/<tokenizer hash>.npz, so later runs (and server
+restarts) load them in milliseconds.
+
+Filters:
+  special        drop special / added-special tokens (bos, eos, pad, unk, chat markers)
+  clean_text     decoded text is alphanumeric, whitespace, or contains . , ! ?
+  ascii          decoded text is non-empty printable ASCII
+  no_whitespace  decoded text contains no whitespace
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import threading
+import weakref
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+import torch
+
+
+VOCAB_MASK_DIR = Path(__file__).resolve().parent.parent.parent / "data" / "vocab_masks"
+TOKEN_FILTERS = ("special", "clean_text", "ascii", "no_whitespace")
+
+_masks_by_hash: Dict[str, Dict[str, np.ndarray]] = {}
+# Keyed by the tokenizer object itself (weakly), so a collected tokenizer's id cannot alias a new one.
+_hash_by_tokenizer: "weakref.WeakKeyDictionary[object, str]" = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def parse_token_filters(value) -> Tuple[str, ...]:
+    """'ascii, no_whitespace' / list -> known filter names; "special" is always included."""
+    if isinstance(value, str):
+        names: Iterable[str] = value.replace(";", ",").split(",")
+    elif isinstance(value, (list, tuple)):
+        names = [str(v) for v in value]
+    else:
+        names = []
+    picked = [n.strip().lower() for n in names if n and n.strip().lower() in TOKEN_FILTERS]
+    return tuple(dict.fromkeys(["special", *picked]))
+
+
+def tokenizer_hash(tokenizer) -> str:
+    """Content hash of the vocabulary and special tokens (stable across processes and paths)."""
+    try:
+        cached = _hash_by_tokenizer.get(tokenizer)
+    except TypeError:  # not weak-referenceable: hash every time
+        cached = None
+    if cached is not None:
+        return cached
+    vocab = sorted(tokenizer.get_vocab().items(), key=lambda kv: kv[1])
+    payload = json.dumps(
+        {
+            "class": type(tokenizer).__name__,
+            "vocab": vocab,
+            "special_ids": sorted(int(i) for i in (getattr(tokenizer, "all_special_ids", []) or [])),
+        },
+        ensure_ascii=False,
+    )
+    digest = hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+    try:
+        _hash_by_tokenizer[tokenizer] = digest
+    except TypeError:
+        pass
+    return digest
+
+
+def _special_ids(tokenizer) -> List[int]:
+    ids = set(int(i) for i in (getattr(tokenizer, "all_special_ids", []) or []))
+    for name in ("pad_token_id", "eos_token_id", "bos_token_id", "unk_token_id"):
+        value = getattr(tokenizer, name, None)
+        if isinstance(value, int):
+            ids.add(value)
+    decoder = getattr(tokenizer, "added_tokens_decoder", None) or {}
+    for idx, added in decoder.items():
+        if getattr(added, "special", False):
+            ids.add(int(idx))
+    return sorted(ids)
+
+
+def _compute_masks(tokenizer) -> Dict[str, np.ndarray]:
+    """All filter masks from a single batch decode of every token id."""
+    size = len(tokenizer)
+    texts = tokenizer.batch_decode(
+        [[i] for i in range(size)],
+        skip_special_tokens=False,
+        clean_up_tokenization_spaces=False,
+    )
+    special = np.ones(size, dtype=bool)
+    special[[i for i in _special_ids(tokenizer) if 0 <= i < size]] = False
+    clean = np.fromiter(
+        (bool(t) and "\ufffd" not in t and (t.isalnum() or t.isspace() or any(c in ".,!?" for c in t)) for t in texts),
+        dtype=bool,
+        count=size,
+    )
+    ascii_ok = np.fromiter((bool(t) and t.isascii() and t.isprintable() for t in texts), dtype=bool, count=size)
+    no_ws = np.fromiter((bool(t) and not any(c.isspace() for c in t) for t in texts), dtype=bool, count=size)
+    return {"special": special, "clean_text": clean, "ascii": ascii_ok, "no_whitespace": no_ws}
+
+
+def _load_masks(tokenizer) -> Dict[str, np.ndarray]:
+    digest = tokenizer_hash(tokenizer)
+    with _lock:
+        if digest in _masks_by_hash:
+            return _masks_by_hash[digest]
+        path = VOCAB_MASK_DIR / f"{digest}.npz"
+        masks: Dict[str, np.ndarray] = {}
+        if path.exists():
+            try:
+                with np.load(path) as stored:
+                    masks = {name: stored[name].astype(bool) for name in TOKEN_FILTERS if name in stored}
+            except (OSError, ValueError):
+                masks = {}
+        if set(masks) != set(TOKEN_FILTERS):
+            masks = _compute_masks(tokenizer)
+            VOCAB_MASK_DIR.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp.npz")
+            np.savez_compressed(tmp, **masks)
+            tmp.replace(path)
+        _masks_by_hash[digest] = masks
+        return masks
+
+
+def allowed_token_mask(
+    tokenizer,
+    vocab_size: int,
+    device: torch.device,
+    filters: Iterable[str] = ("special",),
+) -> torch.Tensor:
+    """
+    (vocab_size,) bool mask on device: AND of the requested filters. Ids beyond the
+    tokenizer (padded embedding rows) are never allowed.
+    """
+    masks = _load_masks(tokenizer)
+    combined = np.logical_and.reduce([masks[n] for n in parse_token_filters(filters if isinstance(filters, str) else tuple(filters))])
+    out = torch.zeros(vocab_size, dtype=torch.bool)
+    n = min(vocab_size, combined.shape[0])
+    out[:n] = torch.from_numpy(combined[:n])
+    return out.to(device)
@@ -0,0 +1,311 @@
+"""
+Persistent pooled-activation cache for Residual Concept Detection.
+
+One directory per (model, treatment, examples, token_location, hooked module names) under data/activation_cache/<key>/:
+  meta.json          num_examples, hidden_size, cached hook keys, what the key was built from
+  counts.npy         (num_examples,) float32 pooled token count per example
+  <hook key>.npy     (num_examples, hidden_size) float32 pooled sum per example (memory-mapped)
+
+A run writes <name>.<run id>.tmp.npy files and renames them into place on commit, so
+concurrent runs with the same key never share a file. Whole cache directories are evicted
+least recently used first once they exceed MAX_CACHE_BYTES together.
+
+Examples are every row with a non-empty text (label-independent), so changing the label pair,
+estimator or analyzer reuses the cache. Hook points are stored one file each, so a later run
+that selects more layers only captures the missing ones.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+import torch
+
+from python.xai_2.second_order import SecondOrderStats
+
+
+ACTIVATION_CACHE_DIR = Path(__file__).resolve().parent.parent.parent / "data" / "activation_cache"
+ROW_CHUNK = 8192
+MAX_CACHE_BYTES = 32 << 30
+STALE_TMP_SECONDS = 24 * 3600  # .tmp files of runs that stopped this long ago are removed
+
+_lock = threading.Lock()
+
+
+def texts_fingerprint(texts: List[str]) -> str:
+    """Content hash of the example texts (order-sensitive)."""
+    h = hashlib.sha1()
+    for t in texts:
+        h.update(t.encode("utf-8", "surrogatepass"))
+        h.update(b"\x00")
+    return h.hexdigest()[:16]
+
+
+def cache_key(
+    model: str,
+    treatment: str,
+    fingerprint: str,
+    token_location: Any,
+    max_length: int,
+    layer_config: Optional[Dict[str, str]] = None,
+) -> str:
+    """Cache directory name; layer_config names decide which modules the hook keys refer to."""
+    modules = {k: (layer_config or {}).get(k) or "" for k in ("layer_base", "attn_name", "mlp_name")}
+    payload = json.dumps(
+        {
+            "model": model or "",
+            "modules": modules,
+            "treatment": treatment or "",
+            "examples": fingerprint,
+            "token_location": token_location,
+            "max_length": int(max_length),
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+class ActivationCache:
+    def __init__(
+        self,
+        key: str,
+        num_examples: int,
+        hidden_size: int,
+        info: Optional[Dict[str, Any]] = None,
+        root: Optional[Path] = None,
+        run_id: Optional[str] = None,
+    ):
+        self.key = key
+        self.root = Path(root or ACTIVATION_CACHE_DIR)
+        self.path = self.root / key
+        self.run_id = run_id or f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.num_examples = int(num_examples)
+        self.hidden_size = int(hidden_size)
+        self.meta: Dict[str, Any] = {
+            "num_examples": self.num_examples,
+            "hidden_size": self.hidden_size,
+            "keys": [],
+            **(info or {}),
+        }
+        meta_path = self.path / "meta.json"
+        if meta_path.exists():
+            try:
+                stored = json.loads(meta_path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                stored = {}
+            if stored.get("num_examples") == self.num_examples and stored.get("hidden_size") == self.hidden_size:
+                self.meta = stored
+            try:
+                os.utime(self.path)  # recency for eviction
+            except OSError:
+                pass
+        self._writing: Dict[str, np.memmap] = {}
+        self._counts_writing: Optional[np.memmap] = None
+        self._written: set = set()
+
+    # ----- Reading -----
+
+    @property
+    def keys(self) -> List[str]:
+        return [k for k in self.meta.get("keys", []) if (self.path / f"{k}.npy").exists()]
+
+    def missing(self, keys: Iterable[str]) -> List[str]:
+        have = set(self.keys) if (self.path / "counts.npy").exists() else set()
+        return [k for k in keys if k not in have]
+
+    def sums(self, key: str) -> np.ndarray:
+        return np.load(self.path / f"{key}.npy", mmap_mode="r")
+
+    def counts(self) -> np.ndarray:
+        return np.load(self.path / "counts.npy")
+
+    def class_stats(
+        self,
+        keys: Iterable[str],
+        rows: List[int],
+        label_ids: List[int],
+        num_classes: int,
+        second_order: Optional[Dict[str, SecondOrderStats]] = None,
+        second_order_rank: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """
+        {key: (sums (num_classes, hidden), counts (num_classes,))} over the given example rows,
+        read ROW_CHUNK rows at a time from the memory-mapped files. With second_order, the
+        per-key SecondOrderStats of the pooled means are filled from the same chunks.
+        """
+        rows_t = torch.tensor(rows, dtype=torch.long)
+        labels_t = torch.tensor(label_ids, dtype=torch.long)
+        counts = torch.from_numpy(self.counts())
+        row_counts = counts[rows_t]
+        class_counts = torch.zeros(num_classes, dtype=torch.float32).index_add_(0, labels_t, row_counts)
+        out: Dict[str, Any] = {}
+        for key in keys:
+            mm = self.sums(key)
+            class_sums = torch.zeros(num_classes, self.hidden_size, dtype=torch.float32)
+            if second_order is not None:
+                second_order[key] = SecondOrderStats(num_classes, self.hidden_size, torch.device("cpu"), second_order_rank)
+            for start in range(0, len(rows), ROW_CHUNK):
+                chunk = rows[start : start + ROW_CHUNK]
+                block = torch.from_numpy(np.ascontiguousarray(mm[np.asarray(chunk)]))
+                chunk_labels = labels_t[start : start + len(chunk)]
+                class_sums.index_add_(0, chunk_labels, block)
+                if second_order is not None:
+                    n = row_counts[start : start + len(chunk)]
+                    has_tokens = n > 0
+                    second_order[key].update(block[has_tokens] / n[has_tokens].unsqueeze(-1), chunk_labels[has_tokens])
+            out[key] = (class_sums, class_counts.clone())
+        return out
+
+    def example_means(self, keys: List[str], rows: List[int]) -> torch.Tensor:
+        """(len(keys), len(rows), hidden) float32 pooled means (sum / token count) of the given rows."""
+        idx = np.asarray(rows)
+        n = torch.from_numpy(self.counts()[idx]).clamp(min=1.0).unsqueeze(-1)
+        out = torch.empty(len(keys), len(rows), self.hidden_size, dtype=torch.float32)
+        for k, key in enumerate(keys):
+            mm = self.sums(key)
+            for start in range(0, len(rows), ROW_CHUNK):
+                chunk = idx[start : start + ROW_CHUNK]
+                out[k, start : start + len(chunk)] = torch.from_numpy(np.ascontiguousarray(mm[chunk]))
+            out[k] /= n
+        return out
+
+    # ----- Writing -----
+
+    def _tmp(self, name: str) -> Path:
+        return self.path / f"{name}.{self.run_id}.tmp.npy"
+
+    def begin(self, keys: Iterable[str], resume_run: Optional[str] = None) -> bool:
+        """
+        Open this run's .tmp memmaps for keys (and counts); visible to readers only after
+        commit(). resume_run (the run_id of an interrupted run) reopens that run's .tmp files
+        when all of them are still there (returns True) instead of starting empty ones
+        (returns False).
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        now = time.time()
+        for tmp in self.path.glob("*.tmp.npy"):
+            try:
+                if now - tmp.stat().st_mtime > STALE_TMP_SECONDS:
+                    tmp.unlink()
+            except OSError:
+                pass
+        shape = (self.num_examples, self.hidden_size)
+        keys = list(keys)
+        if resume_run:
+            own_run = self.run_id
+            self.run_id = resume_run
+            if all(self._tmp(name).exists() for name in [*keys, "counts"]):
+                try:
+                    self.attach(keys)
+                    if all(mm.shape == shape for mm in self._writing.values()):
+                        return True
+                except (OSError, ValueError):
+                    pass
+                self.abort()
+            self.run_id = own_run
+        for key in keys:
+            self._writing[key] = np.lib.format.open_memmap(self._tmp(key), mode="w+", dtype=np.float32, shape=shape)
+        self._counts_writing = np.lib.format.open_memmap(
+            self._tmp("counts"), mode="w+", dtype=np.float32, shape=(self.num_examples,)
+        )
+        return False
+
+    def write(self, rows: List[int], pooled: Dict[str, Any]) -> None:
+        """pooled: {key: (sums (len(rows), hidden), counts (len(rows),))} for one batch."""
+        idx = np.asarray(rows)
+        for key, (s, n) in pooled.items():
+            if key in self._writing:
+                self._writing[key][idx] = s.numpy()
+                self._written.add(key)
+                if self._counts_writing is not None:
+                    self._counts_writing[idx] = n.numpy()
+
+    def attach(self, keys: Iterable[str]) -> None:
+        """Open the .tmp memmaps begin() created for this run_id (e.g. in another process) to write rows."""
+        for key in keys:
+            self._writing[key] = np.load(self._tmp(key), mmap_mode="r+")
+        self._counts_writing = np.load(self._tmp("counts"), mmap_mode="r+")
+
+    def flush(self) -> List[str]:
+        """Flush attached memmaps; returns the keys this process wrote (for mark_written)."""
+        for mm in self._writing.values():
+            mm.flush()
+        if self._counts_writing is not None:
+            self._counts_writing.flush()
+        return sorted(self._written)
+
+    def mark_written(self, keys: Iterable[str]) -> None:
+        self._written.update(k for k in keys if k in self._writing)
+
+    def commit(self) -> None:
+        with _lock:
+            # Keys whose hook never fired (module not found) are dropped, not stored as zeros
+            written = [k for k in self._writing if k in self._written]
+            for mm in self._writing.values():
+                mm.flush()
+            opened = list(self._writing)
+            self._writing = {}
+            self._written = set()
+            for key in opened:
+                tmp = self._tmp(key)
+                if key in written:
+                    tmp.replace(self.path / f"{key}.npy")
+                else:
+                    tmp.unlink(missing_ok=True)
+            if self._counts_writing is not None:
+                self._counts_writing.flush()
+                self._counts_writing = None
+                if written:
+                    self._tmp("counts").replace(self.path / "counts.npy")
+                else:
+                    self._tmp("counts").unlink(missing_ok=True)
+            self.meta["keys"] = sorted(set(self.meta.get("keys", [])) | set(written))
+            self.meta["updated"] = time.time()
+            tmp = self.path / f"meta.{self.run_id}.tmp.json"
+            tmp.write_text(json.dumps(self.meta, ensure_ascii=False, indent=2), encoding="utf-8")
+            tmp.replace(self.path / "meta.json")
+            _evict(self.root, keep=self.key)
+
+    def abort(self) -> None:
+        self._writing = {}
+        self._written = set()
+        self._counts_writing = None
+        for tmp in self.path.glob(f"*.{self.run_id}.tmp.npy"):
+            try:
+                tmp.unlink()
+            except OSError:
+                pass
+
+
+def _evict(root: Path, keep: str, max_bytes: int = MAX_CACHE_BYTES) -> None:
+    """Remove least recently used cache directories until the rest fit in max_bytes."""
+    now = time.time()
+    entries = []
+    for path in root.iterdir() if root.exists() else []:
+        if not path.is_dir():
+            continue
+        files = [f for f in path.iterdir() if f.is_file()]
+        try:
+            size = sum(f.stat().st_size for f in files)
+            # A directory another run is still writing into is never evicted
+            busy = any(f.name.endswith(".tmp.npy") and now - f.stat().st_mtime < STALE_TMP_SECONDS for f in files)
+            entries.append((path.stat().st_mtime, path, size, busy or path.name == keep))
+        except OSError:
+            continue
+    total = sum(size for _, _, size, _ in entries)
+    for _, path, size, pinned in sorted(entries, key=lambda e: e[0]):
+        if total <= max_bytes:
+            break
+        if pinned:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
@@ -0,0 +1,83 @@
+"""
+Logistic-regression probes trained for many hook points at once.
+
+All hook points are stacked into one (keys, examples, hidden) tensor and one (keys, hidden)
+weight tensor, so a single batched einsum per step trains every layer's probe together on
+CPU or GPU. Features are standardised per key on the training split. Classes are weighted
+to balance them, and held-out accuracy per key gives the layer-wise localisation curve.
+"""
+
+from __future__ import annotations
+
+from typing import Dict
+
+import torch
+import torch.nn.functional as F
+
+
+PROBE_STEPS = 300
+PROBE_LR = 0.05
+PROBE_L2 = 1e-3
+HELDOUT_FRACTION = 0.2
+
+
+def heldout_split(n: int, fraction: float = HELDOUT_FRACTION, seed: int = 0) -> torch.Tensor:
+    """(n,) bool, True = train. At least one example on each side when n >= 2."""
+    gen = torch.Generator().manual_seed(seed)
+    order = torch.randperm(n, generator=gen)
+    n_heldout = min(max(int(round(n * fraction)), 1 if n >= 2 else 0), max(n - 1, 0))
+    train = torch.ones(n, dtype=torch.bool)
+    train[order[:n_heldout]] = False
+    return train
+
+
+def train_linear_probes(
+    x: torch.Tensor,
+    y: torch.Tensor,
+    train: torch.Tensor,
+    steps: int = PROBE_STEPS,
+    lr: float = PROBE_LR,
+    l2: float = PROBE_L2,
+) -> Dict[str, torch.Tensor]:
+    """
+    x: (keys, examples, hidden) features, y: (examples,) 0/1 targets, train: (examples,) bool.
+    Returns weight (keys, hidden) and bias (keys,) in the original feature space, plus
+    train_accuracy and heldout_accuracy (keys,) (NaN when the held-out split is empty).
+    """
+    x = x.float()
+    y = y.float().to(x.device)
+    train = train.to(x.device)
+    x_train = x[:, train]
+    y_train = y[train]
+    mu = x_train.mean(dim=1, keepdim=True)
+    sd = x_train.std(dim=1, keepdim=True).clamp(min=1e-6)
+    z_train = (x_train - mu) / sd
+
+    n_pos = y_train.sum().clamp(min=1.0)
+    n_neg = (1.0 - y_train).sum().clamp(min=1.0)
+    sample_w = torch.where(y_train > 0.5, 0.5 / n_pos, 0.5 / n_neg)
+
+    keys, _, hidden = x.shape
+    w = torch.zeros(keys, hidden, device=x.device, requires_grad=True)
+    b = torch.zeros(keys, device=x.device, requires_grad=True)
+    opt = torch.optim.Adam([w, b], lr=lr)
+    target = y_train.unsqueeze(0).expand(keys, -1)
+    with torch.enable_grad():
+        for _ in range(max(int(steps), 1)):
+            opt.zero_grad(set_to_none=True)
+            logits = torch.einsum("knh,kh->kn", z_train, w) + b.unsqueeze(1)
+            loss = (F.binary_cross_entropy_with_logits(logits, target, reduction="none") * sample_w).sum(dim=1)
+            (loss.sum() + l2 * (w * w).sum()).backward()
+            opt.step()
+
+    with torch.no_grad():
+        weight = w / sd.squeeze(1)
+        bias = b - (weight * mu.squeeze(1)).sum(dim=-1)
+        pred = (torch.einsum("knh,kh->kn", x, weight) + bias.unsqueeze(1)) > 0
+        correct = (pred == (y > 0.5).unsqueeze(0)).float()
+        heldout = ~train
+        train_acc = correct[:, train].mean(dim=1)
+        heldout_acc = (
+            correct[:, heldout].mean(dim=1) if heldout.any() else torch.full((keys,), float("nan"), device=x.device)
+        )
+    return {"weight": weight, "bias": bias, "train_accuracy": train_acc, "heldout_accuracy": heldout_acc}
@@ -0,0 +1,226 @@
+"""
+Data-parallel capture for Residual Concept Detection.
+
+The length-sorted batches are dealt to N spawned worker processes by padded-token load.
+Each worker loads its own model replica with the session treatment (Simple Steering hooks)
+applied, pinned to one GPU through CUDA_VISIBLE_DEVICES. GPUs are dealt round-robin starting
+after the parent's GPU, whose own replica stays resident: with fewer GPUs than workers some
+GPUs hold several replicas, and with N GPUs and N workers the last worker shares the parent's
+GPU. Without CUDA, workers hide every GPU (CUDA_VISIBLE_DEVICES="") and split the CPU cores;
+that needs a loader that can load on CPU (python.model_load loads on CUDA only). It runs
+_get_layer_outputs_residual on its shard and sends back per-class sums / counts (and
+SecondOrderStats), which the parent adds up. With the activation cache, workers write their
+rows straight into the parent run's .tmp memmaps. Progress from all workers is merged into one
+progress_callback(done, total) in the parent. Parallel runs are not checkpointed: a stop or
+a failed worker discards the partial result.
+"""
+
+from __future__ import annotations
+
+import io
+import os
+import queue as queue_module
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+
+
+MAX_WORKERS = 16
+POLL_SECONDS = 1.0
+
+
+def worker_gpus(num_workers: int, parent_device: Optional[torch.device] = None) -> List[Optional[int]]:
+    """
+    GPU index per worker, round-robin starting after parent_device's GPU (so the parent's
+    replica is the last to get company); None for every worker when CUDA is unavailable.
+    """
+    n_gpu = torch.cuda.device_count() if torch.cuda.is_available() else 0
+    if n_gpu == 0:
+        return [None] * num_workers
+    parent = (parent_device.index or 0) if parent_device is not None and parent_device.type == "cuda" else -1
+    return [(parent + 1 + i) % n_gpu for i in range(num_workers)]
+
+
+def shard_batches(batches: List[List[int]], lengths: List[int], num_workers: int) -> List[List[List[int]]]:
+    """Longest-first batches go to the least-loaded worker (padded tokens); empty shards are dropped."""
+    loads = [0] * num_workers
+    shards: List[List[List[int]]] = [[] for _ in range(num_workers)]
+    for batch in batches:
+        w = min(range(num_workers), key=loads.__getitem__)
+        shards[w].append(batch)
+        loads[w] += len(batch) * max((lengths[i] for i in batch), default=0)
+    return [s for s in shards if s]
+
+
+def _worker(index: int, gpu: Optional[int], threads: int, job: Dict[str, Any], out_queue) -> None:
+    # Set before the first CUDA call in this (spawned) process
+    if gpu is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu)
+    else:
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+        torch.set_num_threads(max(1, threads))
+    try:
+        from python.model_load import load_llm
+        from python.xai_2.residual_concept_detection import _get_layer_outputs_residual
+
+        tokenizer, model = load_llm(job["model_key"])
+        if job["treatment"]:
+            from python.treatments.simple_steering import apply_simple_steering_from_string
+
+            apply_simple_steering_from_string(job["model_key"], job["treatment"])
+        device = next(
+            (p.device for p in model.parameters() if p.device.type != "meta"),
+            torch.device("cpu"),
+        )
+        rows = job["rows"]
+        cache = None
+        example_sink = None
+        if job["cache"] is not None:
+            from python.xai_2.activation_cache import ActivationCache
+
+            cache = ActivationCache(**job["cache"])
+            cache.attach(job["output_keys"])
+
+            def example_sink(local_rows, pooled):
+                cache.write([rows[i] for i in local_rows], pooled)
+
+        second_order = {} if job["second_order"] else None
+        stats = _get_layer_outputs_residual(
+            model, tokenizer, job["input_ids"], job["batches"], job["label_ids"], job["num_classes"],
+            job["layer_config"], job["num_layers"], job["output_keys"], job["token_location"], device,
+            progress_callback=lambda done, total: out_queue.put(("progress", index, done, total)),
+            example_sink=example_sink,
+            spans=job["spans"],
+            second_order=second_order,
+            second_order_rank=job["second_order_rank"],
+        )
+        payload = {
+            "stats": stats,
+            "second_order": {k: v.cpu() for k, v in second_order.items()} if second_order else None,
+            "written": cache.flush() if cache is not None else [],
+        }
+        # Serialised to bytes so the parent does not depend on this process's shared memory
+        buf = io.BytesIO()
+        torch.save(payload, buf)
+        out_queue.put(("done", index, buf.getvalue()))
+    except BaseException as e:  # noqa: BLE001
+        out_queue.put(("error", index, f"{type(e).__name__}: {e}"))
+
+
+def capture_parallel(
+    *,
+    num_workers: int,
+    model_key: str,
+    treatment: str,
+    input_ids: List[List[int]],
+    batches: List[List[int]],
+    label_ids: Optional[List[int]],
+    num_classes: int,
+    layer_config: Dict[str, str],
+    num_layers: int,
+    output_keys: List[str],
+    token_location: Any,
+    spans: Optional[List[Tuple[int, int]]] = None,
+    cache=None,
+    second_order: Optional[Dict[str, Any]] = None,
+    second_order_rank: Optional[int] = None,
+    progress_callback=None,
+    should_stop=None,
+    parent_device: Optional[torch.device] = None,
+) -> Dict[str, Tuple[torch.Tensor, torch.Tensor]]:
+    """
+    Same result as _get_layer_outputs_residual over all batches, computed by num_workers
+    processes. With cache (begun by the caller), workers write pooled rows into it and the
+    written keys are marked on it; the returned stats are then empty. second_order, when
+    given, is filled with the merged per-key SecondOrderStats. Raises RuntimeError when a
+    worker fails and RunCancelled (workers terminated, nothing checkpointed) when should_stop()
+    turns true. parent_device is where the caller's replica lives (see worker_gpus).
+    """
+    import multiprocessing
+
+    from python.xai_2.residual_concept_detection import RunCancelled
+
+    shards = shard_batches(batches, [len(ids) for ids in input_ids], num_workers)
+    gpus = worker_gpus(len(shards), parent_device)
+    threads = max(1, (os.cpu_count() or 1) // len(shards))
+    ctx = multiprocessing.get_context("spawn")
+    out_queue = ctx.Queue()
+    procs = []
+    total_batches = len(batches)
+    for index, shard in enumerate(shards):
+        rows = sorted({i for batch in shard for i in batch})
+        local = {row: i for i, row in enumerate(rows)}
+        job = {
+            "model_key": model_key,
+            "treatment": treatment,
+            "rows": rows,
+            "input_ids": [input_ids[r] for r in rows],
+            "batches": [[local[i] for i in batch] for batch in shard],
+            "label_ids": [label_ids[r] for r in rows] if label_ids is not None and cache is None else None,
+            "num_classes": num_classes,
+            "layer_config": layer_config,
+            "num_layers": num_layers,
+            "output_keys": list(output_keys),
+            "token_location": token_location,
+            "spans": [spans[r] for r in rows] if spans is not None else None,
+            "second_order": second_order is not None and cache is None,
+            "second_order_rank": second_order_rank,
+            "cache": (
+                {
+                    "key": cache.key,
+                    "num_examples": cache.num_examples,
+                    "hidden_size": cache.hidden_size,
+                    "root": str(cache.root),
+                    "run_id": cache.run_id,
+                }
+                if cache is not None
+                else None
+            ),
+        }
+        proc = ctx.Process(target=_worker, args=(index, gpus[index], threads, job, out_queue), daemon=True)
+        proc.start()
+        procs.append(proc)
+
+    done_by_worker = [0] * len(procs)
+    results: Dict[int, Dict[str, Any]] = {}
+    try:
+        while len(results) < len(procs):
+            if should_stop is not None and should_stop():
+                raise RunCancelled(sum(done_by_worker), total_batches)
+            try:
+                kind, index, value, *rest = out_queue.get(timeout=POLL_SECONDS)
+            except queue_module.Empty:
+                dead = [i for i, p in enumerate(procs) if i not in results and p.exitcode is not None]
+                if dead:
+                    raise RuntimeError(f"Worker {dead[0]} exited (code {procs[dead[0]].exitcode}) without a result")
+                continue
+            if kind == "progress":
+                done_by_worker[index] = value
+                if progress_callback is not None:
+                    progress_callback(sum(done_by_worker), total_batches)
+            elif kind == "error":
+                raise RuntimeError(f"Worker {index} failed: {value}")
+            else:
+                results[index] = torch.load(io.BytesIO(value), weights_only=False)
+    finally:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+
+    merged: Dict[str, Tuple[torch.Tensor, torch.Tensor]] = {}
+    for index in sorted(results):
+        payload = results[index]
+        for key, (sums, counts) in payload["stats"].items():
+            if key in merged:
+                merged[key] = (merged[key][0] + sums, merged[key][1] + counts)
+            else:
+                merged[key] = (sums, counts)
+        for key, stats in (payload["second_order"] or {}).items():
+            if key in second_order:
+                second_order[key].merge(stats)
+            else:
+                second_order[key] = stats
+        if cache is not None:
+            cache.mark_written(payload["written"])
+    return merged
@@ -9,29 +9,98 @@ Residual Concept Detection (2.0.1).
 - Output: direction vectors for attn, mlp across all layers
 """
 
+import os
+import re
+import time
 from typing import Any, Dict, List, Optional, Tuple, Union
 
+import pyarrow as pa
+import pyarrow.compute as pc
 import torch
 
+from python.xai_1.prefix_cache import tail_logits_kwargs
+from python.xai_2 import run_checkpoint
+from python.xai_2.second_order import COVARIANCE_MODES, ESTIMATORS, SecondOrderStats, choose_rank
+
+
+HOOK_KINDS = ("attn_out", "attn_block_out", "mlp_out", "mlp_block_out")
+
+
+def parse_hook_kinds(value: Any) -> List[str]:
+    """
+    'attn_out, mlp_block_out' / list -> hook kinds in forward order. Empty / 'all' selects
+    every kind; raises ValueError on an unknown name.
+    """
+    if isinstance(value, str):
+        names = value.replace(";", ",").split(",")
+    elif isinstance(value, (list, tuple)):
+        names = [str(v) for v in value]
+    else:
+        names = []
+    picked = {n.strip().lower() for n in names if n and n.strip()}
+    if not picked or "all" in picked:
+        return list(HOOK_KINDS)
+    unknown = sorted(picked - set(HOOK_KINDS))
+    if unknown:
+        raise ValueError(f"Unknown hook kind(s) {', '.join(unknown)}; valid: {', '.join(HOOK_KINDS)}, all")
+    return [k for k in HOOK_KINDS if k in picked]
+
+
+def parse_layer_selection(value: Any, num_layers: int) -> List[int]:
+    """
+    '0-11', '4,8,-1', [0, 2] -> sorted layer indices (negative = from the end, ranges inclusive).
+    Empty / 'all' selects every layer; raises ValueError on malformed or out-of-range entries.
+    """
+    if value is None or (isinstance(value, str) and value.strip().lower() in ("", "all")):
+        return list(range(num_layers))
+    if isinstance(value, int):
+        parts: List[str] = [str(value)]
+    elif isinstance(value, (list, tuple)):
+        parts = [str(v).strip() for v in value]
+    else:
+        parts = [p.strip() for p in str(value).replace(";", ",").split(",")]
+
+    def index(text: str) -> int:
+        i = int(text)
+        j = i + num_layers if i < 0 else i
+        if not 0 <= j < num_layers:
+            raise ValueError(f"Layer {i} out of range (model has {num_layers} layers)")
+        return j
+
+    picked = set()
+    for part in parts:
+        if not part:
+            continue
+        m = re.fullmatch(r"(-?\d+)\s*-\s*(-?\d+)", part)
+        if m:
+            lo, hi = index(m.group(1)), index(m.group(2))
+            picked.update(range(min(lo, hi), max(lo, hi) + 1))
+        elif re.fullmatch(r"-?\d+", part):
+            picked.add(index(part))
+        else:
+            raise ValueError(f"Invalid layer selection: {part!r}")
+    return sorted(picked) if picked else list(range(num_layers))
+
 
 def _build_hook_names_residual(
     layer_config: Dict[str, str],
     num_layers: int,
+    layers: Optional[List[int]] = None,
+    hook_kinds: Optional[List[str]] = None,
 ) -> List[str]:
     """
-    Build output keys: attn_out, attn_block_out, mlp_out, mlp_block_out per layer.
+    Build output keys <layer_base>.<i>.<kind> for the selected layers and hook kinds
+    (default: every layer, all of attn_out, attn_block_out, mlp_out, mlp_block_out).
     Returns list like [base.0.attn_out, base.0.attn_block_out, base.0.mlp_out, base.0.mlp_block_out, ...]
     """
     base = (layer_config.get("layer_base") or "").strip()
     if not base:
         return []
+    kinds = [k for k in HOOK_KINDS if k in hook_kinds] if hook_kinds else list(HOOK_KINDS)
     names: List[str] = []
-    for i in range(num_layers):
+    for i in (range(num_layers) if layers is None else layers):
         layer_prefix = f"{base}.{i}"
-        names.append(f"{layer_prefix}.attn_out")
-        names.append(f"{layer_prefix}.attn_block_out")
-        names.append(f"{layer_prefix}.mlp_out")
-        names.append(f"{layer_prefix}.mlp_block_out")
+        names.extend(f"{layer_prefix}.{kind}" for kind in kinds)
     return names
 
 
@@ -68,28 +137,90 @@ def _extract_tensor(outp: Any) -> Optional[torch.Tensor]:
     return t.detach() if t is not None else None
 
 
-def _agg_token_sum_count(
-    t: torch.Tensor, token_location: Union[str, List[int]]
-) -> Tuple[torch.Tensor, torch.Tensor]:
+TokenLocation = Union[str, List[int]]
+
+
+def parse_token_location(value: Any) -> TokenLocation:
     """
-    (batch, seq, hidden) -> (sum over tokens, count per example).
-    Returns (batch, hidden), (batch,) for memory-efficient aggregation.
+    "full" | "user_span" | relative positions [p, ...] (0 = first non-pad token, -1 = last).
+    Accepts "last", "first", "last:k" / "first:k" and "0,1,-1" / lists. Empty = "full";
+    raises ValueError on anything else.
+    """
+    if isinstance(value, int):
+        return [value]
+    if isinstance(value, (list, tuple)):
+        return [int(x) for x in value] or "full"
+    text = str(value or "").strip().lower()
+    if text in ("", "full"):
+        return "full"
+    if text == "user_span":
+        return "user_span"
+    if text in ("last", "first"):
+        return [-1] if text == "last" else [0]
+    m = re.fullmatch(r"(last|first)\s*[:\-_]\s*(\d+)", text)
+    if m:
+        k = max(int(m.group(2)), 1)
+        return list(range(-k, 0)) if m.group(1) == "last" else list(range(k))
+    try:
+        return [int(x) for x in text.replace(",", " ").split()]
+    except ValueError:
+        raise ValueError(f"Invalid token_location: {value!r}") from None
+
+
+def _token_selection(
+    mask: torch.Tensor, token_location: TokenLocation, spans: Optional[torch.Tensor] = None
+) -> Tuple[torch.Tensor, ...]:
     """
+    Per-batch pooling selection, resolved per row from the attention mask (either padding side):
+      ("weights", w (batch, seq))                full / user_span
+      ("gather", idx (batch, P), valid (batch, P))  relative positions
+    spans: (batch, 2) [start, end) per row relative to the first non-pad token (user_span).
+    """
+    lengths = mask.sum(dim=1)
+    first = mask.to(torch.int8).argmax(dim=1)
     if token_location == "full":
-        s = t.sum(dim=1)
-        n = t.new_full((t.shape[0],), t.shape[1], dtype=torch.long)
-        return s, n
-    idx = token_location
-    idx_list = [idx] if isinstance(idx, int) else list(idx)
-    valid = [i for i in idx_list if 0 <= i < t.shape[1]]
-    if not valid:
-        s = t.sum(dim=1)
-        n = t.new_full((t.shape[0],), t.shape[1], dtype=torch.long)
-        return s, n
-    sel = t[:, valid, :]
-    s = sel.sum(dim=1)
-    n = s.new_full((t.shape[0],), len(valid), dtype=torch.long)
-    return s, n
+        return ("weights", mask)
+    if token_location == "user_span":
+        pos = torch.arange(mask.shape[1], device=mask.device).unsqueeze(0) - first.unsqueeze(1)
+        inside = (pos >= spans[:, :1]) & (pos < spans[:, 1:])
+        return ("weights", mask * inside.to(mask.dtype))
+    rel = torch.tensor(token_location, dtype=torch.long, device=mask.device).unsqueeze(0)
+    rel = torch.where(rel < 0, rel + lengths.unsqueeze(1), rel)
+    valid = (rel >= 0) & (rel < lengths.unsqueeze(1))
+    idx = (first.unsqueeze(1) + rel.clamp(min=0)).clamp(max=mask.shape[1] - 1)
+    return ("gather", idx, valid)
+
+
+def _agg_token_sum_count(t: torch.Tensor, selection: Tuple[torch.Tensor, ...]) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    (batch, seq, hidden) -> (sum over selected non-pad tokens, count per example), both fp32,
+    using a selection from _token_selection (one bmm or one gather, no per-row loop).
+    Returns (batch, hidden), (batch,) for memory-efficient aggregation.
+    """
+    if selection[0] == "weights":
+        w = selection[1]
+        s = torch.bmm(w.to(t.dtype).unsqueeze(1), t).squeeze(1).float()
+        return s, w.sum(dim=1, dtype=torch.float32)
+    _, idx, valid = selection
+    picked = torch.gather(t, 1, idx.unsqueeze(-1).expand(-1, -1, t.shape[-1]))
+    s = torch.bmm(valid.to(t.dtype).unsqueeze(1), picked).squeeze(1).float()
+    return s, valid.sum(dim=1, dtype=torch.float32)
+
+
+class _StopForward(Exception):
+    """Raised by the hook on the deepest hooked module to end a capture forward early."""
+
+
+def _decoder_module(model: torch.nn.Module, layer_base: str) -> Optional[torch.nn.Module]:
+    """
+    Module that owns the layer list (e.g. 'model' for 'model.layers'), i.e. the decoder stack
+    without the lm_head. None when layer_base sits directly on the model.
+    """
+    parent = layer_base.rsplit(".", 1)[0] if "." in layer_base else ""
+    if not parent:
+        return None
+    mod = _resolve_module(model, parent)
+    return mod if mod is not None and mod is not model else None
 
 
 def _extract_input(inp: Any) -> Optional[torch.Tensor]:
@@ -98,101 +229,573 @@ def _extract_input(inp: Any) -> Optional[torch.Tensor]:
     return x.detach() if x is not None else None
 
 
+MAX_TOKEN_LENGTH = 2048
+
+
+def _tokenize_texts(tokenizer: Any, texts: List[str]) -> List[List[int]]:
+    """Tokenize every text once (truncated, unpadded) in a single batched call."""
+    enc = tokenizer(texts, padding=False, truncation=True, max_length=MAX_TOKEN_LENGTH)
+    return [list(ids) for ids in enc["input_ids"]]
+
+
+_USER_SENTINEL = "<<PNP_USER_CONTENT>>"
+
+
+def _tokenize_user_spans(tokenizer: Any, texts: List[str]) -> Tuple[List[List[int]], List[Tuple[int, int]]]:
+    """
+    Wrap every text as a user turn of the chat template and tokenize; also return the
+    [start, end) token span of the user content in each sequence (via offset mapping).
+    The content's character offset comes from rendering the template around a sentinel, so
+    text that also occurs in the template (or is very short) is not mislocated. Raises
+    ValueError when a row's content cannot be located or is truncated away.
+    """
+
+    def render(content: str) -> str:
+        return tokenizer.apply_chat_template(
+            [{"role": "user", "content": content}], tokenize=False, add_generation_prompt=True
+        )
+
+    rendered = render(_USER_SENTINEL)
+    if rendered.count(_USER_SENTINEL) != 1:
+        raise ValueError("Chat template does not render the user content verbatim; cannot locate user_span")
+    before, after = rendered.split(_USER_SENTINEL)
+    formatted = [render(t) for t in texts]
+    enc = tokenizer(
+        formatted,
+        padding=False,
+        truncation=True,
+        max_length=MAX_TOKEN_LENGTH,
+        add_special_tokens=False,
+        return_offsets_mapping=True,
+    )
+    spans: List[Tuple[int, int]] = []
+    for i, (text, full, offsets) in enumerate(zip(texts, formatted, enc["offset_mapping"])):
+        if full == before + text + after:
+            c0, c1 = len(before), len(before) + len(text)
+        else:
+            # Template rewrites the content (e.g. trims it): search only after the user header
+            header = len(os.path.commonprefix([before, full]))
+            content = text.strip()
+            c0 = full.find(content, header) if content else -1
+            c1 = c0 + len(content)
+        inside = [j for j, (a, b) in enumerate(offsets) if c0 >= 0 and b > c0 and a < c1]
+        if not inside:
+            raise ValueError(f"Cannot locate the user content of row {i} in its chat-template tokens")
+        spans.append((inside[0], inside[-1] + 1))
+    return [list(ids) for ids in enc["input_ids"]], spans
+
+
+def _length_batches(
+    lengths: List[int], batch_size: int, max_batch_tokens: Optional[int] = None
+) -> List[List[int]]:
+    """
+    Group example indices into batches of similar length (longest first, so an OOM shows
+    up on the first batch). With max_batch_tokens, a batch grows while rows x longest row
+    stays within the budget; otherwise it holds batch_size rows.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: (-lengths[i], i))
+    bs = max(int(batch_size) if batch_size else 8, 1)
+    batches: List[List[int]] = []
+    current: List[int] = []
+    for i in order:
+        if current:
+            longest = lengths[current[0]]
+            full = (
+                (len(current) + 1) * max(longest, 1) > max_batch_tokens
+                if max_batch_tokens
+                else len(current) >= bs
+            )
+            if full:
+                batches.append(current)
+                current = []
+        current.append(i)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _pooled_to_host(
+    pooled: Dict[str, Tuple[torch.Tensor, torch.Tensor]]
+) -> Dict[str, Tuple[torch.Tensor, torch.Tensor]]:
+    """Per-batch {key: (sums, counts)} -> CPU, stacking the keys on each device into one copy."""
+    by_device: Dict[torch.device, List[str]] = {}
+    for key, (s, _n) in pooled.items():
+        by_device.setdefault(s.device, []).append(key)
+    out: Dict[str, Tuple[torch.Tensor, torch.Tensor]] = {}
+    for keys in by_device.values():
+        stacked = torch.stack([pooled[k][0] for k in keys]).cpu()
+        counts = pooled[keys[0]][1].cpu()
+        for j, key in enumerate(keys):
+            out[key] = (stacked[j], counts)
+    return out
+
+
+class RunCancelled(Exception):
+    """Raised between batches when should_stop() turns true; next_batch is where a resume starts."""
+
+    def __init__(self, next_batch: int, total_batches: int):
+        super().__init__(f"Cancelled at batch {next_batch}/{total_batches}")
+        self.next_batch = next_batch
+        self.total_batches = total_batches
+
+
 def _get_layer_outputs_residual(
     model: torch.nn.Module,
     tokenizer: Any,
-    texts: List[str],
+    input_ids: List[List[int]],
+    batches: List[List[int]],
+    label_ids: Optional[List[int]],
+    num_classes: int,
     layer_config: Dict[str, str],
     num_layers: int,
     output_keys: List[str],
-    token_location: Union[str, List[int]],
+    token_location: TokenLocation,
     device: torch.device,
-    batch_size: int,
     progress_callback=None,
-) -> Dict[str, torch.Tensor]:
+    example_sink=None,
+    spans: Optional[List[Tuple[int, int]]] = None,
+    second_order: Optional[Dict[str, Any]] = None,
+    second_order_rank: Optional[int] = None,
+    start_batch: int = 0,
+    resume_stats: Optional[Dict[str, Tuple[torch.Tensor, torch.Tensor]]] = None,
+    should_stop=None,
+    checkpoint=None,
+    checkpoint_every: int = 0,
+) -> Dict[str, Tuple[torch.Tensor, torch.Tensor]]:
     """
     Run model with hooks:
     - attn: MLP input (value after attn block)
     - mlp: block output (value after MLP block)
-    Returns: {output_key: tensor of shape (total_examples, model_dim)}
+    input_ids: pre-tokenized examples; batches: index lists into input_ids (see _length_batches);
+    label_ids: class index per example; spans: per-example [start, end) for token_location="user_span".
+    Hooks index_add_ their pooled sums into fp32 per-class buffers on the hooked module's
+    device; everything is copied to the host once at the end.
+    With example_sink(rows, {key: (sums, counts)}), per-example pooled values are handed to
+    the sink after every batch instead (one host copy per device per batch) and nothing is
+    accumulated; label_ids is then unused.
+    second_order: dict filled with a SecondOrderStats per key (per-example pooled means,
+    exact or sketched with second_order_rank) alongside the class sums.
+    start_batch / resume_stats: continue a checkpointed run (second_order then holds its stats).
+    checkpoint(next_batch, stats) is called every checkpoint_every batches and before raising
+    RunCancelled when should_stop() turns true between batches.
+    Returns: {output_key: (sums (num_classes, hidden), token counts (num_classes,))}
     """
     base = (layer_config.get("layer_base") or "").strip()
     attn_name = (layer_config.get("attn_name") or "self_attn").strip()
     mlp_name = (layer_config.get("mlp_name") or "mlp").strip()
-    outputs_sum: Dict[str, List[torch.Tensor]] = {k: [] for k in output_keys}
-    outputs_count: Dict[str, List[torch.Tensor]] = {k: [] for k in output_keys}
+    class_sums: Dict[str, torch.Tensor] = {}
+    class_counts: Dict[str, torch.Tensor] = {}
+    # Current batch's attention mask / label ids, per device (layers may be spread out)
+    batch_state: Dict[str, Any] = {}
     handles: List[Any] = []
 
+    def batch_tensors(dev: torch.device) -> Tuple[Tuple[torch.Tensor, ...], Optional[torch.Tensor]]:
+        cached = batch_state["by_device"].get(dev)
+        if cached is None:
+            labels = batch_state["labels"]
+            selection = tuple(x.to(dev) if isinstance(x, torch.Tensor) else x for x in batch_state["selection"])
+            cached = (selection, labels.to(dev) if labels is not None else None)
+            batch_state["by_device"][dev] = cached
+        return cached
+
+    batch_pooled: Dict[str, Tuple[torch.Tensor, torch.Tensor]] = {}
+
+    def accumulate(key: str, t: torch.Tensor) -> None:
+        selection, labels = batch_tensors(t.device)
+        s, n = _agg_token_sum_count(t, selection)
+        if example_sink is not None:
+            batch_pooled[key] = (s, n)
+            return
+        if key not in class_sums:
+            if resume_stats and key in resume_stats:
+                class_sums[key] = resume_stats[key][0].float().to(t.device)
+                class_counts[key] = resume_stats[key][1].float().to(t.device)
+            else:
+                class_sums[key] = torch.zeros(num_classes, s.shape[-1], dtype=torch.float32, device=t.device)
+                class_counts[key] = torch.zeros(num_classes, dtype=torch.float32, device=t.device)
+            if second_order is not None and key in second_order:
+                second_order[key].to(t.device)
+        class_sums[key].index_add_(0, labels, s)
+        class_counts[key].index_add_(0, labels, n)
+        if second_order is not None:
+            if key not in second_order:
+                second_order[key] = SecondOrderStats(num_classes, s.shape[-1], t.device, second_order_rank)
+            has_tokens = n > 0
+            second_order[key].update(s[has_tokens] / n[has_tokens].unsqueeze(-1), labels[has_tokens])
+
     def make_forward_hook(key: str):
         def hook(_mod, _inp, outp):
             t = _extract_tensor(outp)
             if t is not None:
-                t = t.detach()
-                s, n = _agg_token_sum_count(t, token_location)
-                outputs_sum[key].append(s.cpu())
-                outputs_count[key].append(n.cpu())
+                accumulate(key, t)
         return hook
 
     def make_pre_hook(key: str):
         def hook(_mod, inp):
             t = _extract_input(inp)
             if t is not None:
-                t = t.detach()
-                s, n = _agg_token_sum_count(t, token_location)
-                outputs_sum[key].append(s.cpu())
-                outputs_count[key].append(n.cpu())
+                accumulate(key, t)
         return hook
 
+    def stop_forward(*_args):
+        raise _StopForward()
+
+    # Register only hooks whose key was requested. Registration order follows forward order,
+    # so last_hooked ends on the deepest hook point.
+    wanted = set(output_keys)
+    modules = dict(model.named_modules())
+    last_hooked: Optional[Tuple[torch.nn.Module, bool]] = None
     for i in range(num_layers):
         layer_prefix = f"{base}.{i}"
-        layer_mod = _resolve_module(model, layer_prefix)
-        attn_mod = _resolve_module(model, f"{layer_prefix}.{attn_name}")
-        mlp_mod = _resolve_module(model, f"{layer_prefix}.{mlp_name}")
         key_attn_out = f"{layer_prefix}.attn_out"
         key_attn_block = f"{layer_prefix}.attn_block_out"
         key_mlp_out = f"{layer_prefix}.mlp_out"
         key_mlp_block = f"{layer_prefix}.mlp_block_out"
-        if attn_mod is not None:
+        if not wanted.intersection((key_attn_out, key_attn_block, key_mlp_out, key_mlp_block)):
+            continue
+        layer_mod = modules.get(layer_prefix)
+        attn_mod = modules.get(f"{layer_prefix}.{attn_name}")
+        mlp_mod = modules.get(f"{layer_prefix}.{mlp_name}")
+        if attn_mod is not None and key_attn_out in wanted:
             handles.append(attn_mod.register_forward_hook(make_forward_hook(key_attn_out)))
-        if mlp_mod is not None:
+            last_hooked = (attn_mod, False)
+        if mlp_mod is not None and key_attn_block in wanted:
             handles.append(mlp_mod.register_forward_pre_hook(make_pre_hook(key_attn_block)))
-        if mlp_mod is not None:
+            last_hooked = (mlp_mod, True)
+        if mlp_mod is not None and key_mlp_out in wanted:
             handles.append(mlp_mod.register_forward_hook(make_forward_hook(key_mlp_out)))
-        if layer_mod is not None:
+            last_hooked = (mlp_mod, False)
+        if layer_mod is not None and key_mlp_block in wanted:
             handles.append(layer_mod.register_forward_hook(make_forward_hook(key_mlp_block)))
+            last_hooked = (layer_mod, False)
+
+    # Nothing past the deepest hook point is needed: skip the remaining layers, final norm
+    # and the (batch, seq, vocab) logits by running the decoder stack and stopping there.
+    if last_hooked is not None:
+        stop_mod, is_pre = last_hooked
+        if is_pre:
+            handles.append(stop_mod.register_forward_pre_hook(stop_forward))
+        else:
+            handles.append(stop_mod.register_forward_hook(stop_forward))
+    decoder = _decoder_module(model, base)
+    run_kwargs: Dict[str, Any] = {"use_cache": False}
+    if decoder is None:
+        decoder = model
+        run_kwargs.update(tail_logits_kwargs(model, 1))
+
+    def partial() -> Dict[str, Tuple[torch.Tensor, torch.Tensor]]:
+        # Keys not hooked yet in this call keep their resumed values
+        out = dict(resume_stats or {})
+        out.update({name: (class_sums[name], class_counts[name]) for name in class_sums})
+        return out
 
     try:
-        bs = max(int(batch_size) if batch_size else 8, 1)
-        total_batches = (len(texts) + bs - 1) // bs
+        total_batches = len(batches)
         with torch.inference_mode():
-            for batch_idx, start in enumerate(range(0, len(texts), bs)):
+            for batch_idx in range(start_batch, total_batches):
+                rows = batches[batch_idx]
+                if should_stop is not None and should_stop():
+                    if checkpoint is not None:
+                        checkpoint(batch_idx, partial())
+                    raise RunCancelled(batch_idx, total_batches)
                 if progress_callback:
                     progress_callback(batch_idx + 1, total_batches)
-                batch_texts = texts[start : start + bs]
-                enc = tokenizer(
-                    batch_texts,
-                    return_tensors="pt",
+                enc = tokenizer.pad(
+                    {"input_ids": [input_ids[i] for i in rows]},
                     padding=True,
-                    truncation=True,
-                    max_length=2048,
+                    return_tensors="pt",
                 )
                 enc = {k: v.to(device) for k, v in enc.items()}
-                _ = model(**enc)
-
-        result: Dict[str, Tuple[torch.Tensor, torch.Tensor]] = {}
-        for name in output_keys:
-            if not outputs_sum[name]:
-                continue
-            result[name] = (
-                torch.cat(outputs_sum[name], dim=0),
-                torch.cat(outputs_count[name], dim=0),
-            )
-        return result
+                batch_spans = (
+                    torch.tensor([spans[i] for i in rows], dtype=torch.long, device=device)
+                    if spans is not None
+                    else None
+                )
+                batch_state["selection"] = _token_selection(enc["attention_mask"], token_location, batch_spans)
+                batch_state["labels"] = (
+                    torch.tensor([label_ids[i] for i in rows], dtype=torch.long, device=device)
+                    if label_ids is not None
+                    else None
+                )
+                batch_state["by_device"] = {}
+                try:
+                    decoder(**enc, **run_kwargs)
+                except _StopForward:
+                    pass
+                if example_sink is not None and batch_pooled:
+                    example_sink(rows, _pooled_to_host(batch_pooled))
+                    batch_pooled.clear()
+                if checkpoint is not None and checkpoint_every > 0 and (batch_idx + 1) % checkpoint_every == 0:
+                    checkpoint(batch_idx + 1, partial())
+
+        stats = partial()
+        return {name: (stats[name][0].cpu(), stats[name][1].cpu()) for name in output_keys if name in stats}
     finally:
         for h in handles:
             h.remove()
 
 
+def _column_strings(column) -> pa.Array:
+    """
+    Arrow column -> trimmed utf8 array (nulls kept). String and integer columns are cast in
+    Arrow; other types (bool, float, nested) go through Python str() to keep its spelling.
+    """
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    if pa.types.is_dictionary(column.type):
+        column = column.dictionary_decode()
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type) or pa.types.is_integer(column.type):
+        column = pc.cast(column, pa.string())
+    else:
+        column = pa.array([None if v is None else str(v) for v in column.to_pylist()], type=pa.string())
+    return pc.utf8_trim_whitespace(column)
+
+
+def _collect_texts_labels(
+    ds, text_key: str, label_key: str, keep_labels: Optional[List[str]]
+) -> Tuple[List[str], List[Optional[str]]]:
+    """
+    Whole-column text/label extraction: rows with a non-empty text and a label (as trimmed
+    string) in keep_labels, in dataset order. keep_labels=None keeps every row with a text
+    (label may then be None).
+    """
+    if text_key not in ds.column_names or label_key not in ds.column_names:
+        return [], []
+    table = ds.select_columns(list(dict.fromkeys([text_key, label_key]))).with_format("arrow")[:]
+    texts = _column_strings(table.column(text_key))
+    labels = _column_strings(table.column(label_key))
+    keep = pc.and_(pc.is_valid(texts), pc.not_equal(texts, ""))
+    if keep_labels is not None:
+        keep = pc.and_(keep, pc.is_in(labels, value_set=pa.array(keep_labels, type=pa.string())))
+    keep = pc.fill_null(keep, False)
+    return pc.filter(texts, keep).to_pylist(), pc.filter(labels, keep).to_pylist()
+
+
+def _available_labels(ds, label_key: str) -> List[str]:
+    """Distinct non-null label values (as trimmed strings) over the whole column."""
+    if label_key not in ds.column_names:
+        return []
+    labels = _column_strings(ds.select_columns([label_key]).with_format("arrow")[:].column(label_key))
+    return sorted(v for v in pc.unique(labels.drop_null()).to_pylist())
+
+
+DIRECTION_MODES = ("pair", "pairs", "one_vs_rest", "class_mean")
+MAX_LABEL_CLASSES = 256
+PROBE_ESTIMATOR = "probe"
+DIRECTION_ESTIMATORS = ESTIMATORS + (PROBE_ESTIMATOR,)
+PROBE_BUDGET_BYTES = 1 << 30
+STATS_NAMESPACE = "residual_stats"
+MAX_STORED_STATS = 8
+
+
+def parse_label_pairs(value: Any) -> List[Tuple[str, str]]:
+    """'pos:neg, a:b' / [[a, b], ...] -> [(a, b), ...] (labels compared as trimmed strings)."""
+    if isinstance(value, str):
+        items: List[Any] = [p.split(":", 1) for p in value.replace(";", ",").split(",") if ":" in p]
+    elif isinstance(value, (list, tuple)):
+        items = [p.split(":", 1) if isinstance(p, str) else p for p in value]
+    else:
+        items = []
+    pairs: List[Tuple[str, str]] = []
+    for item in items:
+        if isinstance(item, (list, tuple)) and len(item) == 2:
+            a, b = str(item[0]).strip(), str(item[1]).strip()
+            if a and b:
+                pairs.append((a, b))
+    return pairs
+
+
+def _direction_labels(
+    mode: str,
+    positive_label: Optional[str],
+    negative_label: Optional[str],
+    pairs: Optional[List[Tuple[str, str]]],
+) -> Optional[List[str]]:
+    """Labels a mode refers to explicitly (None = needs every label)."""
+    if mode == "pair":
+        return [positive_label or "", negative_label or ""]
+    if mode == "pairs":
+        return list(dict.fromkeys(l for pair in (pairs or []) for l in pair))
+    return None
+
+
+def compute_directions(
+    stats: Dict[str, Tuple[torch.Tensor, torch.Tensor]],
+    class_names: List[str],
+    mode: str = "pair",
+    positive_label: Optional[str] = None,
+    negative_label: Optional[str] = None,
+    pairs: Optional[List[Tuple[str, str]]] = None,
+    estimator: str = "mean_diff",
+    second_order: Optional[Dict[str, SecondOrderStats]] = None,
+    shrinkage: float = 0.1,
+) -> Dict[str, Dict[str, torch.Tensor]]:
+    """
+    Concept directions from per-label statistics {key: (sums (C, hidden), token counts (C,))}.
+    Means are token-weighted. estimator "lda" / "whitened_mean" maps each mean difference
+    through the shrunk within-class covariance (second_order) as Sigma^-1 d / Sigma^-1/2 d.
+    Modes:
+      pair         positive - negative
+      pairs        a - b for each (a, b)
+      one_vs_rest  label - all other labels, for every label
+      class_mean   label - global mean, for every label
+    Returns {set name: {key: (hidden,) direction}}; raises ValueError on unknown labels/mode.
+    """
+    if mode not in DIRECTION_MODES:
+        raise ValueError(f"Unknown direction mode {mode!r} (expected one of {', '.join(DIRECTION_MODES)})")
+    if estimator == PROBE_ESTIMATOR:
+        raise ValueError("Probe directions are trained on cached activations; run with estimator 'probe'")
+    if estimator not in ESTIMATORS:
+        raise ValueError(f"Unknown estimator {estimator!r} (expected one of {', '.join(ESTIMATORS)})")
+    if estimator != "mean_diff" and not second_order:
+        raise ValueError(f"Estimator {estimator!r} needs covariance statistics (run with that estimator)")
+    index = {name: i for i, name in enumerate(class_names)}
+    if mode == "pair":
+        pairs = [(str(positive_label or "").strip(), str(negative_label or "").strip())]
+    if mode in ("pair", "pairs"):
+        if not pairs:
+            raise ValueError("label_pairs required (e.g. 'pos:neg, a:b')")
+        missing = [l for pair in pairs for l in pair if l not in index]
+        if missing:
+            raise ValueError(f"Labels not found: {', '.join(sorted(set(missing)))}")
+
+    out: Dict[str, Dict[str, torch.Tensor]] = {}
+    for key, (sums, counts) in stats.items():
+        sums = sums.float()
+        counts = counts.float()
+        means = sums / counts.clamp(min=1e-12).unsqueeze(-1)
+        if mode in ("pair", "pairs"):
+            targets = [(f"{a} vs {b}", means[index[a]] - means[index[b]]) for a, b in pairs]
+        elif mode == "one_vs_rest":
+            rest_sums = sums.sum(dim=0, keepdim=True) - sums
+            rest_counts = counts.sum() - counts
+            rest_means = rest_sums / rest_counts.clamp(min=1e-12).unsqueeze(-1)
+            targets = [(f"{name} vs rest", means[i] - rest_means[i]) for i, name in enumerate(class_names)]
+        else:
+            global_mean = sums.sum(dim=0) / counts.sum().clamp(min=1e-12)
+            targets = [(f"{name} - mean", means[i] - global_mean) for i, name in enumerate(class_names)]
+        if estimator != "mean_diff":
+            whiten = second_order[key].whitener(estimator, shrinkage)
+            targets = [(name, whiten(direction).to(direction.device)) for name, direction in targets]
+        for name, direction in targets:
+            out.setdefault(name, {})[key] = direction
+    return out
+
+
+def _probe_tasks(
+    mode: str,
+    class_names: List[str],
+    positive_label: Optional[str],
+    negative_label: Optional[str],
+    pairs: Optional[List[Tuple[str, str]]],
+) -> List[Tuple[str, List[int], List[int]]]:
+    """Binary probe targets as (set name, positive class ids, negative class ids), named as in compute_directions."""
+    index = {name: i for i, name in enumerate(class_names)}
+    if mode == "pair":
+        pairs = [(str(positive_label or "").strip(), str(negative_label or "").strip())]
+    if mode in ("pair", "pairs"):
+        missing = [l for pair in pairs or [] for l in pair if l not in index]
+        if not pairs or missing:
+            raise ValueError(f"Labels not found: {', '.join(sorted(set(missing)))}" if missing else "label_pairs required")
+        return [(f"{a} vs {b}", [index[a]], [index[b]]) for a, b in pairs]
+    if mode == "one_vs_rest":
+        all_ids = list(range(len(class_names)))
+        return [(f"{name} vs rest", [i], [j for j in all_ids if j != i]) for i, name in enumerate(class_names)]
+    raise ValueError(f"Estimator 'probe' needs two-sided targets (direction_mode pair, pairs or one_vs_rest), not {mode!r}")
+
+
+def train_probe_directions(
+    cache,
+    keys: List[str],
+    rows: List[int],
+    label_ids: List[int],
+    class_names: List[str],
+    mode: str,
+    positive_label: Optional[str],
+    negative_label: Optional[str],
+    pairs: Optional[List[Tuple[str, str]]],
+    scale_sets: Dict[str, Dict[str, torch.Tensor]],
+    device: torch.device,
+) -> Tuple[Dict[str, Dict[str, torch.Tensor]], Dict[str, Dict[str, Any]]]:
+    """
+    One logistic-regression probe per (set, key) on per-example pooled means from the
+    activation cache; all keys of a set train together (key groups bounded by
+    PROBE_BUDGET_BYTES). Each probe weight is rescaled to the norm of the matching
+    mean-difference direction in scale_sets. Returns (direction sets, per-set probe report
+    with n_train / n_heldout and train / held-out accuracy per key).
+    """
+    from python.xai_2.linear_probe import heldout_split, train_linear_probes
+
+    has_tokens = cache.counts() > 0
+    out: Dict[str, Dict[str, torch.Tensor]] = {}
+    report: Dict[str, Dict[str, Any]] = {}
+    for name, pos_ids, neg_ids in _probe_tasks(mode, class_names, positive_label, negative_label, pairs):
+        pos_set, neg_set = set(pos_ids), set(neg_ids)
+        task = [(r, c in pos_set) for r, c in zip(rows, label_ids) if (c in pos_set or c in neg_set) and has_tokens[r]]
+        n_pos = sum(1 for _, is_pos in task if is_pos)
+        if n_pos == 0 or n_pos == len(task):
+            raise ValueError(f"Probe {name!r} needs examples on both sides")
+        task_rows = [r for r, _ in task]
+        y = torch.tensor([1.0 if is_pos else 0.0 for _, is_pos in task])
+        train = heldout_split(len(task_rows))
+        group = max(1, PROBE_BUDGET_BYTES // max(4 * len(task_rows) * cache.hidden_size, 1))
+        entry: Dict[str, Any] = {
+            "n_train": int(train.sum().item()),
+            "n_heldout": int((~train).sum().item()),
+            "train_accuracy": {},
+            "heldout_accuracy": {},
+        }
+        for start in range(0, len(keys), group):
+            group_keys = keys[start : start + group]
+            fit = train_linear_probes(cache.example_means(group_keys, task_rows).to(device), y, train)
+            for k, key in enumerate(group_keys):
+                w = fit["weight"][k].cpu()
+                target = scale_sets.get(name, {}).get(key)
+                norm = w.norm()
+                if target is not None and norm > 0:
+                    w = w * (target.float().norm() / norm)
+                out.setdefault(name, {})[key] = w
+                entry["train_accuracy"][key] = float(fit["train_accuracy"][k].item())
+                entry["heldout_accuracy"][key] = float(fit["heldout_accuracy"][k].item())
+        report[name] = entry
+    return out, report
+
+
+def store_label_stats(
+    stats: Dict[str, Tuple[torch.Tensor, torch.Tensor]],
+    class_names: List[str],
+    class_examples: List[int],
+    info: Dict[str, Any],
+) -> str:
+    """Keep per-label statistics in the cache store (newest MAX_STORED_STATS) and return their id."""
+    import uuid
+
+    from python.memory.cache_store import cache_store
+
+    stats_id = uuid.uuid4().hex[:12]
+    stored = cache_store.get_namespace(STATS_NAMESPACE)
+    for old_id in sorted(stored, key=lambda k: stored[k].get("created", 0.0))[: max(0, len(stored) - MAX_STORED_STATS + 1)]:
+        cache_store.delete(STATS_NAMESPACE, old_id)
+    cache_store.put(
+        STATS_NAMESPACE,
+        stats_id,
+        {
+            "stats": stats,
+            "class_names": list(class_names),
+            "class_examples": list(class_examples),
+            "created": time.time(),
+            **info,
+        },
+    )
+    return stats_id
+
+
+def get_label_stats(stats_id: str) -> Optional[Dict[str, Any]]:
+    from python.memory.cache_store import cache_store
+
+    return cache_store.get(STATS_NAMESPACE, stats_id)
+
+
 def _apply_process(ds, code: str):
     """Apply processing code to dataset."""
     if not (code or code.strip()):
@@ -212,16 +815,49 @@ def run_residual_concept_detection(
     pipeline: Dict[str, Any],
     text_key: str,
     label_key: str,
-    positive_label: str,
-    negative_label: str,
+    positive_label: Optional[str],
+    negative_label: Optional[str],
     layer_config: Dict[str, str],
-    token_location: Union[str, List[int]],
+    token_location: Any,
     batch_size: int,
     progress_callback=None,
+    max_batch_tokens: Optional[int] = None,
+    layers: Any = None,
+    hook_kinds: Any = None,
+    treatment: str = "",
+    activation_cache: bool = False,
+    direction_mode: str = "pair",
+    label_pairs: Optional[List[Tuple[str, str]]] = None,
+    estimator: str = "mean_diff",
+    covariance: str = "auto",
+    shrinkage: float = 0.1,
+    num_workers: int = 1,
+    should_stop=None,
+    checkpoint_every: int = run_checkpoint.CHECKPOINT_EVERY,
+    resume: bool = False,
 ) -> Tuple[Dict[str, Any], int]:
     """
     Run residual concept detection.
     ds: loaded HuggingFace Dataset (single split, after random select if any).
+    max_batch_tokens: when set, batches are sized by padded tokens instead of batch_size.
+    layers: layer selection ('0-11', '4,8,-1', list; None = all), see parse_layer_selection.
+    hook_kinds: subset of HOOK_KINDS to capture ('attn_out,mlp_out', list; None = all).
+    activation_cache: read/write pooled per-example activations under data/activation_cache
+        (keyed by model, treatment, texts, token_location); cached hook points skip the model.
+    direction_mode / label_pairs: which directions to return, see compute_directions. Per-label
+        sums/counts for every label are accumulated in the same pass and kept under stats_id.
+    estimator: "mean_diff" | "lda" | "whitened_mean" | "probe"; lda / whitened_mean also stream the
+        within-class covariance of per-example pooled activations ("exact", "sketch" or "auto" by size);
+        probe trains logistic-regression probes for all hook points on the activation cache (turned on)
+        and reports held-out accuracy per hook point.
+    num_workers: > 1 shards the batches across that many spawned processes, each with its own
+        model replica with the treatment applied, GPUs dealt round-robin after the parent's
+        (whose replica stays loaded); see parallel_capture. Parallel runs are not checkpointed, so resume is rejected.
+    should_stop: polled between batches; a stop returns 409 with "cancelled". Serial runs save
+        partial sums every checkpoint_every batches (0 = never) and on stop, and with resume=True
+        a rerun with the same settings and data continues from the last checkpoint (see
+        run_checkpoint). Runs whose second-order state exceeds MAX_SECOND_ORDER_BYTES are not
+        checkpointed.
     Returns (result_dict, status_code).
     """
     try:
@@ -229,10 +865,14 @@ def run_residual_concept_detection(
     except ImportError as e:
         return ({"error": f"Import error: {e}"}, 500)
 
+    if num_workers > 1 and resume:
+        return ({"error": "resume needs num_workers = 1 (parallel runs are not checkpointed)"}, 400)
+
     if hasattr(ds, "keys"):
         ds = ds[list(ds.keys())[0]]
     if ds.num_rows == 0:
         return ({"error": "Dataset is empty"}, 400)
+    data_fingerprint = run_checkpoint.dataset_fingerprint(ds)
 
     # Apply processing if any
     code = (pipeline.get("processing_code") or "").strip()
@@ -243,40 +883,56 @@ def run_residual_concept_detection(
             return ({"error": f"Processing failed: {e}"}, 400)
 
     # Collect texts and labels (everything as string)
-    positive_label = str(positive_label).strip()
-    negative_label = str(negative_label).strip()
-    texts: List[str] = []
-    labels: List[str] = []
-    for i in range(ds.num_rows):
-        row = ds[i]
-        t = row.get(text_key)
-        l = row.get(label_key)
-        if t is None or l is None:
-            continue
-        t_str = str(t).strip() if t else ""
-        l_str = str(l).strip() if l else ""
-        if not t_str:
-            continue
-        if l_str in (positive_label, negative_label):
-            texts.append(t_str)
-            labels.append(l_str)
+    positive_label = str(positive_label or "").strip()
+    negative_label = str(negative_label or "").strip()
+    direction_mode = (direction_mode or "pair").strip().lower()
+    if direction_mode not in DIRECTION_MODES:
+        return ({"error": f"Unknown direction_mode {direction_mode!r}"}, 400)
+    estimator = (estimator or "mean_diff").strip().lower()
+    covariance = (covariance or "auto").strip().lower()
+    if estimator not in DIRECTION_ESTIMATORS:
+        return ({"error": f"Unknown estimator {estimator!r}"}, 400)
+    if estimator == PROBE_ESTIMATOR:
+        if direction_mode == "class_mean":
+            return ({"error": "Estimator 'probe' needs direction_mode pair, pairs or one_vs_rest"}, 400)
+        # Probes train on per-example pooled activations, which only the cache keeps
+        activation_cache = True
+    if covariance not in COVARIANCE_MODES:
+        return ({"error": f"Unknown covariance mode {covariance!r}"}, 400)
+    if direction_mode == "pairs" and not label_pairs:
+        return ({"error": "label_pairs required for direction_mode 'pairs' (e.g. 'pos:neg, a:b')"}, 400)
+    texts, labels = _collect_texts_labels(ds, text_key, label_key, None)
 
-    if not texts:
+    # One class per distinct label; too many distinct values only work for explicit pairs
+    needed = _direction_labels(direction_mode, positive_label, negative_label, label_pairs)
+    class_names = sorted({l for l in labels if l is not None})
+    if len(class_names) > MAX_LABEL_CLASSES:
+        if needed is None:
+            return ({"error": f"{label_key!r} has {len(class_names)} distinct values (max {MAX_LABEL_CLASSES} for {direction_mode})"}, 400)
+        class_names = sorted(set(needed) & set(class_names))
+    missing = [l for l in (needed or []) if l not in class_names]
+    if not class_names or missing:
         # 디버깅을 위해 label_key의 가능한 값들을 문자열 기준으로 같이 보여준다
-        seen: set[str] = set()
-        for i in range(min(ds.num_rows, 200)):
-            lv = ds[i].get(label_key)
-            if lv is None:
-                continue
-            seen.add(str(lv).strip())
+        wanted = needed if needed else [positive_label, negative_label]
         return (
             {
-                "error": f"No rows with label in [{positive_label!r}, {negative_label!r}]",
+                "error": f"No rows with label in [{', '.join(repr(l) for l in wanted)}]",
                 "label_key": label_key,
-                "available_labels_str": sorted(seen),
+                "available_labels_str": _available_labels(ds, label_key),
             },
             400,
         )
+    class_index = {name: i for i, name in enumerate(class_names)}
+    rows = [i for i, l in enumerate(labels) if l in class_index]
+    label_ids = [class_index[labels[i]] for i in rows]
+    class_examples = [0] * len(class_names)
+    for c in label_ids:
+        class_examples[c] += 1
+    # With the activation cache, every text is an example (cache is label-independent);
+    # otherwise only labelled rows are run.
+    if not activation_cache:
+        texts = [texts[i] for i in rows]
+        rows = list(range(len(texts)))
 
     # Load model (do not move model; it may be offloaded to cpu/disk)
     tokenizer, model = load_llm(model_key)
@@ -291,7 +947,12 @@ def run_residual_concept_detection(
     num_layers = _get_num_layers(model, layer_base)
     if num_layers <= 0:
         return ({"error": f"Cannot discover num_layers for layer_base={layer_base!r}"}, 400)
-    output_keys = _build_hook_names_residual(layer_config, num_layers)
+    try:
+        layer_indices = parse_layer_selection(layers, num_layers)
+        hook_kinds = parse_hook_kinds(hook_kinds)
+    except ValueError as e:
+        return ({"error": str(e)}, 400)
+    output_keys = _build_hook_names_residual(layer_config, num_layers, layer_indices, hook_kinds)
     if not output_keys:
         return ({"error": "Failed to build hook names from layer_config"}, 400)
 
@@ -316,52 +977,223 @@ def run_residual_concept_detection(
         return ({"error": "Cannot determine model hidden size"}, 500)
 
     # Resolve token_location
-    if token_location == "full":
-        pass
-    elif isinstance(token_location, str) and token_location.strip().lower() == "full":
-        token_location = "full"
-    else:
-        try:
-            if isinstance(token_location, list):
-                token_location = [int(x) for x in token_location]
-            else:
-                parts = str(token_location).replace(",", " ").split()
-                token_location = [int(x) for x in parts if x.strip()]
-        except (ValueError, TypeError):
-            token_location = "full"
-
-    # Get outputs: attn=MLP input, mlp=block output per layer (sums, counts)
-    layer_outputs = _get_layer_outputs_residual(
-        model, tokenizer, texts, layer_config, num_layers, output_keys,
-        token_location, device, batch_size,
-        progress_callback=progress_callback,
-    )
+    try:
+        token_location = parse_token_location(token_location)
+    except (ValueError, TypeError) as e:
+        return ({"error": str(e)}, 400)
+    if token_location == "user_span" and not getattr(tokenizer, "chat_template", None):
+        return ({"error": "token_location 'user_span' needs a tokenizer with a chat template"}, 400)
+
+    cache = None
+    capture_keys = output_keys
+    if activation_cache:
+        from python.xai_2.activation_cache import ActivationCache, cache_key, texts_fingerprint
+
+        fingerprint = texts_fingerprint(texts)
+        location_key = token_location if isinstance(token_location, str) else {"relative": token_location}
+        cache = ActivationCache(
+            cache_key(model_key, treatment, fingerprint, location_key, MAX_TOKEN_LENGTH, layer_config),
+            len(texts),
+            hidden_size,
+            info={"model": model_key, "treatment": treatment, "examples": fingerprint, "token_location": location_key},
+        )
+        capture_keys = cache.missing(output_keys)
+
+    # Covariance for lda / whitened_mean streams alongside the class sums
+    second_order: Optional[Dict[str, SecondOrderStats]] = None
+    second_order_rank: Optional[int] = None
+    if estimator in ("lda", "whitened_mean"):
+        second_order = {}
+        second_order_rank = choose_rank(covariance, int(hidden_size), len(output_keys))
+
+    # Tokenize once, then batch by length so short texts are not padded to long ones
+    batches: List[List[int]] = []
+    layer_outputs: Dict[str, Tuple[torch.Tensor, torch.Tensor]] = {}
+    start_batch = 0
+    if capture_keys:
+        spans: Optional[List[Tuple[int, int]]] = None
+        if token_location == "user_span":
+            try:
+                input_ids, spans = _tokenize_user_spans(tokenizer, texts)
+            except ValueError as e:
+                return ({"error": str(e)}, 400)
+        else:
+            input_ids = _tokenize_texts(tokenizer, texts)
+        batches = _length_batches([len(ids) for ids in input_ids], batch_size, max_batch_tokens)
+
+        # Get outputs: attn=MLP input, mlp=block output per layer (sums, counts)
+        if num_workers > 1 and len(batches) > 1:
+            from python.xai_2.parallel_capture import capture_parallel
+
+            if cache is not None:
+                cache.begin(capture_keys)
+            try:
+                layer_outputs = capture_parallel(
+                    num_workers=num_workers,
+                    model_key=model_key,
+                    treatment=treatment,
+                    input_ids=input_ids,
+                    batches=batches,
+                    label_ids=label_ids,
+                    num_classes=len(class_names),
+                    layer_config=layer_config,
+                    num_layers=num_layers,
+                    output_keys=capture_keys,
+                    token_location=token_location,
+                    spans=spans,
+                    cache=cache,
+                    second_order=second_order,
+                    second_order_rank=second_order_rank,
+                    progress_callback=progress_callback,
+                    should_stop=should_stop,
+                    parent_device=device,
+                )
+            except RunCancelled as e:
+                if cache is not None:
+                    cache.abort()
+                return (
+                    {
+                        "error": f"Cancelled after {e.next_batch}/{e.total_batches} batches (parallel runs are not checkpointed)",
+                        "cancelled": True,
+                    },
+                    409,
+                )
+            except RuntimeError as e:
+                if cache is not None:
+                    cache.abort()
+                return ({"error": str(e)}, 500)
+            except BaseException:
+                if cache is not None:
+                    cache.abort()
+                raise
+            if cache is not None:
+                cache.commit()
+        else:
+            # Serial runs checkpoint their partial sums and resume from the last checkpoint
+            from python.xai_2.activation_cache import texts_fingerprint
+
+            if second_order is not None and cache is None:
+                width = second_order_rank or int(hidden_size)
+                state_bytes = len(capture_keys) * int(hidden_size) * width * 4 * (2 if second_order_rank else 1)
+                if state_bytes > run_checkpoint.MAX_SECOND_ORDER_BYTES:
+                    checkpoint_every = 0
+
+            run_key = run_checkpoint.checkpoint_key(
+                {
+                    "model": model_key,
+                    "treatment": treatment,
+                    "data": data_fingerprint,
+                    "examples": texts_fingerprint(texts),
+                    "labels": None if cache is not None else texts_fingerprint([str(c) for c in label_ids]),
+                    "classes": class_names,
+                    "token_location": token_location,
+                    "max_length": MAX_TOKEN_LENGTH,
+                    "modules": {k: layer_config.get(k) for k in ("layer_base", "attn_name", "mlp_name")},
+                    "keys": capture_keys,
+                    "batches": texts_fingerprint([",".join(map(str, b)) for b in batches]),
+                    "second_order": None if second_order is None else (second_order_rank or "exact"),
+                    "cache": cache.key if cache is not None else None,
+                }
+            )
+            state = run_checkpoint.load_checkpoint(run_key) if resume and checkpoint_every > 0 else None
+            if state is not None:
+                start_batch = min(int(state["next_batch"]), len(batches))
+            if cache is not None:
+                # An interrupted cache run continues in its .tmp files; without them, start over
+                resume_run = state.get("cache_run") if state is not None and start_batch > 0 else None
+                if not cache.begin(capture_keys, resume_run=resume_run):
+                    start_batch = 0
+                elif state is not None:
+                    cache.mark_written(state["written"])
+            elif state is not None and start_batch > 0:
+                if second_order is not None:
+                    second_order.update(state["second_order"] or {})
+
+            def save_checkpoint(next_batch, stats):
+                if cache is not None:
+                    run_checkpoint.save_checkpoint(
+                        run_key, next_batch, {}, written=cache.flush(), cache_run=cache.run_id
+                    )
+                else:
+                    run_checkpoint.save_checkpoint(run_key, next_batch, stats, second_order)
+
+            try:
+                layer_outputs = _get_layer_outputs_residual(
+                    model, tokenizer, input_ids, batches,
+                    None if cache is not None else label_ids,
+                    0 if cache is not None else len(class_names),
+                    layer_config, num_layers, capture_keys, token_location, device,
+                    progress_callback=progress_callback,
+                    example_sink=cache.write if cache is not None else None,
+                    spans=spans,
+                    second_order=None if cache is not None else second_order,
+                    second_order_rank=second_order_rank,
+                    start_batch=start_batch,
+                    resume_stats=state["stats"] if state is not None and cache is None and start_batch > 0 else None,
+                    should_stop=should_stop,
+                    checkpoint=save_checkpoint if checkpoint_every > 0 else None,
+                    checkpoint_every=checkpoint_every,
+                )
+            except RunCancelled as e:
+                if checkpoint_every <= 0:
+                    if cache is not None:
+                        cache.abort()
+                    return ({"error": str(e), "cancelled": True}, 409)
+                return (
+                    {
+                        "error": f"{e}; run again with the same settings and resume on to continue from there",
+                        "cancelled": True,
+                        "next_batch": e.next_batch,
+                        "total_batches": e.total_batches,
+                    },
+                    409,
+                )
+            except BaseException:
+                if cache is not None:
+                    cache.abort()
+                raise
+            if cache is not None:
+                cache.commit()
+            run_checkpoint.clear_checkpoint(run_key)
+    if cache is not None:
+        cached_keys = [k for k in output_keys if k in cache.keys]
+        if cached_keys:
+            layer_outputs = cache.class_stats(
+                cached_keys, rows, label_ids, len(class_names), second_order, second_order_rank
+            )
     if not layer_outputs:
         return ({"error": "No layer outputs captured. Check layer module names."}, 400)
 
-    # Split by label and compute positive - negative mean (weighted by token counts)
-    pos_mask = [l == positive_label for l in labels]
-    neg_mask = [l == negative_label for l in labels]
-    pos_indices = [i for i, m in enumerate(pos_mask) if m]
-    neg_indices = [i for i, m in enumerate(neg_mask) if m]
-    if not pos_indices or not neg_indices:
-        return ({"error": f"Need both positive and negative examples. Got {len(pos_indices)} pos, {len(neg_indices)} neg"}, 400)
-
-    pos_idx = torch.tensor(pos_indices, dtype=torch.long)
-    neg_idx = torch.tensor(neg_indices, dtype=torch.long)
-
-    directions: Dict[str, List[float]] = {}
-    for layer_name, (sums, counts) in layer_outputs.items():
-        sums_f = sums.float()
-        counts_f = counts.float().clamp(min=1e-12)
-        pos_sum = sums_f[pos_idx].sum(dim=0)
-        pos_cnt = counts_f[pos_idx].sum()
-        neg_sum = sums_f[neg_idx].sum(dim=0)
-        neg_cnt = counts_f[neg_idx].sum()
-        pos_mean = pos_sum / pos_cnt.clamp(min=1e-12)
-        neg_mean = neg_sum / neg_cnt.clamp(min=1e-12)
-        direction = (pos_mean - neg_mean).cpu().tolist()
-        directions[layer_name] = direction
+    # Directions on demand from the per-label statistics (token-weighted means)
+    probe_report: Optional[Dict[str, Dict[str, Any]]] = None
+    try:
+        direction_sets = compute_directions(
+            layer_outputs, class_names, direction_mode, positive_label, negative_label, label_pairs,
+            "mean_diff" if estimator == PROBE_ESTIMATOR else estimator, second_order, shrinkage,
+        )
+        if estimator == PROBE_ESTIMATOR:
+            direction_sets, probe_report = train_probe_directions(
+                cache, list(layer_outputs), rows, label_ids, class_names, direction_mode,
+                positive_label, negative_label, label_pairs, direction_sets, device,
+            )
+    except ValueError as e:
+        return ({"error": str(e)}, 400)
+    direction_sets_json = {
+        name: {key: vec.tolist() for key, vec in vecs.items()} for name, vecs in direction_sets.items()
+    }
+    directions = next(iter(direction_sets_json.values()), {})
+    stats_id = store_label_stats(
+        layer_outputs,
+        class_names,
+        class_examples,
+        {
+            "model": model_key,
+            "treatment": treatment,
+            "label_key": label_key,
+            "text_key": text_key,
+            "second_order": {k: v.cpu() for k, v in second_order.items()} if second_order else None,
+        },
+    )
 
     num_keys = len(directions)
     model_dim = len(next(iter(directions.values()), [])) if directions else 0
@@ -370,13 +1202,36 @@ def run_residual_concept_detection(
         {
             "status": "ok",
             "directions": directions,
+            "direction_mode": direction_mode,
+            "estimator": estimator,
+            "covariance": (
+                ("exact" if second_order_rank is None else f"sketch (rank {second_order_rank})")
+                if second_order is not None
+                else None
+            ),
+            "shrinkage": shrinkage if second_order is not None else None,
+            "probe": probe_report,
+            "direction_sets": direction_sets_json if direction_mode != "pair" else None,
+            "labels": [{"label": name, "n_examples": n} for name, n in zip(class_names, class_examples)],
+            "stats_id": stats_id,
             "num_keys": num_keys,
             "model_dim": model_dim,
-            "n_positive": len(pos_indices),
-            "n_negative": len(neg_indices),
-            "total_examples": len(texts),
+            "n_positive": class_examples[class_index[positive_label]] if positive_label in class_index else 0,
+            "n_negative": class_examples[class_index[negative_label]] if negative_label in class_index else 0,
+            "total_examples": len(rows),
             "batch_size": int(batch_size),
-            "num_batches": (len(texts) + int(batch_size) - 1) // int(batch_size) if batch_size else len(texts),
+            "num_batches": len(batches),
+            "max_batch_tokens": max_batch_tokens,
+            "num_workers": int(num_workers),
+            "resumed_from_batch": start_batch,
+            "checkpoint_every": int(checkpoint_every),
+            "layers": layer_indices,
+            "hook_kinds": hook_kinds,
+            "activation_cache": (
+                {"key": cache.key, "hit": not capture_keys, "captured_keys": len(capture_keys), "num_examples": len(texts)}
+                if cache is not None
+                else None
+            ),
             "layer_base": layer_config.get("layer_base"),
             "attn_name": layer_config.get("attn_name"),
             "mlp_name": layer_config.get("mlp_name"),
@@ -0,0 +1,90 @@
+"""
+On-disk checkpoints of partial Residual Concept Detection runs.
+
+A checkpoint holds the index of the next batch to run plus the partial per-class sums /
+counts (and SecondOrderStats) accumulated so far, under data/residual_checkpoints/<key>.pt.
+The key covers everything that decides the batches and what they add up to (model,
+treatment, texts, labels, batches, token location, hook points), so a rerun with the same
+settings resumes where the last one stopped (only when the caller asks to resume). Newest
+MAX_CHECKPOINTS are kept. Second-order state is only checkpointed up to
+MAX_SECOND_ORDER_BYTES; callers turn checkpointing off above that.
+"""
+
+from __future__ import annotations
+
+import copy
+import hashlib
+import json
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import torch
+
+
+CHECKPOINT_DIR = Path(__file__).resolve().parent.parent.parent / "data" / "residual_checkpoints"
+CHECKPOINT_EVERY = 20
+MAX_CHECKPOINTS = 8
+MAX_SECOND_ORDER_BYTES = 256 << 20
+
+
+def dataset_fingerprint(ds: Any) -> list:
+    """(file, size, mtime) of the dataset's backing Arrow files, so rewritten data never resumes."""
+    out = []
+    for entry in getattr(ds, "cache_files", None) or []:
+        name = entry.get("filename") if isinstance(entry, dict) else None
+        if not name:
+            continue
+        try:
+            st = Path(name).stat()
+            out.append([name, st.st_size, st.st_mtime])
+        except OSError:
+            out.append([name, None, None])
+    return out
+
+
+def checkpoint_key(parts: Dict[str, Any]) -> str:
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def load_checkpoint(key: str) -> Optional[Dict[str, Any]]:
+    path = CHECKPOINT_DIR / f"{key}.pt"
+    if not path.exists():
+        return None
+    try:
+        return torch.load(path, map_location="cpu", weights_only=False)
+    except Exception:  # noqa: BLE001
+        return None
+
+
+def save_checkpoint(
+    key: str,
+    next_batch: int,
+    stats: Dict[str, Any],
+    second_order: Optional[Dict[str, Any]] = None,
+    written: Optional[list] = None,
+    cache_run: Optional[str] = None,
+) -> None:
+    """
+    Atomically write the checkpoint; stats / second_order are copied to the host.
+    cache_run is the activation-cache run_id whose .tmp files hold the rows written so far.
+    """
+    CHECKPOINT_DIR.mkdir(parents=True, exist_ok=True)
+    state = {
+        "next_batch": int(next_batch),
+        "stats": {k: (s.cpu(), n.cpu()) for k, (s, n) in stats.items()},
+        "second_order": {k: copy.copy(v).cpu() for k, v in second_order.items()} if second_order else None,
+        "written": list(written or []),
+        "cache_run": cache_run,
+    }
+    tmp = CHECKPOINT_DIR / f"{key}.tmp.pt"
+    torch.save(state, tmp)
+    tmp.replace(CHECKPOINT_DIR / f"{key}.pt")
+    stored = sorted(CHECKPOINT_DIR.glob("*.pt"), key=lambda p: p.stat().st_mtime)
+    stored = [p for p in stored if not p.name.endswith(".tmp.pt")]
+    for old in stored[: max(0, len(stored) - MAX_CHECKPOINTS)]:
+        old.unlink(missing_ok=True)
+
+
+def clear_checkpoint(key: str) -> None:
+    (CHECKPOINT_DIR / f"{key}.pt").unlink(missing_ok=True)
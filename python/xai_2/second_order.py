@@ -0,0 +1,147 @@
+"""
+Streaming second-order statistics for concept-direction estimators (LDA, whitened mean).
+
+Per hook point, SecondOrderStats keeps per-class example counts and means plus the pooled
+within-class scatter of per-example pooled activations, merged batch by batch with Chan's
+parallel update (batch-centred scatter + a rank-C correction for the shift of each class
+mean), so nothing per example is stored and fp32 stays accurate with large activation offsets.
+
+The scatter is either exact (hidden x hidden) or, for large dims, a Nyström sketch
+S @ Omega (hidden x rank) with a fixed Gaussian Omega plus the exact diagonal. Both are linear in
+the scatter, so the same Chan merge applies.
+"""
+
+from __future__ import annotations
+
+from typing import Optional, Tuple
+
+import torch
+
+
+ESTIMATORS = ("mean_diff", "lda", "whitened_mean")
+COVARIANCE_MODES = ("auto", "exact", "sketch")
+SKETCH_RANK = 128
+EXACT_BUDGET_BYTES = 1 << 30
+
+
+def choose_rank(covariance: str, hidden_size: int, num_keys: int) -> Optional[int]:
+    """None = exact scatter; otherwise the sketch rank. "auto" is exact while all keys fit the budget."""
+    if covariance == "exact":
+        return None
+    if covariance == "sketch":
+        return min(SKETCH_RANK, hidden_size)
+    exact_bytes = 4 * hidden_size * hidden_size * max(num_keys, 1)
+    return None if exact_bytes <= EXACT_BUDGET_BYTES else min(SKETCH_RANK, hidden_size)
+
+
+class SecondOrderStats:
+    def __init__(
+        self,
+        num_classes: int,
+        hidden_size: int,
+        device: torch.device,
+        rank: Optional[int] = None,
+        seed: int = 0,
+    ):
+        self.rank = rank
+        self.count = torch.zeros(num_classes, dtype=torch.float32, device=device)
+        self.mean = torch.zeros(num_classes, hidden_size, dtype=torch.float32, device=device)
+        self.diag = torch.zeros(hidden_size, dtype=torch.float32, device=device)
+        if rank is None:
+            self.omega = None
+            self.scatter = torch.zeros(hidden_size, hidden_size, dtype=torch.float32, device=device)
+        else:
+            gen = torch.Generator().manual_seed(seed)
+            self.omega = torch.randn(hidden_size, rank, generator=gen).to(device)
+            self.scatter = torch.zeros(hidden_size, rank, dtype=torch.float32, device=device)
+
+    def _project(self, m: torch.Tensor) -> torch.Tensor:
+        return m if self.omega is None else m @ self.omega
+
+    def update(self, x: torch.Tensor, labels: torch.Tensor) -> None:
+        """Merge a batch of per-example vectors x (B, hidden) with class ids labels (B,)."""
+        if x.shape[0] == 0:
+            return
+        x = x.float()
+        num_classes = self.count.shape[0]
+        b_count = torch.zeros(num_classes, dtype=torch.float32, device=x.device).index_add_(
+            0, labels, torch.ones_like(labels, dtype=torch.float32)
+        )
+        b_sum = torch.zeros_like(self.mean).index_add_(0, labels, x)
+        b_mean = b_sum / b_count.clamp(min=1.0).unsqueeze(-1)
+        centred = x - b_mean[labels]
+        total = self.count + b_count
+        # Chan: shift of each class mean, weighted n_a * n_b / (n_a + n_b)
+        delta = b_mean - self.mean
+        w = (self.count * b_count / total.clamp(min=1.0)).unsqueeze(-1)
+        self.scatter += centred.T @ self._project(centred) + (w * delta).T @ self._project(delta)
+        self.diag += (centred * centred).sum(dim=0) + (w * delta * delta).sum(dim=0)
+        self.mean += delta * (b_count / total.clamp(min=1.0)).unsqueeze(-1)
+        self.count = total
+
+    def merge(self, other: "SecondOrderStats") -> None:
+        """Add the statistics of a disjoint set of examples (same classes, hidden size and sketch)."""
+        other_count = other.count.to(self.count.device)
+        other_mean = other.mean.to(self.mean.device)
+        total = self.count + other_count
+        delta = other_mean - self.mean
+        w = (self.count * other_count / total.clamp(min=1.0)).unsqueeze(-1)
+        self.scatter += other.scatter.to(self.scatter.device) + (w * delta).T @ self._project(delta)
+        self.diag += other.diag.to(self.diag.device) + (w * delta * delta).sum(dim=0)
+        self.mean += delta * (other_count / total.clamp(min=1.0)).unsqueeze(-1)
+        self.count = total
+
+    def to(self, device: torch.device) -> "SecondOrderStats":
+        for name in ("count", "mean", "diag", "scatter", "omega"):
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, value.to(device))
+        return self
+
+    def cpu(self) -> "SecondOrderStats":
+        return self.to(torch.device("cpu"))
+
+    def _spectrum(self, shrinkage: float) -> Tuple[torch.Tensor, torch.Tensor, float]:
+        """
+        Shrunk within-class covariance as (U, eig, floor): U diag(eig) U^T on span(U) and
+        floor * I on its complement. shrinkage pulls towards (trace / hidden) * I.
+        """
+        hidden = self.diag.shape[0]
+        dof = max(float(self.count.sum().item()) - int((self.count > 0).sum().item()), 1.0)
+        diag = self.diag / dof
+        avg = max(float(diag.mean().item()), 1e-12)
+        alpha = min(max(float(shrinkage), 0.0), 1.0)
+        if self.omega is None:
+            eig, u = torch.linalg.eigh(self.scatter / dof)
+            eig = eig.clamp(min=0.0)
+            eig = (1.0 - alpha) * eig + alpha * avg
+            return u, eig.clamp(min=avg * 1e-6), avg
+        # Nyström: S ~ Y (Omega^T Y)^+ Y^T with Y = S Omega
+        y = self.scatter / dof
+        core = self.omega.T @ y
+        core = 0.5 * (core + core.T)
+        c_eig, c_vec = torch.linalg.eigh(core)
+        keep = c_eig > c_eig.max().clamp(min=1e-12) * 1e-6
+        b = y @ (c_vec[:, keep] / c_eig[keep].sqrt())
+        u, sv, _ = torch.linalg.svd(b, full_matrices=False)
+        lam = sv * sv
+        residual = max((float(diag.sum().item()) - float(lam.sum().item())) / max(hidden - lam.shape[0], 1), 0.0)
+        eig = (1.0 - alpha) * (lam + residual) + alpha * avg
+        floor = (1.0 - alpha) * residual + alpha * avg
+        return u, eig.clamp(min=avg * 1e-6), max(floor, avg * 1e-6)
+
+    def whitener(self, estimator: str, shrinkage: float = 0.1):
+        """
+        v (hidden,) -> Sigma^-1 v (lda) or Sigma^-1/2 v (whitened_mean), rescaled to |v|.
+        """
+        power = -1.0 if estimator == "lda" else -0.5
+        u, eig, floor = self._spectrum(shrinkage)
+
+        def apply(v: torch.Tensor) -> torch.Tensor:
+            v = v.float().to(u.device)
+            coeff = u.T @ v
+            out = u @ (coeff * eig.pow(power)) + (v - u @ coeff) * (floor ** power)
+            norm = out.norm()
+            return out * (v.norm() / norm) if norm > 0 else out
+
+        return apply
@@ -13,8 +13,12 @@ from python.xai_1.adversarial_text_generation import (
     DEFAULT_PREFIX_LEN,
     MAX_ITERATIONS,
     MAX_PREFIX_LEN,
-    find_adversarial_prefix,
+    MAX_SOFT_PROMPT_STEPS,
+    find_adversarial_prefixes,
+    find_universal_prefix,
 )
+from python.xai_1.gcg import DEFAULT_SEARCH_WIDTH, DEFAULT_TOP_K, MAX_SEARCH_WIDTH, MAX_TOP_K, PLACEMENTS
+from python.xai_1.vocab_filter import parse_token_filters
 
 
 def _parse_integer(value: Any, default: int, min_value: int, max_value: int) -> int:
@@ -25,6 +29,21 @@ def _parse_integer(value: Any, default: int, min_value: int, max_value: int) ->
     return max(min(iv, max_value), min_value)
 
 
+def _parse_bool(value: Any, default: bool = False) -> bool:
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        v = value.strip().lower()
+        if v in ("1", "true", "yes", "on"):
+            return True
+        if v in ("0", "false", "no", "off", ""):
+            return False
+        return default
+    return bool(value)
+
+
 def _parse_seed_ids(value: Any) -> List[int]:
     if value is None:
         return []
@@ -82,6 +101,78 @@ def _normalize_rows(value: Any) -> List[Dict[str, Any]]:
     return parsed
 
 
+# Settings a resumed search may change; everything else comes from the checkpoint.
+_RESUME_OVERRIDES = ("iterations", "patience", "early_stop", "checkpoint_every")
+
+
+def _load_adversarial_payload(name: str) -> Dict[str, Any] | None:
+    from python.memory.variable import get_adversarial_variable, load_variable_pickle
+
+    if not get_adversarial_variable(name):
+        return None
+    payload = load_variable_pickle(name)
+    if not isinstance(payload, dict) or payload.get("type") != "adversarial":
+        return None
+    return payload
+
+
+def _adversarial_checkpointer(
+    *,
+    checkpoint_id: str | None,
+    input_setting: Dict[str, Any],
+    mode: str,
+    model_key: str,
+    row_ids: List[str],
+    prefix_length: int,
+):
+    """
+    checkpoint_callback for a gcg search that upserts one adversarial variable (summary JSON +
+    pickled state). Returns (save(state, status="running"), info); info["id"] is the variable id.
+    """
+    from python.memory.variable import save_adversarial_checkpoint
+
+    stored_setting = {k: v for k, v in input_setting.items() if k not in ("resume_from", "warm_start_from")}
+    info: Dict[str, Any] = {"id": checkpoint_id, "state": None}
+
+    def save(state: Dict[str, Any], status: str = "running") -> None:
+        best = state["best_ids"].view(len(row_ids), -1).tolist()
+        losses = state["best_loss"] if isinstance(state["best_loss"], list) else [state["best_loss"]]
+        finite = [x for x in losses if x is not None and x != float("inf")]
+        info["id"] = save_adversarial_checkpoint(
+            payload={
+                "type": "adversarial",
+                "mode": mode,
+                "input_setting": stored_setting,
+                "state": state,
+                "results": [
+                    {"row_id": row_id, "prefix_ids": best[j], "loss": losses[j]} for j, row_id in enumerate(row_ids)
+                ],
+            },
+            summary={
+                "status": status,
+                "iterations_run": state["step"],
+                "best_loss": min(finite) if finite else None,
+            },
+            task_name=(input_setting.get("task_name") or "").strip() or "Adversarial",
+            model=model_key,
+            mode=mode,
+            num_rows=len(row_ids),
+            prefix_length=prefix_length,
+            uid=info["id"],
+        )
+        info["state"] = state
+
+    return save, info
+
+
+def _warm_start_ids(payload: Dict[str, Any]) -> tuple[Dict[str, List[int]], List[int]]:
+    """(best prefix ids by row_id, overall lowest-loss prefix ids) of a checkpoint."""
+    results = [r for r in payload.get("results") or [] if r.get("prefix_ids")]
+    by_row = {r["row_id"]: list(r["prefix_ids"]) for r in results}
+    ranked = sorted(results, key=lambda r: r["loss"] if r.get("loss") is not None else float("inf"))
+    return by_row, (list(ranked[0]["prefix_ids"]) if ranked else [])
+
+
 def run_attribution(
     *,
     model: str,
@@ -91,9 +182,11 @@ def run_attribution(
     system_instruction: str,
     attribution_method: str,
     input_setting: Dict[str, Any],
+    progress_callback=None,
 ) -> tuple[Dict[str, Any], int]:
     """
     Handle response attribution (1.0.1).
+    progress_callback receives streamed partial results (e.g. attribution matrix rows).
     Returns (result_dict, status_code).
     """
     try:
@@ -103,6 +196,15 @@ def run_attribution(
         top_k = int(input_setting.get("top_k", 50))
     except (TypeError, ValueError):
         return ({"error": "Invalid input_setting: temperature, max_new_tokens, top_p, top_k must be numbers"}, 400)
+    matrix_chunk_size = _parse_integer(input_setting.get("matrix_chunk_size"), 16, 1, 1024)
+    gradient_checkpointing = _parse_bool(input_setting.get("gradient_checkpointing"))
+    occlusion_span = _parse_integer(input_setting.get("occlusion_span"), 1, 1, 512)
+    occlusion_mode = (input_setting.get("occlusion_mode") or "mask").strip()
+    occlusion_batch_size = _parse_integer(input_setting.get("occlusion_batch_size"), 0, 0, 4096)
+    positive_response = (input_setting.get("positive_response") or "").strip()
+    negative_response = (input_setting.get("negative_response") or "").strip()
+    if attribution_method.lower() == "contrastive_grad" and (not positive_response or not negative_response):
+        return ({"error": "positive_response and negative_response are required for contrastive_grad"}, 400)
 
     try:
         from python.xai_1.input_attribution import compute_input_attribution
@@ -116,6 +218,14 @@ def run_attribution(
             top_p=top_p,
             top_k=top_k,
             attribution_method=attribution_method,
+            matrix_chunk_size=matrix_chunk_size,
+            progress_callback=progress_callback,
+            gradient_checkpointing=gradient_checkpointing,
+            occlusion_span=occlusion_span,
+            occlusion_mode=occlusion_mode,
+            occlusion_batch_size=occlusion_batch_size,
+            positive_response=positive_response,
+            negative_response=negative_response,
         )
         result["status"] = "ok"
         result["model"] = model
@@ -131,22 +241,94 @@ def run_adversarial_text_generation(
     treatment: str,
     current_model: str,
     input_setting: Dict[str, Any],
+    progress_callback=None,
+    should_stop=None,
 ) -> tuple[Dict[str, Any], int]:
+    """
+    GCG adversarial prefix/suffix search for every row of adversarial_rows (or one universal
+    prefix for a dataset variable when mode="universal").
+    progress_callback receives one progress event per iteration (best loss and prefix per row,
+    elapsed time); should_stop() cancels the search and the best prefixes so far are returned.
+    checkpoint_every > 0 checkpoints the search state into an adversarial variable;
+    resume_from (such a variable) continues that search with its stored rows and settings
+    (only iterations / patience / early_stop / checkpoint_every may change), and
+    warm_start_from seeds rows without seed ids from another run's best prefixes.
+    """
+    resume_state = None
+    checkpoint_id = None
+    resume_from = (input_setting.get("resume_from") or "").strip()
+    if resume_from:
+        payload = _load_adversarial_payload(resume_from)
+        if payload is None:
+            return ({"error": f"Adversarial checkpoint not found: {resume_from!r}"}, 404)
+        from python.memory.variable import variable_store
+
+        overrides = {k: input_setting[k] for k in _RESUME_OVERRIDES if k in input_setting}
+        input_setting = {**payload["input_setting"], **overrides}
+        resume_state = payload["state"]
+        checkpoint_id = variable_store.resolve_id(resume_from, preferred_type="adversarial")
+
+    warm_by_row: Dict[str, List[int]] = {}
+    warm_best: List[int] = []
+    warm_start_from = (input_setting.get("warm_start_from") or "").strip()
+    if warm_start_from and resume_state is None:
+        payload = _load_adversarial_payload(warm_start_from)
+        if payload is None:
+            return ({"error": f"Adversarial checkpoint not found: {warm_start_from!r}"}, 404)
+        warm_by_row, warm_best = _warm_start_ids(payload)
+
+    if (input_setting.get("mode") or "").strip().lower() == "universal":
+        return run_universal_adversarial(
+            model=model,
+            treatment=treatment,
+            current_model=current_model,
+            input_setting=input_setting,
+            progress_callback=progress_callback,
+            should_stop=should_stop,
+            resume_state=resume_state,
+            checkpoint_id=checkpoint_id,
+            warm_start_ids=warm_best,
+        )
+
     rows = _normalize_rows(input_setting.get("adversarial_rows"))
     if not rows:
         return ({"error": "adversarial_rows is required (list of {input_string, target_text})."}, 400)
 
     prefix_length = _parse_integer(input_setting.get("prefix_length"), DEFAULT_PREFIX_LEN, 1, MAX_PREFIX_LEN)
     iterations = _parse_integer(input_setting.get("iterations"), DEFAULT_ITERATIONS, 1, MAX_ITERATIONS)
+    gradient_checkpointing = _parse_bool(input_setting.get("gradient_checkpointing"))
+    placement = (input_setting.get("placement") or "prefix").strip().lower()
+    if placement not in PLACEMENTS:
+        return ({"error": f"placement must be one of {', '.join(PLACEMENTS)}"}, 400)
+    search_width = _parse_integer(input_setting.get("search_width"), DEFAULT_SEARCH_WIDTH, 1, MAX_SEARCH_WIDTH)
+    top_k = _parse_integer(input_setting.get("top_k"), DEFAULT_TOP_K, 1, MAX_TOP_K)
+    eval_batch_size = _parse_integer(input_setting.get("eval_batch_size"), 0, 0, MAX_SEARCH_WIDTH)
+    seed = input_setting.get("seed")
+    seed = _parse_integer(seed, 0, 0, 2**31 - 1) if seed not in (None, "") else None
+    token_filter = parse_token_filters(input_setting.get("token_filter"))
+
+    early_stop = _parse_bool(input_setting.get("early_stop"), default=True)
+    patience = _parse_integer(input_setting.get("patience"), 0, 0, MAX_ITERATIONS)
+    checkpoint_every = _parse_integer(input_setting.get("checkpoint_every"), 0, 0, MAX_ITERATIONS)
+    soft_prompt_steps = _parse_integer(input_setting.get("soft_prompt_steps"), 0, 0, MAX_SOFT_PROMPT_STEPS)
+    soft_prompt_compare = _parse_bool(input_setting.get("soft_prompt_compare"))
+    try:
+        soft_prompt_lr = float(input_setting.get("soft_prompt_lr") or 0.1)
+    except (TypeError, ValueError):
+        return ({"error": "Invalid input_setting: soft_prompt_lr must be a number"}, 400)
 
     results: List[Dict[str, Any]] = []
     sanitized_rows: List[Dict[str, Any]] = []
+    search_rows: List[Dict[str, Any]] = []
+    search_slots: List[int] = []
     for idx, row in enumerate(rows):
         row_id = row.get("row_id") or f"row_{idx}"
         input_string = (row.get("input_string") or "").strip()
         target_text = (row.get("target_text") or "").strip()
         seeds = row.get("seed_ids", [])
         seed_text = row.get("seed_text") or ""
+        if not seeds and not seed_text:
+            seeds = warm_by_row.get(row_id) or warm_best
 
         sanitized_rows.append(
             {
@@ -156,46 +338,83 @@ def run_adversarial_text_generation(
                 "seed_ids": seeds,
             }
         )
+        results.append(
+            {
+                "row_id": row_id,
+                "row_index": idx,
+                "input_string": input_string,
+                "target_text": target_text,
+            }
+        )
 
         if not input_string or not target_text:
-            results.append(
-                {
-                    "row_id": row_id,
-                    "row_index": idx,
-                    "input_string": input_string,
-                    "target_text": target_text,
-                    "error": "input_string and target_text are required",
-                }
-            )
+            results[idx]["error"] = "input_string and target_text are required"
             continue
+        search_rows.append(
+            {
+                "input_string": input_string,
+                "target_text": target_text,
+                "seed_ids": seeds,
+                "seed_text": seed_text,
+            }
+        )
+        search_slots.append(idx)
 
+    def on_progress(msg: Dict[str, Any]) -> None:
+        for row in msg["rows"]:
+            row["row_index"] = search_slots[row["row_index"]]
+            row["row_id"] = results[row["row_index"]]["row_id"]
+        progress_callback(msg)
+
+    checkpoint = checkpoint_info = None
+    if search_rows and (checkpoint_every > 0 or resume_state is not None):
+        checkpoint, checkpoint_info = _adversarial_checkpointer(
+            checkpoint_id=checkpoint_id,
+            input_setting=input_setting,
+            mode="rows",
+            model_key=current_model,
+            row_ids=[results[idx]["row_id"] for idx in search_slots],
+            prefix_length=prefix_length,
+        )
+
+    if search_rows:
+        # All valid rows are optimized together in one padded batch.
         try:
-            attack_result = find_adversarial_prefix(
+            attack_results = find_adversarial_prefixes(
                 model_key=current_model,
-                input_string=input_string,
-                target_text=target_text,
+                rows=search_rows,
                 prefix_length=prefix_length,
                 iterations=iterations,
-                initial_prefix_ids=seeds,
-                initial_prefix_text=seed_text,
+                gradient_checkpointing=gradient_checkpointing,
+                placement=placement,
+                search_width=search_width,
+                top_k=top_k,
+                eval_batch_size=eval_batch_size,
+                seed=seed,
+                token_filter=token_filter,
+                early_stop=early_stop,
+                patience=patience,
+                progress_callback=on_progress if progress_callback is not None else None,
+                should_stop=should_stop,
+                resume_state=resume_state,
+                checkpoint_every=checkpoint_every,
+                checkpoint_callback=checkpoint,
+                soft_prompt_steps=soft_prompt_steps,
+                soft_prompt_lr=soft_prompt_lr,
+                soft_prompt_compare=soft_prompt_compare,
             )
-            attack_result["row_id"] = row_id
-            attack_result["row_index"] = idx
-            attack_result["initial_prefix_ids"] = seeds
-            attack_result["seed_text"] = seed_text
-            attack_result["prefix_length"] = prefix_length
-            attack_result["iterations"] = iterations
-            results.append(attack_result)
         except Exception as exc:
-            results.append(
-                {
-                    "row_id": row_id,
-                    "row_index": idx,
-                    "input_string": input_string,
-                    "target_text": target_text,
-                    "error": str(exc),
-                }
-            )
+            attack_results = [{"error": str(exc)} for _ in search_rows]
+        if checkpoint_info and checkpoint_info["state"] is not None:
+            cancelled = any(r.get("stop_reason") == "cancelled" for r in attack_results)
+            checkpoint(checkpoint_info["state"], status="cancelled" if cancelled else "finished")
+        for idx, search_row, attack_result in zip(search_slots, search_rows, attack_results):
+            results[idx].update(attack_result)
+            if "error" not in attack_result:
+                results[idx]["initial_prefix_ids"] = search_row["seed_ids"]
+                results[idx]["seed_text"] = search_row["seed_text"]
+                results[idx]["prefix_length"] = prefix_length
+                results[idx]["iterations"] = iterations
 
     response = {
         "status": "ok",
@@ -203,7 +422,165 @@ def run_adversarial_text_generation(
         "treatment": treatment,
         "prefix_length": prefix_length,
         "iterations": iterations,
+        "gradient_checkpointing": gradient_checkpointing,
+        "placement": placement,
+        "search_width": search_width,
+        "top_k": top_k,
+        "eval_batch_size": eval_batch_size,
+        "seed": seed,
+        "token_filter": ",".join(token_filter),
+        "early_stop": early_stop,
+        "patience": patience,
+        "checkpoint_every": checkpoint_every,
+        "checkpoint_variable_id": checkpoint_info["id"] if checkpoint_info else None,
+        "resumed": resume_state is not None,
+        "soft_prompt_steps": soft_prompt_steps,
+        "soft_prompt_lr": soft_prompt_lr,
+        "soft_prompt_compare": soft_prompt_compare,
+        "cancelled": bool(should_stop is not None and should_stop()),
         "adversarial_rows": sanitized_rows,
         "adversarial_results": results,
     }
     return (response, 200)
+
+
+def run_universal_adversarial(
+    *,
+    model: str,
+    treatment: str,
+    current_model: str,
+    input_setting: Dict[str, Any],
+    progress_callback=None,
+    should_stop=None,
+    resume_state: Dict[str, Any] | None = None,
+    checkpoint_id: str | None = None,
+    warm_start_ids: List[int] | None = None,
+) -> tuple[Dict[str, Any], int]:
+    """
+    One adversarial prefix/suffix for a whole dataset variable (mode="universal").
+    input_setting: variable_name, input_key, target_key, batch_rows, eval_rows, plus the
+    per-row search settings (prefix_length, iterations, placement, search_width, top_k, ...).
+    resume_state / checkpoint_id / warm_start_ids come from run_adversarial_text_generation.
+    """
+    var_name = (input_setting.get("variable_name") or "").strip()
+    input_key = (input_setting.get("input_key") or "").strip()
+    target_key = (input_setting.get("target_key") or "").strip()
+    if not var_name or not input_key or not target_key:
+        return ({"error": "variable_name, input_key and target_key are required for universal mode"}, 400)
+
+    from python.dataset_pipeline_store import get_pipeline_by_id
+    from python.memory.variable import variable_store
+    from python.web.dataset_utils import get_process_function, load_pipeline_dataset
+
+    meta = variable_store.get_meta(var_name)
+    if not meta:
+        return ({"error": f"Variable not found: {var_name!r}"}, 404)
+    pipeline = get_pipeline_by_id(meta.pipeline_id)
+    if not pipeline:
+        return ({"error": f"Pipeline not found: {meta.pipeline_id}"}, 404)
+
+    prefix_length = _parse_integer(input_setting.get("prefix_length"), DEFAULT_PREFIX_LEN, 1, MAX_PREFIX_LEN)
+    iterations = _parse_integer(input_setting.get("iterations"), DEFAULT_ITERATIONS, 1, MAX_ITERATIONS)
+    gradient_checkpointing = _parse_bool(input_setting.get("gradient_checkpointing"))
+    placement = (input_setting.get("placement") or "prefix").strip().lower()
+    if placement not in PLACEMENTS:
+        return ({"error": f"placement must be one of {', '.join(PLACEMENTS)}"}, 400)
+    search_width = _parse_integer(input_setting.get("search_width"), DEFAULT_SEARCH_WIDTH, 1, MAX_SEARCH_WIDTH)
+    top_k = _parse_integer(input_setting.get("top_k"), DEFAULT_TOP_K, 1, MAX_TOP_K)
+    batch_rows = _parse_integer(input_setting.get("batch_rows"), 8, 1, 256)
+    eval_rows = _parse_integer(input_setting.get("eval_rows"), 8, 1, 256)
+    eval_batch_size = _parse_integer(input_setting.get("eval_batch_size"), 0, 0, MAX_SEARCH_WIDTH * 256)
+    seed = input_setting.get("seed")
+    seed = _parse_integer(seed, 0, 0, 2**31 - 1) if seed not in (None, "") else None
+    token_filter = parse_token_filters(input_setting.get("token_filter"))
+    patience = _parse_integer(input_setting.get("patience"), 0, 0, MAX_ITERATIONS)
+    checkpoint_every = _parse_integer(input_setting.get("checkpoint_every"), 0, 0, MAX_ITERATIONS)
+
+    def on_progress(msg: Dict[str, Any]) -> None:
+        for row in msg["rows"]:
+            row["row_id"] = "universal"
+        progress_callback(msg)
+
+    checkpoint = checkpoint_info = None
+    if checkpoint_every > 0 or resume_state is not None:
+        checkpoint, checkpoint_info = _adversarial_checkpointer(
+            checkpoint_id=checkpoint_id,
+            input_setting=input_setting,
+            mode="universal",
+            model_key=current_model,
+            row_ids=["universal"],
+            prefix_length=prefix_length,
+        )
+
+    try:
+        ds, _ = load_pipeline_dataset(pipeline)
+        process_fn = get_process_function(pipeline.get("processing_code") or "")
+    except Exception as e:
+        return ({"error": f"Failed to load dataset: {e}"}, 500)
+
+    try:
+        result = find_universal_prefix(
+            model_key=current_model,
+            ds=ds,
+            input_key=input_key,
+            target_key=target_key,
+            process_fn=process_fn,
+            prefix_length=prefix_length,
+            iterations=iterations,
+            initial_prefix_ids=warm_start_ids or None,
+            initial_prefix_text=(input_setting.get("seed_text") or "").strip() or None,
+            gradient_checkpointing=gradient_checkpointing,
+            placement=placement,
+            search_width=search_width,
+            top_k=top_k,
+            batch_rows=batch_rows,
+            eval_rows=eval_rows,
+            eval_batch_size=eval_batch_size,
+            seed=seed,
+            token_filter=token_filter,
+            patience=patience,
+            progress_callback=on_progress if progress_callback is not None else None,
+            should_stop=should_stop,
+            resume_state=resume_state,
+            checkpoint_every=checkpoint_every,
+            checkpoint_callback=checkpoint,
+        )
+    except ValueError as e:
+        return ({"error": str(e)}, 400)
+    except Exception as e:
+        return ({"error": str(e)}, 500)
+    if checkpoint_info and checkpoint_info["state"] is not None:
+        checkpoint(checkpoint_info["state"], status="cancelled" if result["stop_reason"] == "cancelled" else "finished")
+
+    result["row_id"] = "universal"
+    result["target_text"] = f"{var_name}: {target_key}"
+    return (
+        {
+            "status": "ok",
+            "model": model,
+            "treatment": treatment,
+            "mode": "universal",
+            "variable_name": var_name,
+            "input_key": input_key,
+            "target_key": target_key,
+            "prefix_length": prefix_length,
+            "iterations": iterations,
+            "gradient_checkpointing": gradient_checkpointing,
+            "placement": placement,
+            "search_width": search_width,
+            "top_k": top_k,
+            "batch_rows": batch_rows,
+            "eval_rows": eval_rows,
+            "eval_batch_size": eval_batch_size,
+            "seed": seed,
+            "token_filter": ",".join(token_filter),
+            "patience": patience,
+            "checkpoint_every": checkpoint_every,
+            "checkpoint_variable_id": checkpoint_info["id"] if checkpoint_info else None,
+            "resumed": resume_state is not None,
+            "cancelled": result["stop_reason"] == "cancelled",
+            "adversarial_rows": _normalize_rows(input_setting.get("adversarial_rows")),
+            "adversarial_results": [result],
+        },
+        200,
+    )
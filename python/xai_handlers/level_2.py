@@ -4,7 +4,14 @@ XAI Level 2 API handlers: Internal Mechanism Analysis.
 
 from typing import Any, Dict
 
-from python.xai_2.residual_concept_detection import run_residual_concept_detection
+from python.xai_2.residual_concept_detection import (
+    COVARIANCE_MODES,
+    DIRECTION_ESTIMATORS,
+    DIRECTION_MODES,
+    parse_label_pairs,
+    run_residual_concept_detection,
+)
+from python.xai_handlers.level_1 import _parse_bool
 
 
 def run_residual_concept(
@@ -13,12 +20,23 @@ def run_residual_concept(
     input_setting: Dict[str, Any],
     load_dataset_fn,
     progress_callback=None,
+    treatment: str = "",
+    should_stop=None,
 ) -> tuple[Dict[str, Any], int]:
     """
     Run Residual Concept Detection (2.0.1).
     input_setting: variable_name, text_key, label_key, positive_label, negative_label,
                    layer_base, attn_name, mlp_name, o_proj_name, down_proj_name,
-                   token_location ("full" or "0,1,2"), batch_size.
+                   token_location ("full", "last", "last:k", "first", "user_span" or relative "0,1,-1"), batch_size,
+                   max_batch_tokens (optional; batch by padded token budget instead of rows),
+                   layers ("0-11", "4,8,-1"; blank = all), hook_kinds ("attn_out,mlp_block_out"; blank = all),
+                   activation_cache (reuse/write pooled activations on disk),
+                   direction_mode ("pair" | "pairs" | "one_vs_rest" | "class_mean"), label_pairs ("a:b, c:d"),
+                   estimator ("mean_diff" | "lda" | "whitened_mean" | "probe"), covariance ("auto" | "exact" | "sketch"),
+                   shrinkage (0..1, default 0.1),
+                   num_workers (1 = in process; N > 1 = N worker processes, one model replica each),
+                   checkpoint_every (batches between checkpoints; 0 = off), resume (continue from the last checkpoint; off by default).
+    should_stop: polled between batches (cancel); partial sums are checkpointed for a later resume.
     """
     var_name = (input_setting.get("variable_name") or "").strip()
     if not var_name:
@@ -37,10 +55,33 @@ def run_residual_concept(
 
     text_key = (input_setting.get("text_key") or "").strip()
     label_key = (input_setting.get("label_key") or "").strip()
-    positive_label = (input_setting.get("positive_label") or "").strip()
-    negative_label = (input_setting.get("negative_label") or "").strip()
-    if not all([text_key, label_key, positive_label, negative_label]):
+    positive_label = str(input_setting.get("positive_label") or "").strip()
+    negative_label = str(input_setting.get("negative_label") or "").strip()
+    direction_mode = (input_setting.get("direction_mode") or "pair").strip().lower()
+    if direction_mode not in DIRECTION_MODES:
+        return ({"error": f"direction_mode must be one of {', '.join(DIRECTION_MODES)}"}, 400)
+    label_pairs = parse_label_pairs(input_setting.get("label_pairs"))
+    if not all([text_key, label_key]):
+        return ({"error": "text_key, label_key required"}, 400)
+    if direction_mode == "pair" and not (positive_label and negative_label):
         return ({"error": "text_key, label_key, positive_label, negative_label required"}, 400)
+    if direction_mode == "pairs" and not label_pairs:
+        return ({"error": "label_pairs required for direction_mode 'pairs' (e.g. 'pos:neg, a:b')"}, 400)
+    estimator = (input_setting.get("estimator") or "mean_diff").strip().lower()
+    if estimator not in DIRECTION_ESTIMATORS:
+        return ({"error": f"estimator must be one of {', '.join(DIRECTION_ESTIMATORS)}"}, 400)
+    if estimator == "probe" and direction_mode == "class_mean":
+        return ({"error": "estimator 'probe' needs direction_mode pair, pairs or one_vs_rest"}, 400)
+    covariance = (input_setting.get("covariance") or "auto").strip().lower()
+    if covariance not in COVARIANCE_MODES:
+        return ({"error": f"covariance must be one of {', '.join(COVARIANCE_MODES)}"}, 400)
+    raw_shrinkage = input_setting.get("shrinkage")
+    try:
+        shrinkage = float(raw_shrinkage) if raw_shrinkage is not None and str(raw_shrinkage).strip() != "" else 0.1
+    except (TypeError, ValueError):
+        return ({"error": "shrinkage must be a number in [0, 1]"}, 400)
+    if not 0.0 <= shrinkage <= 1.0:
+        return ({"error": "shrinkage must be a number in [0, 1]"}, 400)
 
     layer_base = (input_setting.get("layer_base") or "").strip()
     attn_name = (input_setting.get("attn_name") or "self_attn").strip()
@@ -69,6 +110,34 @@ def run_residual_concept(
     if batch_size <= 0:
         batch_size = 8
 
+    raw_mbt = input_setting.get("max_batch_tokens")
+    try:
+        max_batch_tokens = int(raw_mbt) if raw_mbt is not None and str(raw_mbt).strip() != "" else None
+    except (TypeError, ValueError):
+        max_batch_tokens = None
+    if max_batch_tokens is not None and max_batch_tokens <= 0:
+        max_batch_tokens = None
+
+    from python.xai_2.parallel_capture import MAX_WORKERS
+
+    raw_workers = input_setting.get("num_workers")
+    try:
+        num_workers = int(raw_workers) if raw_workers is not None and str(raw_workers).strip() != "" else 1
+    except (TypeError, ValueError):
+        return ({"error": f"num_workers must be an integer in [1, {MAX_WORKERS}]"}, 400)
+    if not 1 <= num_workers <= MAX_WORKERS:
+        return ({"error": f"num_workers must be an integer in [1, {MAX_WORKERS}]"}, 400)
+
+    from python.xai_2.run_checkpoint import CHECKPOINT_EVERY
+
+    raw_every = input_setting.get("checkpoint_every")
+    try:
+        checkpoint_every = int(raw_every) if raw_every is not None and str(raw_every).strip() != "" else CHECKPOINT_EVERY
+    except (TypeError, ValueError):
+        return ({"error": "checkpoint_every must be a non-negative integer"}, 400)
+    if checkpoint_every < 0:
+        return ({"error": "checkpoint_every must be a non-negative integer"}, 400)
+
     try:
         ds, _ = load_dataset_fn(pipeline)
     except Exception as e:
@@ -86,6 +155,20 @@ def run_residual_concept(
         token_location=token_location,
         batch_size=batch_size,
         progress_callback=progress_callback,
+        max_batch_tokens=max_batch_tokens,
+        layers=input_setting.get("layers"),
+        hook_kinds=input_setting.get("hook_kinds"),
+        treatment=treatment or "",
+        activation_cache=_parse_bool(input_setting.get("activation_cache"), False),
+        direction_mode=direction_mode,
+        label_pairs=label_pairs,
+        estimator=estimator,
+        covariance=covariance,
+        shrinkage=shrinkage,
+        num_workers=num_workers,
+        should_stop=should_stop,
+        checkpoint_every=checkpoint_every,
+        resume=_parse_bool(input_setting.get("resume"), False),
     )
 
 
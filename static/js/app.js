@@ -65,6 +65,7 @@
   let pendingRunAfterConfirm = null;
   let currentTaskLevel = ""; // Selected task name when creating task
   let runAbortController = null; // abort the current /api/run request when user clicks Stop
+  let runJobId = null; // server-side job of the current stream (cancelled via /api/run/jobs/<id>/cancel)
   let taskLinkNavigateTimeout = null; // delay single-click navigate so double-click can cancel it for rename
   let modelSpecTooltipEl = null;
   let modelSpecShowTimeout = null;
@@ -1207,10 +1208,74 @@
       let res;
       const runBody = { model, treatment, input_setting: inputSetting };
       const isResidualStream = window.PNP_CURRENT_TASK_LEVEL === "Residual Concept Detection" && (inputSetting.variable_name || "").trim();
-
-      if (isResidualStream) {
+      const isMatrixStream = inputSetting.attribution_method === "input_grad_matrix";
+      const isAdversarialStream = inputSetting.adversarial_rows != null;
+      const streamUrl = isResidualStream
+        ? "/api/run/residual-concept-stream"
+        : isMatrixStream
+          ? "/api/run/attribution-matrix-stream"
+          : isAdversarialStream
+            ? "/api/run/adversarial-stream"
+            : null;
+
+      if (streamUrl) {
+        // Events of the server-side job seen so far (the initial "job" event is not counted),
+        // so a dropped stream can re-attach with ?since=n without replaying them.
+        let jobEventsSeen = 0;
+        const handleStreamMessage = (msg) => {
+          if (msg.type === "job") {
+            runJobId = msg.job_id;
+            return;
+          }
+          jobEventsSeen += 1;
+          if (msg.type === "progress" && generationStatus) {
+            generationStatus.textContent = msg.message || "Forward batch " + msg.batch + "/" + msg.total;
+            if (Array.isArray(msg.rows) && typeof window.PNP_onAdversarialProgress === "function") {
+              window.PNP_onAdversarialProgress(msg);
+            }
+          } else if (msg.type === "matrix_meta") {
+            if (typeof window.PNP_onAttributionMatrixMeta === "function") window.PNP_onAttributionMatrixMeta(msg, el.resultsContent);
+          } else if (msg.type === "matrix_rows") {
+            if (generationStatus) {
+              generationStatus.textContent = msg.message || "Attribution rows " + (msg.start + msg.rows.length) + "/" + msg.total;
+            }
+            if (typeof window.PNP_onAttributionMatrixRows === "function") window.PNP_onAttributionMatrixRows(msg, el.resultsContent);
+          } else if (msg.type === "done") {
+            res = { ok: true, ...(msg.result || {}) };
+          } else if (msg.type === "error") {
+            res = { ok: false, error: msg.error };
+          }
+        };
+        const readStream = async (r) => {
+          const reader = r.body.getReader();
+          const decoder = new TextDecoder();
+          let buffer = "";
+          while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const events = buffer.split("\n\n");
+            buffer = events.pop() || "";
+            for (const ev of events) {
+              const dataLine = ev.split("\n").find((l) => l.startsWith("data: "));
+              if (dataLine) {
+                try {
+                  handleStreamMessage(JSON.parse(dataLine.slice(6)));
+                } catch (e) { /* ignore parse */ }
+              }
+            }
+          }
+          if (buffer) {
+            const dataLine = buffer.split("\n").find((l) => l.startsWith("data: "));
+            if (dataLine) {
+              try {
+                handleStreamMessage(JSON.parse(dataLine.slice(6)));
+              } catch (e) { /* ignore */ }
+            }
+          }
+        };
         try {
-          const r = await fetch("/api/run/residual-concept-stream", {
+          const r = await fetch(streamUrl, {
             method: "POST",
             headers: { "Content-Type": "application/json" },
             body: JSON.stringify(runBody),
@@ -1220,48 +1285,32 @@
             const errText = await r.text().catch(() => "");
             res = { ok: false, error: errText || "Stream failed (status " + r.status + ")" };
           } else {
-            const reader = r.body.getReader();
-            const decoder = new TextDecoder();
-            let buffer = "";
-            while (true) {
-              const { done, value } = await reader.read();
-              if (done) break;
-              buffer += decoder.decode(value, { stream: true });
-              const events = buffer.split("\n\n");
-              buffer = events.pop() || "";
-              for (const ev of events) {
-                const dataLine = ev.split("\n").find((l) => l.startsWith("data: "));
-                if (dataLine) {
-                  try {
-                    const msg = JSON.parse(dataLine.slice(6));
-                    if (msg.type === "progress" && generationStatus) {
-                      generationStatus.textContent = msg.message || "Forward batch " + msg.batch + "/" + msg.total;
-                    } else if (msg.type === "done") {
-                      res = { ok: true, ...(msg.result || {}) };
-                    } else if (msg.type === "error") {
-                      res = { ok: false, error: msg.error };
-                    }
-                  } catch (e) { /* ignore parse */ }
-                }
-              }
-            }
-            if (buffer) {
-              const dataLine = buffer.split("\n").find((l) => l.startsWith("data: "));
-              if (dataLine) {
-                try {
-                  const msg = JSON.parse(dataLine.slice(6));
-                  if (msg.type === "done") res = { ok: true, ...(msg.result || {}) };
-                  else if (msg.type === "error") res = { ok: false, error: msg.error };
-                } catch (e) { /* ignore */ }
-              }
-            }
-            if (!res) res = { ok: false, error: "No result from stream" };
+            await readStream(r);
           }
         } catch (streamErr) {
           if (streamErr.name === "AbortError") throw streamErr;
-          res = { ok: false, error: streamErr.message || "Stream error" };
+          if (!runJobId) res = { ok: false, error: streamErr.message || "Stream error" };
+        }
+        // The connection dropped while the job keeps running: re-attach and continue from the last event seen
+        for (let attempt = 0; !res && runJobId && attempt < 5; attempt++) {
+          if (generationStatus) generationStatus.textContent = "Reconnecting...";
+          try {
+            const r = await fetch(
+              "/api/run/jobs/" + encodeURIComponent(runJobId) + "/stream?since=" + jobEventsSeen,
+              { signal: runAbortController.signal }
+            );
+            if (r.ok && r.body) await readStream(r);
+          } catch (streamErr) {
+            if (streamErr.name === "AbortError") throw streamErr;
+          }
+          if (!res) await new Promise((resolve) => setTimeout(resolve, 1000 * (attempt + 1)));
         }
-        if (res && res.error === "No result from stream") {
+        if (!res) res = { ok: false, error: "No result from stream" };
+        // The matrix stream's done event leaves out the rows already streamed
+        if (res.ok && isMatrixStream && !Array.isArray(res.attribution_matrix) && typeof window.PNP_takeAttributionMatrix === "function") {
+          res.attribution_matrix = window.PNP_takeAttributionMatrix() || [];
+        }
+        if (res && res.error === "No result from stream" && !runJobId) {
           const fallback = await fetch("/api/run", {
             method: "POST",
             headers: { "Content-Type": "application/json" },
@@ -1383,6 +1432,12 @@
               <p>Format: <code>{ module: dimension }</code></p>
               <p>Modules: ${escapeHtml(keysStr)}</p>
               <p>Positive: ${res.n_positive ?? "—"} · Negative: ${res.n_negative ?? "—"} · Batches: ${res.num_batches ?? "—"}</p>
+              ${Array.isArray(res.labels) && res.labels.length ? `<p>Labels: ${escapeHtml(res.labels.map((l) => `${l.label} (${l.n_examples})`).join(", "))}</p>` : ""}
+              ${res.direction_sets ? `<p>Direction sets: ${escapeHtml(Object.keys(res.direction_sets).join(", "))} (first one is saved)</p>` : ""}
+              ${res.probe ? Object.entries(res.probe).map(([name, p]) => {
+                const best = Object.entries(p.heldout_accuracy || {}).sort((x, y) => y[1] - x[1])[0];
+                return best ? `<p>Probe ${escapeHtml(name)}: best held-out accuracy ${escapeHtml(best[0])} = ${best[1].toFixed(3)} (train ${p.n_train}, held-out ${p.n_heldout})</p>` : "";
+              }).join("") : ""}
               <div class="residual-save-row">
                 <button type="button" class="btn-save-residual-var">Save To Variable</button>
                 <input type="text" class="residual-var-additional-input" placeholder="Additional naming (optional)" value="" />
@@ -1444,6 +1499,10 @@
           resultToSave.token_location_mode = document.getElementById("input-token-location-mode")?.value || "full";
           resultToSave.token_ids = document.getElementById("input-token-ids")?.value || "";
           resultToSave.batch_size = inputSetting.batch_size;
+          resultToSave.layers_spec = inputSetting.layers || "";
+          resultToSave.hook_kinds_spec = inputSetting.hook_kinds || "";
+          resultToSave.label_pairs_spec = inputSetting.label_pairs || "";
+          resultToSave.covariance_spec = inputSetting.covariance || "auto";
         }
         await API.updateTask(taskId, { result: resultToSave, model, treatment });
         if (el.inputSettingTrigger) {
@@ -1488,6 +1547,7 @@
       alert(err.message || String(err));
     } finally {
       runAbortController = null;
+      runJobId = null;
       setRunButtonState(false);
       if (document.getElementById("generation-status")) {
         const gs = document.getElementById("generation-status");
@@ -1522,9 +1582,16 @@
       const modeEl = document.getElementById("input-token-location-mode");
       const idsEl = document.getElementById("input-token-ids");
       const mode = (modeEl && modeEl.value) || "full";
-      obj.token_location = mode === "ids" && idsEl && idsEl.value.trim()
-        ? idsEl.value.trim().replace(/\s+/g, ",").split(",").map((x) => parseInt(x, 10)).filter((n) => !isNaN(n))
-        : "full";
+      const idsValue = idsEl && idsEl.value ? idsEl.value.trim() : "";
+      if (mode === "ids") {
+        obj.token_location = idsValue
+          ? idsValue.replace(/\s+/g, ",").split(",").map((x) => parseInt(x, 10)).filter((n) => !isNaN(n))
+          : "full";
+      } else if (mode === "last_k") {
+        obj.token_location = "last:" + (parseInt(idsValue, 10) || 1);
+      } else {
+        obj.token_location = mode;
+      }
     }
     return obj;
   }
@@ -1539,6 +1606,15 @@
           return;
         }
         if (!confirm("Generation을 중단하시겠습니까?")) return;
+        if (runJobId) {
+          // Jobs stop after their current step and still stream back the best result so far.
+          fetch("/api/run/jobs/" + encodeURIComponent(runJobId) + "/cancel", { method: "POST" }).catch(() => {
+            if (runAbortController) runAbortController.abort();
+          });
+          const generationStatus = document.getElementById("generation-status");
+          if (generationStatus) generationStatus.textContent = "Stopping...";
+          return;
+        }
         if (runAbortController) runAbortController.abort();
         return;
       }
@@ -2109,6 +2185,9 @@
     if (t === "residual") {
       return { icon: "↗️", label: "Tensor", hint: "Residual direction vectors (layer × dim)." };
     }
+    if (t === "adversarial") {
+      return { icon: "🎯", label: "Checkpoint", hint: "Adversarial search checkpoint (prefix ids, loss history, RNG state)." };
+    }
     return { icon: "📦", label: "Dataset", hint: "Processed data from dataset pipeline." };
   }
   function variableStatusInfo(v) {
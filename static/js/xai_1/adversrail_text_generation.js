@@ -28,12 +28,15 @@
   let rowCounter = 0;
   const COPY_RESET_MS = 1200;
 
-  function buildPrefixedInput(prefix, input) {
+  function buildPrefixedInput(prefix, input, placement) {
     const parts = [];
     const safePrefix = String(prefix || "").trim();
     const safeInput = String(input || "").trim();
     if (safePrefix) parts.push(safePrefix);
-    if (safeInput) parts.push(safeInput);
+    if (safeInput) {
+      if (placement === "suffix") parts.unshift(safeInput);
+      else parts.push(safeInput);
+    }
     return parts.join(" ");
   }
 
@@ -130,7 +133,7 @@
           setButtonFlash(copyBtn, "Run first");
           return;
         }
-        const combined = buildPrefixedInput(prefixText, inputValue);
+        const combined = buildPrefixedInput(prefixText, inputValue, clone.dataset.placement);
         if (!combined) {
           setButtonFlash(copyBtn, "Empty");
           return;
@@ -204,9 +207,21 @@
     if (typeof result.loss === "number") {
       pieces.push(`<span><strong>Loss</strong> ${escapeFn(result.loss.toFixed(3))}</span>`);
     }
+    if (result.target_reached) {
+      pieces.push(`<span><strong>Target reached</strong></span>`);
+    }
+    if (typeof result.iterations_saved === "number") {
+      pieces.push(`<span><strong>Warmup saved</strong> ${escapeFn(String(result.iterations_saved))} it.</span>`);
+    }
+    if (result.progress) {
+      pieces.push(`<span><strong>Iteration</strong> ${escapeFn(result.progress)}</span>`);
+    } else if (result.stop_reason === "plateau" || result.stop_reason === "cancelled") {
+      pieces.push(`<span><strong>Stopped</strong> ${escapeFn(result.stop_reason)}</span>`);
+    }
     resultEl.innerHTML = pieces.length ? pieces.join("") : escapeFn("No prefix found");
     resultEl.classList.remove("adversarial-row-result-empty");
     rowEl.dataset.prefixText = prefixText;
+    rowEl.dataset.placement = result.placement || "prefix";
   }
 
   function refreshResults(results) {
@@ -238,6 +253,7 @@
       const prefix = result.prefix_text || (Array.isArray(result.prefix_tokens) && result.prefix_tokens.join(" ")) || "—";
       const extras = [];
       if (typeof result.loss === "number") extras.push(`loss ${result.loss.toFixed(3)}`);
+      if (typeof result.iterations_saved === "number") extras.push(`warmup saved ${result.iterations_saved} it.`);
       if (result.error) extras.push(`error ${escapeFn(result.error)}`);
       return `<li><span class="adversarial-summary-key">${escapeFn(target)}</span>→ ${escapeFn(prefix)}${extras.length ? ` · ${extras.join(" · ")}` : ""}</li>`;
     });
@@ -260,6 +276,19 @@
     `;
   };
 
+  window.PNP_onAdversarialProgress = function (msg) {
+    const placementSelect = document.getElementById("input-adversarial-placement");
+    const placement = placementSelect ? placementSelect.value : "prefix";
+    const elapsed = typeof msg.elapsed_seconds === "number" ? ` · ${msg.elapsed_seconds.toFixed(1)}s` : "";
+    (msg.rows || []).forEach((row) => {
+      setRowResult(row.row_id, {
+        ...row,
+        placement,
+        progress: row.active ? `${msg.iteration}/${msg.total}${elapsed}` : "",
+      });
+    });
+  };
+
   window.PNP_applyAdversarialResults = function (res) {
     const results = Array.isArray(res?.adversarial_results) ? res.adversarial_results : [];
     refreshResults(results);
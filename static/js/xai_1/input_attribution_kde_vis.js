@@ -1,6 +1,7 @@
 /**
  * Renders the attribution result HTML (controls + KDE chart + token blocks + generated).
- * Exposes window.PNP_renderAttributionResultHTML(res, escapeHtml).
+ * Exposes window.PNP_renderAttributionResultHTML(res, escapeHtml) and the live
+ * attribution-matrix handlers (PNP_onAttributionMatrixMeta / Rows, PNP_takeAttributionMatrix).
  */
 (function () {
   "use strict";
@@ -17,6 +18,64 @@
     return String(raw).replace(/\u0120/g, " ");
   }
 
+  const escAttr = (s) => String(s).replace(/&/g, "&amp;").replace(/</g, "&lt;").replace(/>/g, "&gt;").replace(/"/g, "&quot;");
+
+  /** input_grad_matrix: one row per generated token, one cell per input token (values 0..1) */
+  function matrixRowHTML(outputToken, row) {
+    const cells = (row || [])
+      .map((v) => {
+        const value = Math.max(0, Math.min(1, Number(v) || 0));
+        return `<td style="background: rgba(59, 130, 246, ${value.toFixed(3)})" title="${value.toFixed(3)}"></td>`;
+      })
+      .join("");
+    return `<tr><th class="attribution-matrix-out">${escAttr(tokenDisplayText(outputToken ?? ""))}</th>${cells}</tr>`;
+  }
+
+  function renderAttributionMatrixHTML(inputTokens, outputTokens, rows) {
+    const head = (inputTokens || []).map((t) => `<th><span>${escAttr(tokenDisplayText(t))}</span></th>`).join("");
+    const body = (rows || []).map((row, j) => matrixRowHTML((outputTokens || [])[j], row)).join("");
+    return `
+      <div class="attribution-matrix-wrap">
+        <h3>Attribution matrix <span class="attribution-matrix-count">${(rows || []).length}/${(outputTokens || []).length}</span></h3>
+        <div class="attribution-matrix-scroll">
+          <table class="attribution-matrix"><thead><tr><th></th>${head}</tr></thead><tbody>${body}</tbody></table>
+        </div>
+      </div>
+    `;
+  }
+
+  // Rows of the matrix being streamed; drawn as they arrive and handed to the final result
+  let liveMatrix = null;
+
+  function onAttributionMatrixMeta(msg, container) {
+    liveMatrix = { input_tokens: msg.input_tokens || [], output_tokens: msg.output_tokens || [], rows: [] };
+    if (!container) return;
+    container.classList.add("visible");
+    container.innerHTML = renderAttributionMatrixHTML(liveMatrix.input_tokens, liveMatrix.output_tokens, []);
+  }
+
+  function onAttributionMatrixRows(msg, container) {
+    if (!liveMatrix) return;
+    (msg.rows || []).forEach((row, i) => {
+      liveMatrix.rows[msg.start + i] = row;
+    });
+    const tbody = container ? container.querySelector(".attribution-matrix tbody") : null;
+    if (tbody) {
+      tbody.insertAdjacentHTML(
+        "beforeend",
+        (msg.rows || []).map((row, i) => matrixRowHTML(liveMatrix.output_tokens[msg.start + i], row)).join("")
+      );
+    }
+    const count = container ? container.querySelector(".attribution-matrix-count") : null;
+    if (count) count.textContent = `${liveMatrix.rows.length}/${liveMatrix.output_tokens.length}`;
+  }
+
+  function takeAttributionMatrix() {
+    const rows = liveMatrix ? liveMatrix.rows : null;
+    liveMatrix = null;
+    return rows;
+  }
+
   function renderAttributionResultHTML(res, escapeHtml) {
     escapeHtml = escapeHtml || defaultEscapeHtml;
     const tokens = res.input_tokens || [];
@@ -37,6 +96,13 @@
         return `<span class="attribution-token" data-score="${score}" title="score: ${score}">${esc(display)}</span>`;
       })
       .join("");
+    const responsesHtml = res.attribution_method === "contrastive_grad"
+      ? `<h3>Positive (log p = ${escapeHtml(String(res.logprob_positive ?? "—"))})</h3>
+      <pre class="results-completion-text">${escapeHtml(String(res.positive_response ?? ""))}</pre>
+      <h3>Negative (log p = ${escapeHtml(String(res.logprob_negative ?? "—"))})</h3>
+      <pre class="results-completion-text">${escapeHtml(String(res.negative_response ?? ""))}</pre>`
+      : `<h3>Generated</h3>
+      <pre class="results-completion-text">${escapeHtml(String(res.generated_text ?? ""))}</pre>`;
     return `
     <div class="results-completion-wrap results-attribution-wrap">
       <h3>Input attribution</h3>
@@ -72,8 +138,10 @@
         <div class="attribution-tokens-drop-special-label">Special tokens dropped</div>
         <div class="attribution-tokens-wrap" id="attribution-tokens-wrap-drop-special">${tokenSpansDropSpecial}</div>
       </div>
-      <h3>Generated</h3>
-      <pre class="results-completion-text">${escapeHtml(String(res.generated_text ?? ""))}</pre>
+      ${responsesHtml}
+      ${Array.isArray(res.attribution_matrix) && res.attribution_matrix.length
+        ? renderAttributionMatrixHTML(tokens, res.output_tokens, res.attribution_matrix)
+        : ""}
       <details class="results-completion-meta">
         <summary>Parameters &amp; full result</summary>
         <pre class="results-json">${escapeHtml(JSON.stringify(res, null, 2))}</pre>
@@ -83,5 +151,8 @@
   }
 
   window.PNP_renderAttributionResultHTML = renderAttributionResultHTML;
+  window.PNP_onAttributionMatrixMeta = onAttributionMatrixMeta;
+  window.PNP_onAttributionMatrixRows = onAttributionMatrixRows;
+  window.PNP_takeAttributionMatrix = takeAttributionMatrix;
   window.PNP_tokenDisplayText = tokenDisplayText;
 })();